@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""What a printer is and what it can do, asked once per device.
+
+`discover()` asks the printer for its version (GetPrinterVersion, only
+known by the 715F and PR5F: the rest answer "unknown command" and are
+taken as `default_model`) and for its initialization data, which
+identifies the fiscal unit (CUIT, registration and point of sale).
+
+`CapabilityCache` keeps the result in a JSON file, keyed by device. Each
+entry has a fingerprint of the port (the device node and the USB serial
+link that points to it, if any), so a printer is asked again only when
+the port is new or now leads somewhere else. `connect()` puts both
+together: after the first connection it opens the port at the cached
+speed and sets up the printer without any extra round trip.
+"""
+
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+
+from driver import FiscalDriver, check_status
+from hasar import HasarPrinter, CMD_GET_PRINTER_VERSION, CMD_GET_INIT_DATA
+from schema import COMMANDS, TEXT_SIZES
+
+Capabilities = namedtuple("Capabilities",
+        "model version printer limits commands speed")
+
+# models this driver has no text limits for use those of a close one
+_limits = {
+    "715": "615",
+    "PR5": "615",
+    "PR4": "615",
+    "950": "615",
+    "951": "615",
+}
+
+# port speed of each model
+MODEL_SPEEDS = {
+    "615": 9600,
+    "320": 9600,
+}
+
+# commands only some models have
+_only = {
+    CMD_GET_PRINTER_VERSION: ("715", "PR5"),
+}
+
+# "SMH/P-715F - Versión 2.01"
+_version = re.compile(r"(\d{3}|PR\d)F\D*?(\d+\.\d+)")
+
+# fiscal status bit of an unknown command
+_UNKNOWN_COMMAND = 1 << 3
+
+
+def parse_version(text):
+    """(model, version) from the GetPrinterVersion text, or None."""
+    match = _version.search(text)
+    return match.groups() if match else None
+
+
+def discover(printer, default_model="615"):
+    """Ask `printer` (a HasarPrinter) for its `Capabilities`."""
+    send = printer.driver.send_command
+    model, version = default_model, None
+    reply = send(CMD_GET_PRINTER_VERSION, [], skip_errors=True)
+    if not int(reply[1] or "0", 16) & _UNKNOWN_COMMAND and len(reply) > 2:
+        found = parse_version(reply[2])
+        if found:
+            model, version = found
+    reply = send(CMD_GET_INIT_DATA, [], skip_errors=True)
+    check_status(reply)
+    # CUIT, registration number and point of sale
+    identity = "/".join(reply[i] for i in (2, 4, 6) if i < len(reply))
+    limits = model if model in TEXT_SIZES else _limits.get(model, default_model)
+    commands = sorted(cmd for cmd in COMMANDS
+                      if cmd not in _only or model in _only[cmd])
+    return Capabilities(model, version, identity, limits, commands,
+                        MODEL_SPEEDS.get(model, MODEL_SPEEDS[limits]))
+
+
+def port_fingerprint(device):
+    """Identity of the port behind `device`: the device node it resolves
+    to plus the /dev/serial/by-id links pointing there (their names carry
+    the USB adapter's serial number)."""
+    if not isinstance(device, basestring):
+        return None
+    node = os.path.realpath(device)
+    links = []
+    by_id = "/dev/serial/by-id"
+    if os.path.isdir(by_id):
+        for name in sorted(os.listdir(by_id)):
+            if os.path.realpath(os.path.join(by_id, name)) == node:
+                links.append(name)
+    return "|".join([node] + links)
+
+
+class CapabilityCache(object):
+    """`Capabilities` by device, in the JSON file at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._entries = json.load(f)
+
+    def get(self, device, fingerprint):
+        """Cached capabilities of `device`, if its port still matches."""
+        entry = self._entries.get(device)
+        if entry is None or entry['port'] != fingerprint:
+            return None
+        caps = entry['capabilities']
+        return Capabilities(**dict((str(k), v) for k, v in caps.items()))
+
+    def put(self, device, fingerprint, capabilities):
+        with self._lock:
+            self._entries[device] = {'port': fingerprint,
+                                     'capabilities': capabilities._asdict()}
+            self._save()
+
+    def forget(self, device):
+        with self._lock:
+            if self._entries.pop(device, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def connect(device, cache, default_model="615", name=None):
+    """A HasarPrinter on `device` set up with its capabilities, asking the
+    printer only if `cache` has nothing valid for it. `name` is the cache
+    key, by default the device itself (required for open port objects)."""
+    name = name or device
+    fingerprint = port_fingerprint(device)
+    capabilities = cache.get(name, fingerprint)
+    if capabilities is not None:
+        return HasarPrinter(FiscalDriver(device, capabilities.speed),
+                            capabilities=capabilities)
+    printer = HasarPrinter(FiscalDriver(device, MODEL_SPEEDS[default_model]),
+                           default_model)
+    capabilities = discover(printer, default_model)
+    cache.put(name, fingerprint, capabilities)
+    printer.apply(capabilities)
+    return printer
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""Printer-safe encoding of text fields.
+
+Hasar printers take alphanumeric fields in the range 32-175 of code page
+437: ASCII plus the Spanish letters ñ Ñ á é í ó ú ü Ü É ¿ ¡ º ª. Anything
+else has to be transliterated on the host (Á -> A, ° -> º, “ -> ") or the
+printer rejects the command.
+
+An `Encoder` translates with a per-model table that is filled on demand,
+one code point at a time, and memoizes the encoded and truncated result
+of each text, since most descriptions repeat from ticket to ticket.
+
+A str that starts with DOUBLE_WIDTH (byte 244, the protocol mark) is
+printed in double width characters, and its limit is half of the field
+size. In unicode text u'\xf4' is just an ô; to print unicode text in
+double width, encode it and put the mark in front.
+"""
+
+import unicodedata
+
+from schema import TEXT_SIZES
+
+DOUBLE_WIDTH = '\xf4'
+
+# printable range of alphanumeric fields (manual 2.2.1)
+_FIRST, _LAST = 32, 175
+
+MODEL_CODEPAGES = {
+    "615": "cp437",
+    "320": "cp437",
+}
+
+# characters without a decomposition to a printable one
+_replacements = {
+    u'\xb0': u'\xba',                   # ° -> º
+    u'\xb4': u"'", u'‘': u"'", u'’': u"'", u'‚': u"'",
+    u'“': u'"', u'”': u'"', u'„': u'"',
+    u'\xab': u'"', u'\xbb': u'"',
+    u'–': u'-', u'—': u'-', u'…': u'...',
+    u'€': u'EUR', u'\xd7': u'x', u'\xbd': u'1/2', u'\xbc': u'1/4',
+    u'\t': u' ', u'\n': u' ', u'\r': u' ',
+}
+
+
+class _Table(dict):
+    """unicode.translate() table from code points to printable text."""
+
+    def __init__(self, codepage):
+        dict.__init__(self)
+        self.codepage = codepage
+
+    def _printable(self, char):
+        try:
+            code = ord(char.encode(self.codepage))
+        except (UnicodeError, TypeError):
+            return False
+        return _FIRST <= code <= _LAST
+
+    def __missing__(self, code):
+        char = unichr(code)
+        if self._printable(char):
+            value = char
+        elif char in _replacements:
+            value = _replacements[char]
+            if len(value) == 1 and not self._printable(value):
+                value = u'?'
+        elif unicodedata.category(char)[0] == 'C':
+            # control and unassigned characters are dropped
+            value = u''
+        else:
+            base = u''.join(c for c in unicodedata.normalize('NFKD', char)
+                            if self._printable(c))
+            value = base or u'?'
+        self[code] = value
+        return value
+
+
+class Encoder(object):
+    """Encode and truncate text fields for one printer model."""
+
+    def __init__(self, model="615", cache_size=4096):
+        self.model = model
+        self.codepage = MODEL_CODEPAGES[model]
+        self.sizes = TEXT_SIZES[model]
+        self.cache_size = cache_size
+        self._table = _Table(self.codepage)
+        self._cache = {}
+
+    def printable(self, text):
+        """(double width, unicode of `text` with only printable characters);
+        `text` is unicode or a UTF-8/latin-1 str, only the latter can carry
+        the DOUBLE_WIDTH mark."""
+        double = False
+        if isinstance(text, str):
+            double = text[:1] == DOUBLE_WIDTH
+            if double:
+                text = text[1:]
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError:
+                text = text.decode('latin-1')
+        return double, text.translate(self._table)
+
+    def encode(self, text):
+        """Printable bytes of `text` (unicode, or a UTF-8/latin-1 str)."""
+        double, text = self.printable(text)
+        encoded = text.encode(self.codepage)
+        return DOUBLE_WIDTH + encoded if double else encoded
+
+    def fit(self, text, size):
+        """Encode `text` and cut it to `size`, a number of characters or a
+        field name of TEXT_SIZES (e.g. 'LINE_ITEM')."""
+        # str and unicode with the same characters differ (only str has
+        # the DOUBLE_WIDTH mark), and must not compare with each other
+        key = (isinstance(text, unicode), text, size)
+        value = self._cache.get(key)
+        if value is None:
+            limit = self.sizes.get(size, size)
+            value = self.encode(text)
+            if value[:1] == DOUBLE_WIDTH:
+                value = value[:1 + limit // 2]
+            else:
+                value = value[:limit]
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = value
+        return value
+
+
+_encoders = {}
+
+def encoder(model):
+    """Shared `Encoder` of `model`."""
+    e = _encoders.get(model)
+    if e is None:
+        e = _encoders[model] = Encoder(model)
+    return e
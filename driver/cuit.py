@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""CUIT/CUIL validation and a cache of checked customers.
+
+A CUIT has 11 digits; the last one is a check digit computed from the
+other ten with the weights 5 4 3 2 7 6 5 4 3 2, modulo 11 (a result of
+11 gives 0 and 10 gives 9, as the printer computes it).
+
+`is_valid()` checks one number. `validate_many()` checks a whole list at
+once, which is what imports of customer master files need; it runs on
+numpy arrays when numpy is installed and on precomputed tables otherwise.
+
+`check_customer()` validates a `CustomerData` before it is sent to the
+printer and keeps the result in an LRU cache, since the same customers
+come back on every factura A.
+
+Like schema.py, this module only uses the standard library (numpy is
+optional) so that the emulator can share it.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+WEIGHTS = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+
+DIGITS = '0123456789'
+
+# id types of SetCustomerData that carry a CUIT or a CUIL
+CUIT_TYPES = ('C', 'L')
+
+# iva types that can only be given with a CUIT
+_needs_cuit = ('I',)
+
+# schema choices of SetCustomerData
+_iva_types = 'INEACBMSVWT'
+
+# digit value times weight, per position
+_weighted = [dict((str(d), d * w) for d in range(10)) for w in WEIGHTS]
+
+# check digit, as a character, of each weighted sum modulo 11
+_check = dict((r, str({11: 0, 10: 9}.get(11 - r, 11 - r))) for r in range(11))
+
+# below this size the numpy conversion costs more than it saves
+NUMPY_MIN_BATCH = 64
+
+
+def normalize(cuit):
+    """`cuit` without the usual separators (20-12345678-9 -> 20123456789)."""
+    return cuit.replace('-', '').replace(' ', '').replace('.', '')
+
+
+def _well_formed(cuit):
+    # not isdigit(): it also takes unicode digits of other scripts
+    return len(cuit) == 11 and all(c in DIGITS for c in cuit)
+
+
+def is_valid(cuit):
+    """True if `cuit` has 11 digits and a correct check digit."""
+    if not _well_formed(cuit):
+        return False
+    total = 0
+    for table, digit in zip(_weighted, cuit):
+        total += table[digit]
+    return _check[total % 11] == cuit[10]
+
+
+def validate_many(cuits):
+    """List of `is_valid()` for each of `cuits` (already normalized)."""
+    if not isinstance(cuits, list):
+        cuits = list(cuits)
+    if numpy is None or len(cuits) < NUMPY_MIN_BATCH:
+        return [is_valid(c) for c in cuits]
+    well_formed = numpy.array([_well_formed(c) for c in cuits], dtype=bool)
+    # str() also turns well formed unicode numbers into bytes
+    data = "".join(str(c) if ok else "00000000000"
+                   for c, ok in zip(cuits, well_formed))
+    digits = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 11)
+    digits = digits.astype(numpy.int32) - ord('0')
+    check = 11 - digits[:, :10].dot(numpy.array(WEIGHTS, dtype=numpy.int32)) % 11
+    check[check == 11] = 0
+    check[check == 10] = 9
+    return (well_formed & (check == digits[:, 10])).tolist()
+
+
+class CustomerError(ValueError):
+    """The printer would reject a `CustomerData`."""
+
+
+def customer_errors(data):
+    """Problems of a `CustomerData` that the printer would reject."""
+    errors = []
+    if data.iva_type not in _iva_types:
+        errors.append(u"tipo de IVA desconocido (%s)" % data.iva_type)
+    if data.id_type in CUIT_TYPES:
+        if not is_valid(data.id_number):
+            errors.append(u"CUIT inválido (%s)" % data.id_number)
+    elif data.iva_type in _needs_cuit:
+        errors.append(u"el tipo de IVA %s requiere CUIT" % data.iva_type)
+    return errors
+
+
+class CustomerCache(object):
+    """Checked customers, evicted in approximate LRU order (two generations,
+    as in FrameCache)."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._young = {}
+        self._old = {}
+
+    def check(self, data):
+        """`data` with its CUIT normalized; raise CustomerError if the
+        printer would reject it."""
+        entry = self._young.get(data)
+        if entry is None:
+            entry = self._old.pop(data, None)
+            if entry is None:
+                self.misses += 1
+                if data.id_type in CUIT_TYPES:
+                    clean = data._replace(id_number=normalize(data.id_number))
+                else:
+                    clean = data
+                entry = clean, customer_errors(clean)
+            else:
+                self.hits += 1
+            if self.size:
+                if len(self._young) * 2 >= self.size:
+                    self._old = self._young
+                    self._young = {}
+                self._young[data] = entry
+        else:
+            self.hits += 1
+        clean, errors = entry
+        if errors:
+            raise CustomerError(u"; ".join(errors).encode('utf-8'))
+        return clean
+
+    def clear(self):
+        self._young.clear()
+        self._old.clear()
+
+
+_customers = CustomerCache()
+
+def check_customer(data):
+    """`CustomerCache.check()` on the cache shared by all printers."""
+    return _customers.check(data)
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import random
+import threading
 import time
 import serial
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
 
 _fiscal_status = [
     (1<<0, "Error en memoria fiscal"),
@@ -34,6 +39,7 @@ DC4 = chr(0x14)
 STX = chr(0x02)
 ETX = chr(0x03)
 FS = chr(0x1c)
+ESC = chr(0x1b)
 
 
 class PrinterException(Exception):
@@ -48,6 +54,13 @@ class FiscalStatusError(PrinterException):
 class CommunicationError(PrinterException):
     pass
 
+class CommunicationTimeout(CommunicationError):
+    pass
+
+class PortError(CommunicationError):
+    """The serial port failed or went away (e.g. an unplugged USB adapter)."""
+    pass
+
 
 def _check_status(status, statuses, toraise):
     x = int(status, 16)
@@ -62,32 +75,201 @@ def _check_fiscal_status(status):
     _check_status(status, _fiscal_status, FiscalStatusError)
 
 def _check_bcc(message, bcc):
-    log.debug("message", message, [ord(x) for x in message])
+    log.debug("message %r %r", message, [ord(x) for x in message])
     check_sum = sum([ord(x) for x in message])
     check_sum_h = ("0000" + hex(check_sum)[2:])[-4:].upper()
-    log.debug("check sum: ", check_sum, " (hex): ", check_sum_h)
-    log.debug("bcc: ", bcc)
+    log.debug("check sum: %s (hex): %s", check_sum, check_sum_h)
+    log.debug("bcc: %s", bcc)
     return check_sum_h == bcc.upper()
 
+def _split_reply(reply):
+    # remove STX <seq_number> <command> <sep> ... ETX; an ESC command takes
+    # two bytes, unless the printer did not know it and echoed ESC alone
+    start = 5 if reply[2] == ESC and reply[3] != FS else 4
+    r = reply[start:-1]
+    return r.split(FS)
+
+def command_bytes(command):
+    """Command byte(s) of `command`: codes above 0xff are ESC commands
+    (0x1b7f is ESC 7fH)."""
+    if command > 0xff:
+        return chr(command >> 8) + chr(command & 0xff)
+    return chr(command)
+
+def check_status(fields):
+    """Raise the error flagged by the status words of a parsed reply."""
+    printer_status, fiscal_status = fields[:2]
+    _check_printer_status(printer_status)
+    _check_fiscal_status(fiscal_status)
+
 def _parse_reply(reply, skip_errors):
-    r = reply[4:-1] # remove STX <seq_number> <command> <sep> ... ETX
-    fields = r.split(FS)
+    fields = _split_reply(reply)
     if not skip_errors:
-        printer_status, fiscal_status = fields[:2]
-        _check_printer_status(printer_status)
-        _check_fiscal_status(fiscal_status)
+        check_status(fields)
     return fields
 
+_port_locks = {}
+_port_locks_guard = threading.Lock()
+
+def port_lock(device):
+    """Return the lock that serializes every exchange on `device`."""
+    with _port_locks_guard:
+        lock = _port_locks.get(device)
+        if lock is None:
+            lock = _port_locks[device] = threading.RLock()
+        return lock
+
+
+# traffic of one send_command(): bytes written and read, frames sent again
+# (timeouts, NAKs), seconds the printer spent answering DC2/DC4 and the
+# whole exchange
+ExchangeStats = namedtuple("ExchangeStats",
+        "bytes_out bytes_in retries busy elapsed")
+
+
+class LatencyEstimator(object):
+    """Smoothed reply latency of one command, as TCP estimates its RTO.
+
+    See RFC 6298: `srtt` and `rttvar` are updated with every clean sample
+    and the timeout is srtt + K * rttvar, doubled after each expiration
+    until a new sample arrives.
+    """
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+    K = 4
+    GRANULARITY = 0.01
+    MAX_BACKOFF = 64
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.samples += 1
+        self.backoff = 1
+
+    def expired(self):
+        self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+
+    def timeout(self, floor, ceiling):
+        if self.srtt is None:
+            return ceiling
+        rto = self.srtt + max(self.GRANULARITY, self.K * self.rttvar)
+        return min(max(rto, floor) * self.backoff, ceiling)
+
+
+class FrameCache(object):
+    """Cache of encoded frames, keyed by (command, fields).
+
+    A frame is STX <seq> <command> [FS field]... ETX <BCC>. Only the
+    sequence byte changes between two sends of the same command, so the
+    cache keeps the part after it together with the byte sum of the rest,
+    and each send adds the sequence byte to that sum to get the BCC.
+
+    Eviction is an approximate LRU with two plain dicts: entries are added
+    to the young generation and, when it fills half of `size`, the old one
+    is dropped and the young one takes its place. An old entry that is used
+    again moves back to the young generation.
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._young = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hit_rate}
+
+    def frame(self, command, fields, seq):
+        key = (command, tuple(fields))
+        entry = self._young.get(key)
+        if entry is None:
+            entry = self._old.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                body = command_bytes(command)
+                if fields:
+                    # the frame and its BCC are bytes: a unicode field would
+                    # make the whole body unicode
+                    body += FS + FS.join(f.encode('latin-1')
+                                         if isinstance(f, unicode) else f
+                                         for f in fields)
+                body += ETX
+                entry = body, sum(bytearray(body)) + ord(STX)
+            else:
+                self.hits += 1
+            if self.size:
+                if len(self._young) * 2 >= self.size:
+                    self._old = self._young
+                    self._young = {}
+                self._young[key] = entry
+        else:
+            self.hits += 1
+        body, partial = entry
+        return "%s%c%s%04X" % (STX, seq, body, (partial + seq) & 0xffff)
+
+    def clear(self):
+        self._young.clear()
+        self._old.clear()
 
 
 class FiscalDriver(object):
+    # initial and maximum wait for a reply; the actual wait adapts to the
+    # latency observed for each command (see LatencyEstimator)
     WAIT_TIME = 10
+    MIN_WAIT_TIME = 0.5
     RETRIES = 4
     WAIT_CHAR_TIME = 0.1
     NO_REPLY_TRIES = 200
+    # frames kept encoded for resending (see FrameCache), 0 to disable
+    FRAME_CACHE_SIZE = 512
+    # reopening a failed port: first wait, longest wait and give up time
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 8
+    RECONNECT_TIME = 120
 
     def __init__(self, device, speed=9600):
-        self._serial = serial.Serial(port=device, timeout=None, baudrate=speed)
+        self.device = device
+        self.speed = speed
+        if isinstance(device, basestring):
+            self._serial = self._open()
+        else:
+            # an already open port (e.g. the emulator's in-memory loopback)
+            self._serial = device
+        self.lock = port_lock(device)
+        self.last_activity = 0
+        self.reconnects = 0
+        self.outage_time = 0.0
+        self.last_outage = None
+        # totals since the port was opened (see ExchangeStats)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retransmissions = 0
+        self.busy_time = 0.0
+        self._local = threading.local()
+        self._reply_listeners = []
+        self._latency = {}
+        self._timeout_floors = {}
+        self.frames = FrameCache(self.FRAME_CACHE_SIZE)
 
         # init sequence number
         self._seq_number = random.randint(0x20, 0x7f)
@@ -100,29 +282,148 @@ class FiscalDriver(object):
             self._seq_number = 0x20
 
     def _write(self, string):
-        log.debug("_write", ", ".join(["%x" % ord(c) for c in string]))
-        self._serial.write(string)
+        log.debug("_write %s", ", ".join(["%x" % ord(c) for c in string]))
+        try:
+            self._serial.write(string)
+        except (serial.SerialException, EnvironmentError) as e:
+            raise PortError(u"Falla del puerto %s: %s" % (self.device, e))
+        self.bytes_out += len(string)
 
     def _read(self, count):
-        ret = self._serial.read(count)
-        log.debug("_read", ", ".join(["%x" % ord(c) for c in ret]))
+        try:
+            ret = self._serial.read(count)
+        except (serial.SerialException, EnvironmentError) as e:
+            raise PortError(u"Falla del puerto %s: %s" % (self.device, e))
+        self.bytes_in += len(ret)
+        log.debug("_read %s", ", ".join(["%x" % ord(c) for c in ret]))
         return ret
 
-    def _send_message(self, message):
-        self._send_wait_ack(message)
-        timeout = time.time() + self.WAIT_TIME
+    def _open(self):
+        if isinstance(self.device, basestring):
+            return serial.Serial(port=self.device, timeout=self.WAIT_CHAR_TIME,
+                                 baudrate=self.speed)
+        # a port object given by the caller is reopened in place
+        self.device.open()
+        return self.device
+
+    def _reconnect(self, error):
+        """Reopen the port after `error`, waiting twice as long after each
+        failed attempt. Raise PortError after RECONNECT_TIME seconds."""
+        if not isinstance(self.device, basestring) and \
+                not hasattr(self.device, 'open'):
+            raise error
+        log.warning("%s, reopening the port", error.args[0])
+        start = time.time()
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                self._serial.close()
+            except Exception:
+                pass
+            try:
+                self._serial = self._open()
+                break
+            except (serial.SerialException, EnvironmentError) as e:
+                if time.time() - start + delay > self.RECONNECT_TIME:
+                    self._outage(start)
+                    raise PortError(u"No se pudo reabrir el puerto %s: %s"
+                                    % (self.device, e))
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+        # bytes of the broken exchange must not be taken for the reply
+        reset = getattr(self._serial, 'reset_input_buffer', None) or \
+                getattr(self._serial, 'flushInput', None)
+        if reset is not None:
+            reset()
+        self.reconnects += 1
+        self._outage(start)
+        log.warning("port %s reopened after %.1fs", self.device,
+                    self.last_outage)
+
+    def _outage(self, start):
+        self.last_outage = time.time() - start
+        self.outage_time += self.last_outage
+
+    def link_stats(self):
+        """Reconnections and seconds without a working port so far."""
+        return {'reconnects': self.reconnects,
+                'outage_time': self.outage_time,
+                'last_outage': self.last_outage}
+
+    def set_timeout_floor(self, command, seconds):
+        """Never wait less than `seconds` for a reply to `command`."""
+        self._timeout_floors[command] = seconds
+
+    def timeout_for(self, command):
+        """Seconds to wait for the reply to `command` before resending it."""
+        floor = self._timeout_floors.get(command, self.MIN_WAIT_TIME)
+        estimator = self._latency.get(command)
+        if estimator is None:
+            return max(floor, self.WAIT_TIME)
+        return estimator.timeout(floor, max(floor, self.WAIT_TIME))
+
+    def latency(self, command):
+        """The `LatencyEstimator` of `command`, or None if never sent."""
+        return self._latency.get(command)
+
+    def _exchange(self, message, command):
+        # the frame keeps its sequence number across reconnections: if the
+        # printer ran it before the port failed, it answers with the reply
+        # it already has instead of running it again
+        for reconnects in range(self.RETRIES + 1):
+            try:
+                return self._send_with_retries(message, command)
+            except PortError as e:
+                self._reconnect(e)
+        # a port that fails again as soon as it is reopened
+        return self._send_with_retries(message, command)
+
+    def _send_with_retries(self, message, command):
+        estimator = self._latency.get(command)
+        if estimator is None:
+            estimator = self._latency[command] = LatencyEstimator()
+        for attempt in range(self.RETRIES + 1):
+            wait = self.timeout_for(command)
+            start = time.time()
+            try:
+                reply = self._send_message(message, wait)
+            except CommunicationTimeout:
+                # the same frame is sent again: the printer recognizes the
+                # sequence number and answers without running it twice
+                estimator.expired()
+                self.retransmissions += 1
+                log.warning("no reply to 0x%x after %.2fs (attempt %d)",
+                            command, wait, attempt + 1)
+                continue
+            if attempt == 0:
+                # Karn: retransmitted exchanges are ambiguous, not sampled
+                estimator.sample(time.time() - start)
+            return reply
+        raise CommunicationError(u"Expiró el tiempo de espera de "\
+                u"respuesta de la impresora. Revise la conexión")
+
+    def _send_message(self, message, wait):
+        self._send_wait_ack(message, wait)
+        timeout = time.time() + wait
         retries = 0
+        busy_since = None
         while True:
             if time.time() > timeout:
-                raise CommunicationError(u"Expiró el tiempo de espera de "\
+                raise CommunicationTimeout(u"Expiró el tiempo de espera de "\
                         u"respuesta de la impresora. Revise la conexión")
             c = self._read(1)
             if len(c) == 0:
                 continue
             elif c in (DC2, DC4):
-                timeout += self.WAIT_TIME
+                # the printer is busy: it keeps the exchange alive
+                timeout = time.time() + wait
+                if busy_since is None:
+                    busy_since = time.time()
                 continue
             elif c == STX:
+                if busy_since is not None:
+                    self.busy_time += time.time() - busy_since
+                    busy_since = None
                 reply = c
                 noreply_counter = 0
                 while c != ETX:
@@ -140,7 +441,8 @@ class FiscalDriver(object):
                 if not _check_bcc(reply, bcc):
                     # Send NAK and wait new answer
                     self._write(NAK)
-                    timeout = time.time() + self.WAIT_TIME
+                    self.retransmissions += 1
+                    timeout = time.time() + wait
                     retries += 1
                     if retries > self.RETRIES:
                         raise CommunicationError(u"Falla de comunicación, "\
@@ -149,7 +451,7 @@ class FiscalDriver(object):
                 elif reply[1] != chr(self._seq_number):
                     # Resend message
                     self._write(ACK)
-                    timeout = time.time() + self.WAIT_TIME
+                    timeout = time.time() + wait
                     retries += 1
                     if retries > self.RETRIES:
                         raise CommunicationError(u"Falla de comunicación, "\
@@ -160,15 +462,15 @@ class FiscalDriver(object):
                     break
         return reply
 
-    def _send_wait_ack(self, message, count=0):
+    def _send_wait_ack(self, message, wait, count=0):
         if count > 10:
             raise CommunicationError(u"Demasiados NAK desde la impresora. "\
                     u"Revise la conexión")
         self._write(message)
-        timeout = time.time() > self.WAIT_TIME
+        timeout = time.time() + wait
         while True:
             if time.time() > timeout:
-                raise CommunicationError(u"Expiró el tiempo de espera de "\
+                raise CommunicationTimeout(u"Expiró el tiempo de espera de "\
                         u"respuesta de la impresora. Revise la conexión")
             c = self._read(1)
             if len(c) == 0:
@@ -176,7 +478,8 @@ class FiscalDriver(object):
             elif c == ACK:
                 return True
             elif c == NAK:
-                return self._send_wait_ack(message, count+1)
+                self.retransmissions += 1
+                return self._send_wait_ack(message, wait, count+1)
 
     def __del__(self):
         if hasattr(self, "_serial"):
@@ -192,13 +495,35 @@ class FiscalDriver(object):
             pass
         del self._serial
 
+    def add_reply_listener(self, listener):
+        """Call `listener(command, fields)` for every reply received."""
+        self._reply_listeners.append(listener)
+
+    def remove_reply_listener(self, listener):
+        if listener in self._reply_listeners:
+            self._reply_listeners.remove(listener)
+
+    def last_exchange(self):
+        """`ExchangeStats` of the last command sent by the calling thread."""
+        return getattr(self._local, 'exchange', None)
+
     def send_command(self, command, fields, skip_errors=False):
-        msg = STX + chr(self._seq_number) + chr(command)
-        if fields:
-            msg += FS + FS.join(fields)
-        msg += ETX
-        check_sum = sum([ord(x) for x in msg])
-        msg += ("0000" + hex(check_sum)[2:])[-4:].upper()
-        reply = self._send_message(msg)
-        self._increment_seq_number()
+        with self.lock:
+            start = time.time()
+            before = (self.bytes_out, self.bytes_in, self.retransmissions,
+                      self.busy_time)
+            try:
+                msg = self.frames.frame(command, fields, self._seq_number)
+                reply = self._exchange(msg, command)
+                self._increment_seq_number()
+                self.last_activity = time.time()
+            finally:
+                self._local.exchange = ExchangeStats(
+                        self.bytes_out - before[0], self.bytes_in - before[1],
+                        self.retransmissions - before[2],
+                        self.busy_time - before[3], time.time() - start)
+        if self._reply_listeners:
+            fields = _split_reply(reply)
+            for listener in self._reply_listeners:
+                listener(command, fields)
         return _parse_reply(reply, skip_errors)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming export of fiscal records (namedtuples) to CSV and JSON lines.
+
+Both writers consume any iterable, one record at a time, so they can be fed
+straight from `HasarPrinter.daily_reports()` without collecting the range.
+"""
+
+import csv
+import json
+from datetime import date
+from decimal import Decimal
+
+
+def _text(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def write_csv(records, f, header=True):
+    """Write `records` to the file `f` as CSV. Returns the number written."""
+    writer = csv.writer(f)
+    count = 0
+    for record in records:
+        if header and count == 0:
+            writer.writerow(record._fields)
+        writer.writerow([_text(v) for v in record])
+        count += 1
+    return count
+
+
+def write_jsonl(records, f):
+    """Write `records` to the file `f`, one JSON object per line.
+
+    Amounts are written as strings so no precision is lost.
+    """
+    count = 0
+    for record in records:
+        f.write(json.dumps(dict((k, _text(v)) for k, v
+                                in zip(record._fields, record)),
+                           sort_keys=True))
+        f.write("\n")
+        count += 1
+    return count
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from Queue import Queue, Empty
+from collections import namedtuple
+
+from driver import FiscalDriver, PrinterException, log
+from hasar import HasarPrinter, CMD_STATUS_REQUEST, parse_daily_close
+
+FleetResult = namedtuple("FleetResult",
+        "device report error attempts elapsed")
+
+
+class FleetReport(object):
+    """Results of a fleet operation, one `FleetResult` per device."""
+
+    def __init__(self, close_type, results, elapsed):
+        self.close_type = close_type
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def succeeded(self):
+        return [r for r in self.results if r.report is not None]
+
+    @property
+    def failed(self):
+        return [r for r in self.results if r.report is None]
+
+    def total(self, field):
+        """Sum of a `DailyCloseReport` field over the successful closes."""
+        return sum(getattr(r.report, field) for r in self.succeeded)
+
+    def summary(self):
+        lines = ["%s close: %d ok, %d failed in %.1fs (slowest %.1fs)" % (
+            self.close_type, len(self.succeeded), len(self.failed),
+            self.elapsed, max([r.elapsed for r in self.results] or [0]))]
+        lines.append("sold %s  iva %s  credit %s" % (self.total('sold'),
+                     self.total('iva'), self.total('credit')))
+        for r in self.failed:
+            lines.append("FAILED %s after %d attempt(s): %s" % (r.device,
+                         r.attempts, r.error))
+        return "\n".join(lines)
+
+
+class Fleet(object):
+    """Run daily closes on many printers at once.
+
+    At most `concurrency` devices are worked on at the same time. Each
+    device gets `timeout` seconds per attempt and up to `retries` extra
+    attempts, `retry_delay` seconds apart.
+
+    For a Z only the steps before the close command are retried: opening
+    the port and a status request. Once the close command has been sent, a
+    failure is reported rather than retried. The printer may have closed
+    the day already, and a second Z would open and close an empty day.
+    """
+
+    def __init__(self, devices, printer_factory=None, concurrency=8,
+                 timeout=120, retries=2, retry_delay=5):
+        self.devices = list(devices)
+        self.printer_factory = printer_factory or \
+                (lambda device: HasarPrinter(FiscalDriver(device)))
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def daily_close(self):
+        return self.run('Z')
+
+    def partial_close(self):
+        return self.run('X')
+
+    def run(self, close_type):
+        start = time.time()
+        pending = Queue()
+        for i, device in enumerate(self.devices):
+            pending.put((i, device))
+        results = [None] * len(self.devices)
+        workers = [threading.Thread(target=self._worker,
+                                    args=(pending, results, close_type),
+                                    name="fleet-%d" % n)
+                   for n in range(min(self.concurrency, len(self.devices)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return FleetReport(close_type, results, time.time() - start)
+
+    def _worker(self, pending, results, close_type):
+        while True:
+            try:
+                i, device = pending.get_nowait()
+            except Empty:
+                return
+            results[i] = self._close_device(device, close_type)
+
+    def _close_device(self, device, close_type):
+        start = time.time()
+        error = None
+        for attempt in range(1, self.retries + 2):
+            outcome = {}
+            thread = threading.Thread(target=self._attempt,
+                    args=(device, close_type, outcome),
+                    name="fleet-close-%s" % (device,))
+            thread.daemon = True
+            thread.start()
+            thread.join(self.timeout)
+            if thread.is_alive():
+                # the port is still in use: another attempt would wait on it
+                error = u"no reply after %ss" % self.timeout
+                break
+            if 'report' in outcome:
+                return FleetResult(device, outcome['report'], None, attempt,
+                                   time.time() - start)
+            error = outcome.get('error')
+            if outcome.get('sent') and close_type == 'Z':
+                break
+            log.warning("%s close on %s failed (attempt %d): %s",
+                        close_type, device, attempt, error)
+            if attempt <= self.retries:
+                time.sleep(self.retry_delay)
+        return FleetResult(device, None, error, attempt, time.time() - start)
+
+    def _attempt(self, device, close_type, outcome):
+        printer = None
+        try:
+            printer = self.printer_factory(device)
+            printer.execute(CMD_STATUS_REQUEST)
+            outcome['sent'] = True
+            if close_type == 'Z':
+                reply = printer.daily_close()
+            else:
+                reply = printer.partial_close()
+            outcome['report'] = parse_daily_close(reply)
+        except (PrinterException, EnvironmentError) as e:
+            outcome['error'] = e
+        except Exception as e:
+            log.exception("unexpected error closing %s", device)
+            outcome['error'] = e
+        finally:
+            if printer is not None:
+                try:
+                    printer.close()
+                except Exception:
+                    pass
@@ -1,39 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import textwrap
+import time
 from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
 
-from driver import PrinterException
+from driver import PrinterException, check_status, log
+from monitor import StatusMonitor
+from schema import COMMANDS, FieldError, validator
+from charset import DOUBLE_WIDTH, encoder
+from cuit import CustomerError, check_customer
 
 class Printer(object):
     pass
 
-_text_sizes = {
-    "615": {
-        'NON_FISCAL_TEXT': 40,
-        'CUSTOMER_NAME': 30,
-        'CUSTOMER_ADDRESS': 40,
-        'PAYMENT_DESCRIPTION': 30,
-        'FISCAL_TEXT': 20,
-        'LINE_ITEM': 20,
-        'LAST_ITEM_DISCOUNT': 20,
-        'GENERAL_DISCOUNT': 20,
-        'EMBARK_ITEM': 108,
-        'RECEIPT_TEXT': 106,
-    },
-    "320": {
-        'NON_FISCAL_TEXT': 120,
-        'CUSTOMER_NAME': 50,
-        'CUSTOMER_ADDRESS': 50,
-        'PAYMENT_DESCRIPTION': 50,
-        'FISCAL_TEXT': 50,
-        'LINE_ITEM': 50,
-        'LAST_ITEM_DISCOUNT': 50,
-        'GENERAL_DISCOUNT': 50,
-        'EMBARK_ITEM': 108,
-        'RECEIPT_TEXT': 106,
-    }
-}
-
 # type document
 DOC_TICKET             = u'TICKET'
 DOC_CREDIT_TICKET      = u'CREDIT_TICKET'
@@ -46,6 +28,9 @@ DOC_NON_FISCAL         = u'NON_FISCAL'
 # printer commands
 CMD_STATUS_REQUEST           = 0x2a
 CMD_DAILY_CLOSE              = 0x39
+CMD_DAILY_CLOSE_BY_DATE      = 0x3a
+CMD_DAILY_CLOSE_BY_NUMBER    = 0x3b
+CMD_GET_DAILY_REPORT         = 0x3c
 CMD_OPEN_FISCAL_RECEIPT      = 0x40
 CMD_PRINT_TEXT_IN_FISCAL     = 0x41
 CMD_PRINT_LINE_ITEM          = 0x42
@@ -59,6 +44,7 @@ CMD_GENERAL_DISCOUNT         = 0x54
 CMD_LAST_ITEM_DISCOUNT       = 0x55
 CMD_SET_HEADER_TRAILER       = 0x5d
 CMD_SET_CUSTOMER_DATA        = 0x62
+CMD_GET_INIT_DATA            = 0x73
 CMD_OPEN_DRAWER              = 0x7b
 CMD_OPEN_DNFH                = 0x80
 CMD_OPEN_CREDIT_NOTE         = 0x80
@@ -72,10 +58,23 @@ CMD_CREDIT_NOTE_REFERENCE    = 0x93
 CMD_PRINT_RECEIPT_TEXT       = 0x97
 CMD_CANCEL_ANY_DOCUMENT      = 0x98
 CMD_REPRINT                  = 0x99
+CMD_GET_PRINTER_VERSION      = 0x1b7f   # ESC 7fH, 715F and PR5F only
 
 # internal commands
 CMD_CLOSE = 'CMD_CLOSE_DOCUMENT'
 
+# minimum reply wait (seconds) of commands that print a lot before answering
+_timeout_floors = {
+    CMD_DAILY_CLOSE: 10,
+    CMD_DAILY_CLOSE_BY_DATE: 10,
+    CMD_DAILY_CLOSE_BY_NUMBER: 10,
+    CMD_REPRINT: 10,
+    CMD_CLOSE_FISCAL_RECEIPT: 3,
+    CMD_CLOSE_NON_FISCAL_RECEIPT: 3,
+    CMD_CLOSE_DNFH: 3,
+    CMD_CANCEL_ANY_DOCUMENT: 3,
+}
+
 # iva types
 IVA_RESPONSABLE_INSCRIPTO    = 'I'
 IVA_RESPONSABLE_NO_INSCRIPTO = 'N'
@@ -90,21 +89,155 @@ _iva_types = (
 )
 
 
+DailyCloseReport = namedtuple("DailyCloseReport",
+        "number cancelled dnfh_issued non_fiscal_issued fiscal_issued "
+        "last_b last_a sold iva internal_taxes perceptions iva_rni "
+        "last_credit_b last_credit_a credit credit_iva credit_internal_taxes "
+        "credit_perceptions credit_iva_rni cancelled_credit")
+
+# reply fields of CMD_DAILY_CLOSE after the status words (manual 3.3.2);
+# None marks the reserved fields
+_daily_close_fields = (
+    ('number', int), ('cancelled', int), ('dnfh_issued', int),
+    ('non_fiscal_issued', int), ('fiscal_issued', int), None,
+    ('last_b', int), ('last_a', int), ('sold', Decimal), ('iva', Decimal),
+    ('internal_taxes', Decimal), ('perceptions', Decimal),
+    ('iva_rni', Decimal), ('last_credit_b', int), ('last_credit_a', int),
+    ('credit', Decimal), ('credit_iva', Decimal),
+    ('credit_internal_taxes', Decimal), ('credit_perceptions', Decimal),
+    ('credit_iva_rni', Decimal), None, ('cancelled_credit', int),
+)
+
+def parse_daily_close(reply):
+    """Build a `DailyCloseReport` from the reply of a Z or X close. A reply
+    that can't be read raises PrinterException: the close did run."""
+    values = {}
+    try:
+        if len(reply) < 2 + len(_daily_close_fields):
+            raise ValueError("%d fields" % len(reply))
+        for field, value in zip(_daily_close_fields, reply[2:]):
+            if field is not None:
+                name, convert = field
+                values[name] = convert(value)
+    except (ValueError, ArithmeticError):
+        raise PrinterException("Cierre hecho, pero su respuesta no se pudo "
+                               "interpretar: %r" % (reply,))
+    return DailyCloseReport(**values)
+
+
+StatusReport = namedtuple("StatusReport",
+        "printer_status fiscal_status last_b aux_status last_a "
+        "document_status last_credit_b last_credit_a")
+
+def parse_status(reply):
+    """Build a `StatusReport` from the reply of CMD_STATUS_REQUEST."""
+    fields = list(reply[:8]) + [None] * (8 - len(reply))
+    for i in (2, 4, 6, 7):
+        if fields[i] is not None:
+            fields[i] = int(fields[i])
+    return StatusReport(*fields)
+
+# StatusReport counter of each document type (OpenFiscalReceipt and
+# OpenCreditNote); debit notes share the counter of their bill letter
+_document_counters = {
+    'A': 'last_a', 'D': 'last_a',
+    'B': 'last_b', 'C': 'last_b', 'E': 'last_b', 'T': 'last_b',
+    'R': 'last_credit_a', 'S': 'last_credit_b',
+}
+
+def document_counter(commands):
+    """Name of the `StatusReport` field that numbers the document made by
+    `commands`, or None for documents the printer does not number."""
+    for cmd, args in commands:
+        if cmd in (CMD_OPEN_FISCAL_RECEIPT, CMD_OPEN_CREDIT_NOTE) and args:
+            return _document_counters.get(args[0])
+    return None
+
+def document_open(status):
+    """True if `status` (a StatusReport) shows an open document."""
+    return (int(status.aux_status or "0", 16) & 0xf) not in (0, 1, 2, 9)
+
+
+# fiscal status bit set when a command gets an invalid data field
+FISCAL_INVALID_DATA = 1<<4
+
+DailyReport = namedtuple("DailyReport",
+        "date number last_b last_a sold iva internal_taxes perceptions "
+        "iva_rni last_credit_b last_credit_a credit credit_iva "
+        "credit_internal_taxes credit_perceptions credit_iva_rni")
+
+def _parse_date(value):
+    return datetime.strptime(value, "%y%m%d").date()
+
+# reply fields of CMD_GET_DAILY_REPORT after the status words (manual 3.3.5)
+_daily_report_fields = (
+    _parse_date, int, int, int, Decimal, Decimal, Decimal, Decimal,
+    Decimal, int, int, Decimal, Decimal, Decimal, Decimal, Decimal,
+)
+
+def parse_daily_report(reply):
+    """Build a `DailyReport` from the reply of CMD_GET_DAILY_REPORT."""
+    return DailyReport(*[convert(value) for convert, value
+                         in zip(_daily_report_fields, reply[2:])])
+
+
 PrinterItem = namedtuple("PrinterItem",
         "description quantity price iva discount discount_desc negative")
 CustomerData = namedtuple("CustomerData",
         "name address id_number id_type iva_type")
 
 
+def prepare_args(model, cmd, args):
+    """Fields of `cmd` as the printer of `model` takes them."""
+    # text fields are transliterated and cut to what the model prints;
+    # the rest must be ASCII, the schema check reports anything else
+    args = list(args)
+    fit = encoder(model).fit
+    for i, size in validator(model).text_fields(cmd):
+        if i < len(args):
+            args[i] = fit(args[i], size)
+    for i, value in enumerate(args):
+        if isinstance(value, unicode):
+            args[i] = value.encode('ascii', 'replace')
+    return args
+
+
+def wrap_lines(lines, width, charset):
+    """Printable pieces of at most `width` characters (half for double
+    width lines) of each of `lines`, split at spaces where possible. Lines
+    are read one at a time, so `lines` can be a file or a generator."""
+    for line in lines:
+        double, text = charset.printable(line.rstrip("\r\n"))
+        size = width // 2 if double else width
+        pieces = [text] if len(text) <= size else textwrap.wrap(text, size)
+        for piece in pieces:
+            # the double width mark only counts at the start of a str
+            yield DOUBLE_WIDTH + piece.encode('utf-8') if double else piece
+
+
 class HasarPrinter(Printer):
+    # wait before the next non-fiscal line, as a fraction of the time the
+    # printer was busy (DC2/DC4) answering the last one
+    NON_FISCAL_PACING = 0.5
 
-    def __init__(self, driver):
+    def __init__(self, driver, model="615", capabilities=None):
         self.driver = driver
+        self.model = model
+        self.schema = validator(model)
+        self.charset = encoder(model)
+        self.capabilities = None
+        self.commands = None
+        if capabilities is not None:
+            self.apply(capabilities)
+        for cmd, seconds in _timeout_floors.items():
+            driver.set_timeout_floor(cmd, seconds)
         self._current = None
         self._customer = None
         self._cmd = []
         self._items = []
         self._payments = []
+        self.monitor = None
+        self.tracer = None
 
     def open_bill(self, bill_type):
         assert bill_type in ("A", "B")
@@ -144,9 +277,137 @@ class HasarPrinter(Printer):
         assert self._current is None
         return self.execute(CMD_DAILY_CLOSE, ["X"])
 
+    def daily_report(self, number):
+        """Fiscal memory record of Z `number`, or None if there is none."""
+        assert self._current is None
+        reply = self.execute(CMD_GET_DAILY_REPORT, [str(number), "Z"],
+                             skip_errors=True)
+        if int(reply[1], 16) & FISCAL_INVALID_DATA:
+            return None
+        check_status(reply)
+        return parse_daily_report(reply)
+
+    def daily_reports(self, first=1, last=None):
+        """Yield the `DailyReport` of each Z from `first` to `last`.
+
+        Records are requested one at a time and yielded as each reply
+        arrives, so a multi-year range never sits in memory. Without `last`
+        it stops at the first number the printer has no record for.
+        """
+        number = first
+        while last is None or number <= last:
+            report = self.daily_report(number)
+            if report is None:
+                return
+            yield report
+            number += 1
+
+    def daily_reports_by_date(self, start, end, first=1):
+        """Yield the `DailyReport` of each Z made between `start` and `end`.
+
+        The printer can only look a record up by number or by the exact
+        date of a Z, so the first Z on or after `start` is found with an
+        exponential search from `first` followed by a binary search on the
+        record dates: O(log n) requests before streaming starts.
+        """
+        if isinstance(start, datetime):
+            start = start.date()
+        if isinstance(end, datetime):
+            end = end.date()
+        seen = {}
+        def report(number):
+            if number not in seen:
+                seen[number] = self.daily_report(number)
+            return seen[number]
+
+        first_report = report(first)
+        if first_report is None:
+            return
+        if first_report.date >= start:
+            number = first
+        else:
+            # report(lo) is before start; report(hi) is missing or not before
+            lo, step = first, 1
+            while True:
+                hi = lo + step
+                r = report(hi)
+                if r is None or r.date >= start:
+                    break
+                lo, step = hi, step * 2
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                r = report(mid)
+                if r is not None and r.date < start:
+                    lo = mid
+                else:
+                    hi = mid
+            number = hi
+        while True:
+            r = seen.pop(number, None) or self.daily_report(number)
+            if r is None or r.date > end:
+                return
+            yield r
+            number += 1
+
+    def audit_by_number(self, first, last, detail=False):
+        """Print the fiscal memory audit report of Z `first` to `last`."""
+        assert self._current is None
+        return self.execute(CMD_DAILY_CLOSE_BY_NUMBER,
+                            [str(first), str(last), "D" if detail else "T"])
+
+    def audit_by_date(self, start, end, detail=False):
+        """Print the fiscal memory audit report between two dates."""
+        assert self._current is None
+        return self.execute(CMD_DAILY_CLOSE_BY_DATE,
+                            [start.strftime("%y%m%d"), end.strftime("%y%m%d"),
+                             "D" if detail else "T"])
+
+    def print_non_fiscal(self, lines):
+        """Print `lines` in a non-fiscal receipt, wrapped to the width of
+        the model, and return how many lines were printed.
+
+        Lines are wrapped and sent one by one, each after the reply to the
+        previous one, so memory does not grow with the report. When the
+        printer sends DC2/DC4 while it prints, the next line is held back
+        for part of that time and its buffer gets to drain. On an error
+        the receipt is closed, with what was printed so far.
+        """
+        assert self._current is None
+        width = self.schema.text_size('NON_FISCAL_TEXT')
+        self.execute(CMD_OPEN_NON_FISCAL_RECEIPT)
+        self._current = DOC_NON_FISCAL
+        count = 0
+        try:
+            for text in wrap_lines(lines, width, self.charset):
+                self.execute(CMD_PRINT_NON_FISCAL_TEXT, [text, "0"])
+                count += 1
+                stats = self.driver.last_exchange()
+                if stats is not None and stats.busy:
+                    time.sleep(stats.busy * self.NON_FISCAL_PACING)
+        except Exception:
+            error = sys.exc_info()
+            try:
+                self.execute(CMD_CLOSE_NON_FISCAL_RECEIPT)
+            except PrinterException as e:
+                log.warning("can't close the non-fiscal receipt: %s", e)
+            self._current = None
+            raise error[0], error[1], error[2]
+        self.execute(CMD_CLOSE_NON_FISCAL_RECEIPT)
+        self._current = None
+        return count
+
+    def reprint(self):
+        """Reprint the last issued document."""
+        assert self._current is None
+        return self.execute(CMD_REPRINT)
+
     def set_customer_data(self, data):
         assert isinstance(data, CustomerData)
-        self._customer = data
+        # a bad CUIT fails here, not when the printer rejects the bill
+        try:
+            self._customer = check_customer(data)
+        except CustomerError as e:
+            raise PrinterException("Datos del cliente inválidos: %s" % e)
 
     def add_item(self, item=None, **kwargs):
         if not isinstance(item, PrinterItem):
@@ -157,26 +418,107 @@ class HasarPrinter(Printer):
         for item in items:
             self.add_item(item)
 
+    def item_columns(self):
+        """Keep the items of the current document by column from now on (see
+        items.ItemColumns), for documents with thousands of lines. Returns
+        the store, which also takes whole columns with `extend()`."""
+        from items import ItemColumns
+        if not isinstance(self._items, ItemColumns):
+            columns = ItemColumns()
+            for item in self._items:
+                columns.append(item)
+            self._items = columns
+        return self._items
+
+    def start_status_monitor(self, idle_time=2.0, ttl=5.0):
+        """Start tracking the printer status in background.
+
+        Once started, `status()` can be called from any thread without
+        generating serial traffic.
+        """
+        if self.monitor is None:
+            self.monitor = StatusMonitor(self.driver, CMD_STATUS_REQUEST,
+                    idle_time=idle_time, ttl=ttl)
+            self.monitor.start()
+        return self.monitor
+
+    def stop_status_monitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+    def status(self, max_age=None):
+        """Last known `PrinterState` or None when unknown or stale."""
+        if self.monitor is None:
+            return None
+        return self.monitor.status(max_age)
+
+    def apply(self, capabilities):
+        """Use the text limits and command set of `capabilities` (see
+        capabilities.discover())."""
+        self.capabilities = capabilities
+        self.model = capabilities.limits
+        self.schema = validator(capabilities.limits)
+        self.charset = encoder(capabilities.limits)
+        self.commands = frozenset(capabilities.commands)
+
+    def trace(self, exporter):
+        """Send a span per document to `exporter` (see spans.py)."""
+        from spans import DocumentTracer
+        self.tracer = DocumentTracer(exporter)
+        return self.tracer
+
     def execute(self, cmd, args=(), skip_errors=False):
+        args = self._prepare(cmd, args)
         cmd_str = "SEND|0x%x|%s|%s" %\
                 (cmd, "T" if skip_errors else "F", str(args))
         log.debug("execute: %s" % cmd_str)
+        self._check(cmd, args)
+        tracer = self.tracer
+        start = time.time()
         try:
-            reply = self.driver.send_command(cmd, args)
+            reply = self.driver.send_command(cmd, args, skip_errors)
             log.debug("reply: %s" % reply)
+            if tracer is not None:
+                tracer.command(cmd, args, start, self.driver.last_exchange(),
+                               reply)
             return reply
         except PrinterException as e:
             log.debug("ERROR: %s" % e.args[0])
-            raise PrinterException("Error de la impresora fiscal: %s.\n"
+            if tracer is not None:
+                tracer.command(cmd, args, start, self.driver.last_exchange(),
+                               error=e)
+            # same class, so callers can tell a link failure from a rejection
+            raise e.__class__("Error de la impresora fiscal: %s.\n"
                 "Commando enviado: %s" % (e.args[0], cmd_str))
 
     def command(self, cmd, args):
+        args = self._prepare(cmd, args)
+        self._check(cmd, args)
         self._cmd.append((cmd, args))
 
     def finish(self):
         """Print out document processing all commands."""
 
+    def _prepare(self, cmd, args):
+        return prepare_args(self.model, cmd, args)
+
+    def _check(self, cmd, args):
+        # bad fields fail here instead of after a round trip to the printer;
+        # only commands the schema knows are gated, internal ones such as
+        # CMD_CLOSE and those without a schema pass
+        if self.commands is not None and isinstance(cmd, int) and \
+                cmd in COMMANDS and cmd not in self.commands:
+            raise PrinterException("Comando %r no soportado por el modelo %s"
+                                   % (cmd, self.capabilities.model))
+        try:
+            self.schema.check(cmd, args)
+        except FieldError as e:
+            raise PrinterException("Comando inválido para el modelo %s: %s"
+                                   % (self.model, e))
+
     def close(self):
+        self.stop_status_monitor()
         self.driver.close()
         self.driver = None
 
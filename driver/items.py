@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""Item lines of large documents, stored by column.
+
+`ItemColumns` keeps the items of a document in flat arrays of integers
+(amounts in cents, quantities in millionths, IVA rates in hundredths of a
+point) and the descriptions in a pool where each distinct text is stored
+once. A thousand-line invoice is then a handful of arrays instead of a
+thousand `PrinterItem` tuples, descriptions are checked once per distinct
+text, and the totals are computed over whole columns (on numpy arrays
+when numpy is installed).
+
+Quantities are kept with 6 decimals: the printer accepts 10 but prints 3,
+and 6 keeps quantity * price inside 64 bits. Every stored value fits in 32
+bits, so the columns are arrays of C long on any platform; the products
+are computed on Python integers, or on int64 copies of the columns.
+"""
+
+from array import array
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from hasar import PrinterItem, CMD_PRINT_LINE_ITEM, CMD_LAST_ITEM_DISCOUNT
+from schema import validator
+from charset import encoder
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CENTS = 100
+QUANTITY = 10**6
+RATE = 100 * 100
+
+ItemTotals = namedtuple("ItemTotals", "count total by_rate")
+
+
+def _scale(value, scale):
+    if isinstance(value, (int, long)):
+        return value * scale
+    if isinstance(value, float):
+        # round() takes halves away from zero
+        return int(round(value * scale))
+    if isinstance(value, basestring):
+        # "123.45" without going through Decimal
+        whole, _, frac = value.strip().partition('.')
+        digits = len(str(scale)) - 1
+        if whole.lstrip('-').isdigit() and frac.isdigit() and len(frac) <= digits:
+            return int(whole + frac) * (scale // 10**len(frac))
+        value = Decimal(value)
+    return int((value * scale).to_integral_value(ROUND_HALF_UP))
+
+def _column(values, scale, count):
+    """array of `values` (a sequence, or a numpy array) times `scale`."""
+    if values is None:
+        return array('l', [0]) * count
+    if numpy is not None and hasattr(values, '__array__'):
+        # numpy arrays and pandas Series
+        values = numpy.asarray(values)
+        kind = values.dtype.kind
+        if kind == 'f':
+            scaled = numpy.sign(values) * numpy.floor(numpy.abs(values) * scale + 0.5)
+            return array('l', scaled.astype(numpy.int64).tolist())
+        if kind in 'iub':
+            return array('l', (values.astype(numpy.int64) * scale).tolist())
+        # Decimal, str and other objects, one by one
+        values = values.tolist()
+    return array('l', [_scale(v, scale) for v in values])
+
+def _int64(column):
+    return numpy.array(column, dtype=numpy.int64)
+
+def _div_round(n, d):
+    # n / d to the nearest integer, halves away from zero (as money.py)
+    q, r = divmod(abs(n), d)
+    if 2 * r >= d:
+        q += 1
+    return q if n >= 0 else -q
+
+def _decimal(cents):
+    return Decimal(cents) / CENTS
+
+
+class ItemColumns(object):
+    """The items of a document, column by column.
+
+    `append()` takes a `PrinterItem` like HasarPrinter.add_item(); `extend()`
+    takes whole columns, as lists, tuples or numpy arrays (e.g. the columns
+    of a DataFrame). Amounts and rates may be given as int, float, Decimal
+    or str.
+    """
+
+    def __init__(self):
+        self.quantity = array('l')
+        self.price = array('l')
+        self.iva = array('l')
+        self.discount = array('l')
+        self.negative = array('b')
+        self.description = array('l')
+        self.discount_desc = array('l')     # -1 without a discount text
+        self._pool = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.quantity)
+
+    def _intern(self, text):
+        i = self._index.get(text)
+        if i is None:
+            i = self._index[text] = len(self._pool)
+            self._pool.append(text)
+        return i
+
+    def append(self, item):
+        self.extend([item.description], [item.quantity], [item.price],
+                    [item.iva], [item.discount or 0], [item.discount_desc],
+                    [bool(item.negative)])
+
+    def extend(self, description, quantity, price, iva, discount=None,
+               discount_desc=None, negative=None):
+        """Append the items given by column; all columns have one value per
+        item, the optional ones may be None."""
+        count = len(description)
+        columns = [_column(quantity, QUANTITY, count),
+                   _column(price, CENTS, count),
+                   _column(iva, CENTS, count),
+                   _column(discount, CENTS, count)]
+        if negative is None:
+            flags = array('b', [0]) * count
+        else:
+            flags = array('b', [1 if n else 0 for n in negative])
+        texts = array('l', [self._intern(d) for d in description])
+        if discount_desc is None:
+            discount_texts = array('l', [-1]) * count
+        else:
+            discount_texts = array('l', [-1 if d is None else self._intern(d)
+                                         for d in discount_desc])
+        for column in columns + [flags, texts, discount_texts]:
+            if len(column) != count:
+                raise ValueError("columns of different length (%d and %d)"
+                                 % (count, len(column)))
+        self.quantity.extend(columns[0])
+        self.price.extend(columns[1])
+        self.iva.extend(columns[2])
+        self.discount.extend(columns[3])
+        self.negative.extend(flags)
+        self.description.extend(texts)
+        self.discount_desc.extend(discount_texts)
+
+    def __getitem__(self, i):
+        desc = self.discount_desc[i]
+        return PrinterItem(self._pool[self.description[i]],
+                           Decimal(self.quantity[i]) / QUANTITY,
+                           _decimal(self.price[i]), _decimal(self.iva[i]),
+                           _decimal(self.discount[i]),
+                           None if desc < 0 else self._pool[desc],
+                           bool(self.negative[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def amounts(self):
+        """Final amount of each item in cents: quantity * price, less the
+        discount, negative for returns."""
+        if numpy is not None:
+            n = _int64(self.quantity) * _int64(self.price)
+            gross = numpy.sign(n) * ((numpy.abs(n) + QUANTITY // 2) // QUANTITY)
+            gross -= _int64(self.discount)
+            sign = 1 - 2 * _int64(self.negative)
+            return gross * sign
+        return [(_div_round(q * p, QUANTITY) - d) * (-1 if neg else 1)
+                for q, p, d, neg in zip(self.quantity, self.price,
+                                        self.discount, self.negative)]
+
+    def totals(self):
+        """Preview of the document totals: `ItemTotals` with the total and,
+        for each IVA rate, (gross, net, iva) as Decimal."""
+        amounts = self.amounts()
+        by_rate = {}
+        if numpy is not None:
+            rates = _int64(self.iva)
+            for rate in numpy.unique(rates):
+                by_rate[int(rate)] = int(amounts[rates == rate].sum())
+            total = int(amounts.sum())
+        else:
+            for rate, amount in zip(self.iva, amounts):
+                by_rate[rate] = by_rate.get(rate, 0) + amount
+            total = sum(amounts)
+        result = {}
+        for rate, gross in by_rate.items():
+            # rates are in hundredths of a point, RATE is 100.00 %
+            net = _div_round(gross * RATE, RATE + rate * 100 // CENTS)
+            result[_decimal(rate)] = (_decimal(gross), _decimal(net),
+                                      _decimal(gross - net))
+        return ItemTotals(len(self), _decimal(total), result)
+
+    def errors(self, model="615"):
+        """(item index, message) of the items the printer would reject.
+        Descriptions are checked once per distinct text."""
+        schema = validator(model)
+        fit = encoder(model).fit
+        bad_text = {}
+        for i, text in enumerate(self._pool):
+            try:
+                problems = schema.errors(CMD_PRINT_LINE_ITEM,
+                        [fit(text, 'LINE_ITEM'), "1", "1", "21", "M", "0",
+                         "0", "T"])
+            except UnicodeError as e:
+                problems = [str(e)]
+            if problems:
+                bad_text[i] = "; ".join(problems)
+        errors = []
+        for i in xrange(len(self)):
+            if self.description[i] in bad_text:
+                errors.append((i, bad_text[self.description[i]]))
+            if not 0 < self.quantity[i] < 1000 * QUANTITY:
+                errors.append((i, "quantity out of range"))
+            if not 0 <= self.price[i] < 10**6 * CENTS:
+                errors.append((i, "price out of range"))
+            if not 0 <= self.iva[i] < 100 * CENTS:
+                errors.append((i, "iva rate out of range"))
+        return errors
+
+    def commands(self):
+        """(command, fields) of each item, generated as they are sent."""
+        pool = self._pool
+        for i in xrange(len(self)):
+            q, frac = divmod(self.quantity[i], QUANTITY)
+            price, cents = divmod(self.price[i], CENTS)
+            rate, hundredths = divmod(self.iva[i], CENTS)
+            sign = 'm' if self.negative[i] else 'M'
+            yield CMD_PRINT_LINE_ITEM, [pool[self.description[i]],
+                    ("%d.%06d" % (q, frac)).rstrip('0').rstrip('.'),
+                    "%d.%02d" % (price, cents), "%d.%02d" % (rate, hundredths),
+                    sign, "0", "0", "T"]
+            if self.discount[i]:
+                desc = self.discount_desc[i]
+                amount, cents = divmod(self.discount[i], CENTS)
+                yield CMD_LAST_ITEM_DISCOUNT, [
+                        pool[desc] if desc >= 0 else "Descuento",
+                        "%d.%02d" % (amount, cents), "m", "0", "T"]
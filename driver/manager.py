@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""Printers of many devices, sharded over worker processes.
+
+Framing, checksums and status parsing run in Python, so one process
+driving hundreds of ports is bound to one core (and to its file
+descriptor limit). `Manager` spreads the devices over `processes` worker
+processes: a device always goes to the same shard (CRC32 of its name), and
+each shard runs its own `Spool` with its own log, so it owns the ports of
+its devices and their queued documents.
+
+The API is small: `submit()` a document and get a `spool.Job` back (its
+`result()` is the document number), or ask `status()` of a device.
+
+A worker that dies only takes its shard down. The manager starts it
+again, its spool replays the unfinished jobs (printing each one once, see
+spool.py) and their results arrive as usual. Documents that never reached
+the worker are sent again; a job whose result got lost with the process
+fails with an error saying so, since it may have printed.
+"""
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from Queue import Empty
+from collections import namedtuple
+
+from driver import PrinterException, log
+from spool import Spool, Job, read_log, DONE, FAILED
+
+DeviceStatus = namedtuple("DeviceStatus", "device shard pending status")
+
+# finished jobs each shard keeps in its log, to answer for them after a
+# restart even if their result was lost with the process
+KEEP_FINISHED = 10000
+
+# times a job is sent again to a shard that died before taking it
+MAX_RESENDS = 2
+
+
+def _serve(shard, generation, path, printer_factory, model, fsync,
+           requests, results):
+    """Main loop of a worker process."""
+    # results of the jobs this shard finished before it was restarted
+    finished = {}
+    for record in read_log(path):
+        if record['op'] in (DONE, FAILED) and 'tag' in record:
+            finished[record['tag']] = (record['op'], record.get('number'),
+                                       record.get('error'))
+
+    def report(job):
+        results.put(('finished', shard, job.tag, job.state, job.number,
+                     job.error))
+
+    spool = Spool(path, printer_factory, model, fsync=fsync,
+                  on_finish=report, keep_finished=KEEP_FINISHED)
+    replayed = [job.tag for job in spool.start()]
+    results.put(('started', shard, generation, replayed, finished))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        # a bad request fails alone: it must not take the shard down
+        kind, ticket = request[:2]
+        try:
+            if kind == 'submit':
+                _, tag, device, commands = request
+                spool.submit(device, commands, tag)
+                results.put(('accepted', shard, tag))
+            elif kind == 'status':
+                _, ticket, device = request
+                pending = len([job for job in spool.pending()
+                               if job.device == device])
+                results.put(('status', shard, ticket,
+                             DeviceStatus(device, shard, pending,
+                                          spool.last_status.get(device)),
+                             None))
+        except Exception as e:
+            if isinstance(e, PrinterException):
+                error = str(e)
+            else:
+                log.exception("shard %d: %s request failed", shard, kind)
+                error = "%s: %s" % (e.__class__.__name__, e)
+            if kind == 'submit':
+                results.put(('finished', shard, ticket, FAILED, None, error))
+            else:
+                results.put(('status', shard, ticket, None, error))
+    spool.stop()
+
+
+class _Shard(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.generation = -1
+        self.process = None
+        self.requests = None
+        # each process gets its own result queue: one killed while writing
+        # to it can only break its own
+        self.results = None
+        self.collector = None
+
+
+class Manager(object):
+    """Documents for many devices, printed by a pool of processes.
+
+    Each shard keeps its log at `spool_dir`/shard-N.log; the number of
+    processes must not change between runs, or the devices (and their
+    queued jobs) would move to another shard. `printer_factory` and the
+    other arguments are those of `Spool`; the factory runs in the worker
+    processes.
+    """
+
+    def __init__(self, spool_dir, processes=None, printer_factory=None,
+                 model="615", fsync=True, check_interval=0.5):
+        self.spool_dir = spool_dir
+        self.processes = processes or multiprocessing.cpu_count()
+        self.printer_factory = printer_factory
+        self.model = model
+        self.fsync = fsync
+        self.check_interval = check_interval
+        self.restarts = 0
+        self._shards = [_Shard(i) for i in range(self.processes)]
+        self._jobs = {}         # unfinished jobs by tag
+        self._sent = {}         # tag: (shard, generation) it was sent to
+        self._accepted = set()
+        self._resends = {}
+        self._statuses = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watchdog = None
+        # tags of this run, so results of jobs of a previous run are told apart
+        self._run = "%x.%x" % (int(time.time()), os.getpid())
+        self._ids = itertools.count(1)
+
+    def shard(self, device):
+        """Index of the shard that prints on `device`."""
+        return (zlib.crc32(str(device)) & 0xffffffff) % self.processes
+
+    def start(self):
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        self._stop.clear()
+        for shard in self._shards:
+            self._start_shard(shard)
+        self._watchdog = threading.Thread(target=self._watch,
+                                          name="manager-watchdog")
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def stop(self, timeout=30):
+        """Stop the workers after their current job; queued jobs stay in
+        their logs for the next start."""
+        self._stop.set()
+        for shard in self._shards:
+            shard.requests.put(None)
+        for shard in self._shards:
+            shard.process.join(timeout)
+            if shard.process.is_alive():
+                log.warning("shard %d did not stop, terminating it",
+                            shard.index)
+                shard.process.terminate()
+        self._watchdog.join()
+        for shard in self._shards:
+            shard.collector.join(timeout)
+
+    def submit(self, device, commands):
+        """Queue `commands` (a list of (command, fields)) for `device` and
+        return its `Job`."""
+        shard = self._shards[self.shard(device)]
+        with self._lock:
+            n = next(self._ids)
+            tag = "%s.%d" % (self._run, n)
+            job = Job(n, device, list(commands), tag)
+            self._jobs[tag] = job
+            self._send(shard, job)
+        return job
+
+    def pending(self):
+        """Unfinished jobs, oldest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.id)
+
+    def status(self, device, timeout=5):
+        """`DeviceStatus` of `device`: jobs queued for it and the last
+        status read from the printer (None before its first job)."""
+        shard = self._shards[self.shard(device)]
+        ticket = next(self._ids)
+        event = threading.Event()
+        self._statuses[ticket] = [event, None, None]
+        shard.requests.put(('status', ticket, device))
+        try:
+            if not event.wait(timeout):
+                raise PrinterException("shard %d did not answer in %ss"
+                                       % (shard.index, timeout))
+            status, error = self._statuses[ticket][1:]
+            if error is not None:
+                raise PrinterException(error)
+            return status
+        finally:
+            del self._statuses[ticket]
+
+    def _send(self, shard, job):
+        self._sent[job.tag] = (shard.index, shard.generation)
+        shard.requests.put(('submit', job.tag, job.device, job.commands))
+
+    def _start_shard(self, shard):
+        shard.generation += 1
+        shard.requests = multiprocessing.Queue()
+        shard.results = multiprocessing.Queue()
+        path = os.path.join(self.spool_dir, "shard-%d.log" % shard.index)
+        shard.process = multiprocessing.Process(target=_serve,
+                args=(shard.index, shard.generation, path,
+                      self.printer_factory, self.model, self.fsync,
+                      shard.requests, shard.results),
+                name="printers-%d" % shard.index)
+        shard.process.daemon = True
+        shard.process.start()
+        shard.collector = threading.Thread(target=self._collect,
+                args=(shard, shard.process, shard.results),
+                name="manager-results-%d" % shard.index)
+        shard.collector.daemon = True
+        shard.collector.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            for shard in self._shards:
+                if shard.process.is_alive() or self._stop.is_set():
+                    continue
+                log.error("shard %d died (exit code %s), restarting it",
+                          shard.index, shard.process.exitcode)
+                with self._lock:
+                    self.restarts += 1
+                    self._start_shard(shard)
+
+    def _collect(self, shard, process, results):
+        """Handle the messages of one process of `shard` until it is gone
+        and its queue is empty."""
+        while True:
+            try:
+                message = results.get(timeout=self.check_interval)
+            except Empty:
+                if process is not shard.process or \
+                        self._stop.is_set() and not process.is_alive():
+                    break
+                continue
+            kind = message[0]
+            if kind == 'status':
+                waiter = self._statuses.get(message[2])
+                if waiter is not None:
+                    waiter[1:] = message[3:]
+                    waiter[0].set()
+                continue
+            with self._lock:
+                if kind == 'finished':
+                    _, _, tag, state, number, error = message
+                    self._finish(tag, state, number, error)
+                elif kind == 'accepted':
+                    self._accepted.add(message[2])
+                elif kind == 'started':
+                    self._reconcile(*message[1:])
+
+    def _finish(self, tag, state, number=None, error=None):
+        job = self._jobs.pop(tag, None)
+        self._sent.pop(tag, None)
+        self._accepted.discard(tag)
+        self._resends.pop(tag, None)
+        if job is None:
+            # of a previous run, or already settled after a restart
+            log.info("result of job %s no longer waited for (%s)", tag, state)
+            return
+        job._finish(state, number, error)
+
+    def _reconcile(self, index, generation, replayed, finished):
+        """Settle the jobs sent to an earlier process of a restarted shard."""
+        shard = self._shards[index]
+        if generation != shard.generation:
+            return
+        replayed = set(replayed)
+        for tag, (sent_to, sent_in) in self._sent.items():
+            if sent_to != index or sent_in >= generation:
+                continue
+            if tag in finished:
+                self._finish(tag, *finished[tag])
+            elif tag in replayed:
+                self._sent[tag] = (index, generation)
+            elif tag in self._accepted:
+                self._finish(tag, FAILED, error="shard %d died with the job "
+                             "in progress; it may have printed" % index)
+            else:
+                resends = self._resends[tag] = self._resends.get(tag, 0) + 1
+                if resends > MAX_RESENDS:
+                    self._finish(tag, FAILED, error="shard %d died %d times "
+                                 "before taking the job" % (index, resends))
+                else:
+                    self._send(shard, self._jobs[tag])
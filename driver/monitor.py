@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import namedtuple
+
+from driver import PrinterException, log
+
+PrinterState = namedtuple("PrinterState",
+        "printer_status fiscal_status timestamp")
+
+
+class StatusMonitor(object):
+    """Keep the last known status of a printer without adding traffic.
+
+    Status words are picked from every reply that goes through the driver.
+    Only when the link has been quiet for `idle_time` seconds and the cached
+    status is older than `ttl` a status request is sent, and only if the
+    port lock can be taken without waiting, so documents in progress are
+    never delayed by the monitor.
+
+    Reading `state` or calling `status()` never touches the port.
+    """
+
+    def __init__(self, driver, status_command, idle_time=2.0, ttl=5.0):
+        self.driver = driver
+        self.status_command = status_command
+        self.idle_time = idle_time
+        self.ttl = ttl
+        self.state = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.driver.add_reply_listener(self._on_reply)
+        self._thread = threading.Thread(target=self._run,
+                name="StatusMonitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self.driver.remove_reply_listener(self._on_reply)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def status(self, max_age=None):
+        """Return the cached `PrinterState`, or None if it is stale."""
+        state = self.state
+        if state is None:
+            return None
+        if max_age is None:
+            max_age = self.ttl
+        if time.time() - state.timestamp > max_age:
+            return None
+        return state
+
+    def _on_reply(self, command, fields):
+        if len(fields) >= 2:
+            self.state = PrinterState(fields[0], fields[1], time.time())
+
+    def _poll(self):
+        now = time.time()
+        if now - self.driver.last_activity < self.idle_time:
+            return
+        state = self.state
+        if state is not None and now - state.timestamp < self.ttl:
+            return
+        lock = self.driver.lock
+        if not lock.acquire(False):
+            return
+        try:
+            if time.time() - self.driver.last_activity < self.idle_time:
+                return
+            self.driver.send_command(self.status_command, [],
+                    skip_errors=True)
+        except PrinterException as e:
+            log.debug("status monitor: %s", e)
+        finally:
+            lock.release()
+
+    def _run(self):
+        interval = min(self.idle_time, self.ttl) / 2.0
+        while not self._stop.wait(interval):
+            try:
+                self._poll()
+            except Exception as e:
+                # the port may be gone (closed driver); keep trying
+                log.debug("status monitor: %s", e)
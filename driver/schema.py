@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""Declarative command schema of the Hasar fiscal printers.
+
+`COMMANDS` lists the fields of each command (see the Hasar 615F manual,
+chapter 3) and `TEXT_SIZES` the longest text each model accepts in a
+field. `validator(model)` compiles both, once per model, into a table of
+checks that the host runs before sending a command and the emulator runs
+on every command it receives.
+
+This module only depends on the standard library so that it can be shared
+by the host driver and the emulator.
+"""
+
+import re
+
+TEXT_SIZES = {
+    "615": {
+        'NON_FISCAL_TEXT': 40,
+        'CUSTOMER_NAME': 30,
+        'CUSTOMER_ADDRESS': 40,
+        'PAYMENT_DESCRIPTION': 30,
+        'FISCAL_TEXT': 20,
+        'LINE_ITEM': 20,
+        'LAST_ITEM_DISCOUNT': 20,
+        'GENERAL_DISCOUNT': 20,
+        'EMBARK_ITEM': 108,
+        'RECEIPT_TEXT': 106,
+    },
+    "320": {
+        'NON_FISCAL_TEXT': 120,
+        'CUSTOMER_NAME': 50,
+        'CUSTOMER_ADDRESS': 50,
+        'PAYMENT_DESCRIPTION': 50,
+        'FISCAL_TEXT': 50,
+        'LINE_ITEM': 50,
+        'LAST_ITEM_DISCOUNT': 50,
+        'GENERAL_DISCOUNT': 50,
+        'EMBARK_ITEM': 108,
+        'RECEIPT_TEXT': 106,
+    }
+}
+
+
+class FieldError(ValueError):
+    """A command does not match its schema."""
+
+    def __init__(self, command, message):
+        ValueError.__init__(self, "0x%02x %s: %s" % (command,
+                            COMMANDS[command][0], message))
+        self.command = command
+
+
+class Field(object):
+    """One field of a command. Subclasses give the pattern it must match."""
+
+    pattern = None
+
+    def __init__(self, name, optional=False):
+        self.name = name
+        self.optional = optional
+
+    def compile(self, sizes):
+        """Return a function that takes a value and returns an error or None."""
+        match = re.compile(self.regex(sizes) + r"\Z").match
+        name, pattern = self.name, self.regex(sizes)
+        def check(value):
+            if match(value) is None:
+                return "%s: %r does not match %s" % (name, value, pattern)
+        return check
+
+    def regex(self, sizes):
+        return self.pattern
+
+
+# characters 32-175, optionally after the double width mark (244)
+_text = re.compile(r"\xf4?[\x20-\xaf]*\Z").match
+
+class Text(Field):
+    """Printable text of up to `size` characters; `size` may name an entry
+    of TEXT_SIZES, so the limit depends on the model. Double width text
+    (starting with character 244) gets half of it."""
+
+    def __init__(self, name, size, optional=False):
+        Field.__init__(self, name, optional)
+        self.size = size
+
+    def compile(self, sizes):
+        size = sizes.get(self.size, self.size)
+        name = self.name
+        def check(value):
+            limit = size
+            if value[:1] == '\xf4':
+                limit = 1 + size // 2
+            if len(value) > limit:
+                return "%s: %d characters, at most %d" % (name, len(value), limit)
+            if _text(value) is None:
+                return "%s: %r has characters out of the printable range" % (name, value)
+        return check
+
+
+class Choice(Field):
+    """One of the characters in `values`."""
+
+    def __init__(self, name, values, optional=False):
+        Field.__init__(self, name, optional)
+        self.values = values
+
+    def regex(self, sizes):
+        return "[%s]" % re.escape(self.values)
+
+
+class Char(Field):
+    """Any single character (flags where only one value is meaningful)."""
+    pattern = r"[^\x1c\x03]"
+
+
+class Integer(Field):
+
+    def __init__(self, name, digits, signed=False, optional=False):
+        Field.__init__(self, name, optional)
+        self.digits = digits
+        self.signed = signed
+
+    def regex(self, sizes):
+        return "%s\\d{1,%d}" % ("[-+]?" if self.signed else "", self.digits)
+
+
+class Number(Field):
+    """A number with up to `digits` integer and `decimals` decimal digits."""
+
+    def __init__(self, name, digits, decimals, signed=True, optional=False):
+        Field.__init__(self, name, optional)
+        self.digits = digits
+        self.decimals = decimals
+        self.signed = signed
+
+    def regex(self, sizes):
+        return "%s(?=\\.?\\d)\\d{0,%d}(\\.\\d{0,%d})?" % (
+                "[-+]?" if self.signed else "", self.digits, self.decimals)
+
+
+class Rate(Field):
+    """IVA rate, nn.nn or **.** (the rate of the items already sold)."""
+    pattern = r"\d{1,2}(\.\d{1,2})?|\*\*\.\*\*"
+
+
+class Date(Field):
+    pattern = r"\d\d(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])"
+
+
+class Time(Field):
+    pattern = r"([01]\d|2[0-3])[0-5]\d[0-5]\d"
+
+
+def _display(optional=False):
+    # only the 615 uses it, the other models take any of the three values
+    return Choice('display', '012', optional)
+
+# command: (name, fields)
+COMMANDS = {
+    0x2a: ('StatusRequest', ()),
+    0x39: ('DailyClose', (Choice('close type', 'ZX'),)),
+    0x3a: ('DailyCloseByDate', (Date('start'), Date('end'), Char('detail'))),
+    0x3b: ('DailyCloseByNumber', (Integer('first', 4), Integer('last', 4),
+                                  Char('detail'))),
+    0x3c: ('GetDailyReport', (Integer('number or date', 6), Choice('kind', 'ZF'))),
+    0x40: ('OpenFiscalReceipt', (Choice('document type', 'TABCDE'),
+                                 Choice('mode', 'T'))),
+    0x41: ('PrintFiscalText', (Text('text', 'FISCAL_TEXT'), _display())),
+    0x42: ('PrintLineItem', (Text('description', 'LINE_ITEM'),
+                             Number('quantity', 3, 10),
+                             Number('price', 6, 2),
+                             Rate('iva'),
+                             Choice('sign', 'Mm'),
+                             Number('internal taxes', 1, 8),
+                             _display(),
+                             Char('price qualifier'))),
+    0x43: ('Subtotal', (Char('print'), Text('reserved', 25), _display())),
+    0x44: ('TotalTender', (Text('description', 'PAYMENT_DESCRIPTION'),
+                           Number('amount', 9, 2),
+                           Choice('operation', 'CTD'),
+                           _display(),
+                           Text('card', 20, optional=True))),
+    0x45: ('CloseFiscalReceipt', ()),
+    0x48: ('OpenNonFiscalReceipt', ()),
+    0x49: ('PrintNonFiscalText', (Text('text', 'NON_FISCAL_TEXT'), _display())),
+    0x4a: ('CloseNonFiscalReceipt', ()),
+    0x54: ('GeneralDiscount', (Text('description', 'GENERAL_DISCOUNT'),
+                               Number('amount', 6, 2),
+                               Choice('sign', 'Mm'),
+                               _display(),
+                               Char('price qualifier'))),
+    0x55: ('LastItemDiscount', (Text('description', 'LAST_ITEM_DISCOUNT'),
+                                Number('amount', 6, 2),
+                                Choice('sign', 'Mm'),
+                                _display(),
+                                Char('price qualifier'))),
+    0x58: ('SetDateTime', (Date('date'), Time('time'))),
+    0x59: ('GetDateTime', ()),
+    0x5d: ('SetHeaderTrailer', (Integer('line', 2, signed=True), Text('text', 40))),
+    0x62: ('SetCustomerData', (Text('name', 'CUSTOMER_NAME'),
+                               Text('document number', 11),
+                               Choice('iva type', 'INEACBMSVWT'),
+                               Choice('document type', 'CL01234 '),
+                               Text('address', 'CUSTOMER_ADDRESS', optional=True))),
+    0x73: ('GetInitData', ()),
+    0x7b: ('OpenDrawer', ()),
+    0x80: ('OpenDNFH', (Char('document type'), Char('mode'),
+                        Text('identification', 20, optional=True))),
+    0x81: ('CloseDNFH', (Integer('copies', 2, optional=True),)),
+    0x82: ('PrintEmbarkItem', (Text('text', 'EMBARK_ITEM'),
+                               Number('quantity', 3, 10), _display())),
+    0x85: ('PrintDNFHInfo', (Integer('field', 2), Text('text', 'RECEIPT_TEXT'),
+                             _display(optional=True))),
+    0x93: ('SetEmbarkNumber', (Choice('line', '12'), Text('text', 20))),
+    0x97: ('PrintReceiptText', (Text('text', 'RECEIPT_TEXT'),)),
+    0x98: ('Cancel', ()),
+    0x99: ('Reprint', (Char('document type', optional=True),
+                       Integer('number', 8, optional=True))),
+    0x1b7f: ('GetPrinterVersion', ()),
+}
+
+
+class Validator(object):
+    """The schema of one model, compiled into a check per command."""
+
+    def __init__(self, model):
+        self.model = model
+        sizes = TEXT_SIZES[model]
+        self._commands = {}
+        self._text_fields = {}
+        for command, (name, fields) in COMMANDS.items():
+            required = len([f for f in fields if not f.optional])
+            checks = tuple(f.compile(sizes) for f in fields)
+            self._commands[command] = (required, checks)
+            self._text_fields[command] = tuple((i, sizes.get(f.size, f.size))
+                    for i, f in enumerate(fields) if isinstance(f, Text))
+
+    def __contains__(self, command):
+        return command in self._commands
+
+    def errors(self, command, fields):
+        """List the problems of `fields` for `command` (unknown commands pass)."""
+        spec = self._commands.get(command)
+        if spec is None:
+            return []
+        required, checks = spec
+        if not required <= len(fields) <= len(checks):
+            if required == len(checks):
+                expected = "%d" % required
+            else:
+                expected = "%d to %d" % (required, len(checks))
+            return ["%d fields, expected %s" % (len(fields), expected)]
+        errors = []
+        for check, value in zip(checks, fields):
+            error = check(value)
+            if error is not None:
+                errors.append(error)
+        return errors
+
+    def check(self, command, fields):
+        """Raise `FieldError` if `fields` do not match the schema of `command`."""
+        errors = self.errors(command, fields)
+        if errors:
+            raise FieldError(command, "; ".join(errors))
+
+    def text_fields(self, command):
+        """(index, size) of the text fields of `command`."""
+        return self._text_fields.get(command, ())
+
+    def text_size(self, field):
+        return TEXT_SIZES[self.model][field]
+
+
+_validators = {}
+
+def validator(model):
+    """Compiled `Validator` of `model` ("615" or "320"), built on first use."""
+    v = _validators.get(model)
+    if v is None:
+        v = _validators[model] = Validator(model)
+    return v
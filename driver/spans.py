@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Timing spans of whole documents.
+
+A `DocumentTracer` follows the commands a `HasarPrinter` sends and groups
+them by document: a span opens with the command that opens a document
+(fiscal receipt, credit note, DNFH, non-fiscal receipt) and ends with the
+one that closes or cancels it, with a child span per command. Each span
+adds up the traffic of its commands (see `driver.ExchangeStats`).
+
+Finished spans go to an exporter, which only has to implement
+`export(span)`: `JsonlExporter` appends them to a file and `RingExporter`
+keeps the last ones in memory. Nothing leaves the machine.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+from hasar import CMD_OPEN_FISCAL_RECEIPT, CMD_OPEN_DNFH, \
+                  CMD_OPEN_NON_FISCAL_RECEIPT, CMD_CLOSE_FISCAL_RECEIPT, \
+                  CMD_CLOSE_DNFH, CMD_CLOSE_NON_FISCAL_RECEIPT, \
+                  CMD_ADD_PAYMENT, CMD_PRINT_LINE_ITEM, CMD_PRINT_EMBARK_ITEM, \
+                  CMD_PRINT_ACCOUNT_ITEM, CMD_PRINT_QUOTATION_ITEM, \
+                  CMD_CANCEL_ANY_DOCUMENT
+from schema import COMMANDS
+
+_opening = (CMD_OPEN_FISCAL_RECEIPT, CMD_OPEN_DNFH, CMD_OPEN_NON_FISCAL_RECEIPT)
+_closing = (CMD_CLOSE_FISCAL_RECEIPT, CMD_CLOSE_DNFH,
+            CMD_CLOSE_NON_FISCAL_RECEIPT)
+_items = (CMD_PRINT_LINE_ITEM, CMD_PRINT_EMBARK_ITEM, CMD_PRINT_ACCOUNT_ITEM,
+          CMD_PRINT_QUOTATION_ITEM)
+
+
+class Span(object):
+    """A timed operation with the traffic it generated."""
+
+    def __init__(self, name, start=None, **attributes):
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes
+        self.children = []
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.busy = 0.0
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def add(self, stats):
+        """Add the traffic of an `ExchangeStats`."""
+        self.bytes_out += stats.bytes_out
+        self.bytes_in += stats.bytes_in
+        self.retries += stats.retries
+        self.busy += stats.busy
+
+    def as_dict(self):
+        d = dict(self.attributes)
+        d.update(name=self.name, start=self.start, duration=self.duration,
+                 bytes_out=self.bytes_out, bytes_in=self.bytes_in,
+                 retries=self.retries, busy=round(self.busy, 6))
+        if self.children:
+            d['children'] = [c.as_dict() for c in self.children]
+        return d
+
+    def __repr__(self):
+        return "<Span %s %s>" % (self.name, self.duration)
+
+
+class DocumentTracer(object):
+    """Build a span per document from the commands sent to a printer."""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.current = None
+
+    def command(self, cmd, args, start, stats, reply=None, error=None):
+        """Record `cmd`, sent at `start` with traffic `stats` (may be None),
+        and its reply or the error it raised."""
+        end = time.time()
+        if cmd in _opening and error is not None:
+            # nothing was opened: a span left waiting for its close would
+            # swallow every later document
+            self.current = None
+            return
+        if cmd in _opening and self.current is None:
+            kind = args[0] if args and cmd != CMD_OPEN_NON_FISCAL_RECEIPT \
+                    else 'non-fiscal'
+            self.current = Span('document', start, type=kind, items=0,
+                                status='open')
+        document = self.current
+        if document is None:
+            return
+        name = COMMANDS[cmd][0] if cmd in COMMANDS else "0x%02x" % cmd
+        child = Span(name, start, command=cmd)
+        child.end = end
+        if stats is not None:
+            child.add(stats)
+            document.add(stats)
+        if error is not None:
+            child.attributes['error'] = unicode(error.args[0] if error.args
+                                                else error)
+        document.children.append(child)
+        if cmd in _items and error is None:
+            document.attributes['items'] += 1
+        if error is not None:
+            return
+        if cmd in _closing:
+            document.attributes['status'] = 'closed'
+            if reply is not None and len(reply) > 2 and reply[2].isdigit():
+                document.attributes['number'] = int(reply[2])
+        elif cmd == CMD_CANCEL_ANY_DOCUMENT or \
+                cmd == CMD_ADD_PAYMENT and len(args) > 2 and args[2] == 'C':
+            document.attributes['status'] = 'cancelled'
+        else:
+            return
+        document.end = end
+        self.current = None
+        self.exporter.export(document)
+
+
+class JsonlExporter(object):
+    """Append each span to the file at `path` as a JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), sort_keys=True) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RingExporter(object):
+    """Keep the last `size` spans in memory."""
+
+    def __init__(self, size=1000):
+        self.spans = deque(maxlen=size)
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def by_shape(self):
+        """{(type, items, status): (count, mean seconds, max seconds)}"""
+        durations = {}
+        for span in list(self.spans):
+            a = span.attributes
+            key = (a['type'], a['items'], a['status'])
+            durations.setdefault(key, []).append(span.duration)
+        return dict((key, (len(d), sum(d) / len(d), max(d)))
+                    for key, d in durations.items())
+
+    def slowest(self, n=10):
+        return sorted(self.spans, key=lambda s: s.duration, reverse=True)[:n]
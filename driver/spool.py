@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+
+"""Store-and-forward queue of documents in front of the printers.
+
+`Spool.submit()` writes the job to a local write-ahead log and returns a
+`Job` at once; a worker thread per device prints the queued jobs in order
+and retries them while the printer is unreachable, so a POS keeps selling
+through a printer outage.
+
+The log is a file of JSON records, one per line with its CRC32:
+
+    job     a new job: device and commands
+    sent    the job is about to be sent, with the document counter it had
+    done    the job printed, with the number of its document
+    failed  the printer rejected the job
+
+Appends from all the workers are written and fsync'ed in batches by one
+writer thread (group commit), and every append waits for its batch.
+
+After a crash the jobs without `done` or `failed` are replayed. For a job
+that was `sent`, the document counter of the printer tells whether the
+document got closed: if it moved the job is done, otherwise the open
+document (if any) is cancelled and the job is sent again. Documents the
+printer does not number (non-fiscal, DNFH) have no counter to look at and
+may print twice. The counters only prove anything if the spool is the only
+one printing on the device.
+"""
+
+import itertools
+import json
+import os
+import threading
+import zlib
+from Queue import Queue
+from collections import deque
+
+from driver import FiscalDriver, PrinterException, PrinterStatusError, \
+                   CommunicationError, log
+from hasar import HasarPrinter, CMD_STATUS_REQUEST, CMD_ADD_PAYMENT, \
+                  CMD_CLOSE_FISCAL_RECEIPT, CMD_CLOSE_NON_FISCAL_RECEIPT, \
+                  CMD_CLOSE_CREDIT_NOTE, parse_status, document_counter, \
+                  document_open, prepare_args
+from schema import FieldError, validator
+
+PENDING = 'pending'
+SENT = 'sent'
+DONE = 'done'
+FAILED = 'failed'
+
+# errors after which the printer may work again, everything else from the
+# printer is a rejection of the document
+_transient = (CommunicationError, PrinterStatusError, EnvironmentError)
+
+# commands whose reply has the number of the document they close
+_closing = (CMD_CLOSE_FISCAL_RECEIPT, CMD_CLOSE_CREDIT_NOTE)
+
+
+class Job(object):
+    """A queued document. Works as a future of its document number."""
+
+    def __init__(self, id, device, commands, tag=None):
+        self.id = id
+        self.device = device
+        self.commands = commands
+        self.tag = tag          # caller's reference, kept in the log
+        self.state = PENDING
+        self.before = None      # document counter when it was sent
+        self.number = None
+        self.error = None
+        self.attempts = 0
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the job is done or failed. False on timeout."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Number of the printed document (None if not numbered); raise the
+        error if the printer rejected the job."""
+        if not self.wait(timeout):
+            raise RuntimeError("job %d still %s" % (self.id, self.state))
+        if self.state == FAILED:
+            raise PrinterException(self.error)
+        return self.number
+
+    def _finish(self, state, number=None, error=None):
+        self.state = state
+        self.number = number
+        self.error = error
+        self._done.set()
+
+    def __repr__(self):
+        return "<Job %d %s %s>" % (self.id, self.device, self.state)
+
+
+def _encode(record):
+    # fields are str in the printer code page; latin-1 maps them 1:1
+    data = json.dumps(record, separators=(',', ':'), ensure_ascii=True,
+                      encoding='latin-1')
+    return "%08x %s\n" % (zlib.crc32(data) & 0xffffffff, data)
+
+def _decode(line):
+    crc, _, data = line.rstrip("\n").partition(" ")
+    if len(crc) != 8 or int(crc, 16) != zlib.crc32(data) & 0xffffffff:
+        raise ValueError("bad checksum")
+    return _to_str(json.loads(data))
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), _to_str(v)) for k, v in value.items())
+    return value
+
+
+def read_log(path):
+    """Records of the log at `path`, up to the first damaged line (the tail
+    of a write cut by a crash)."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'rb') as f:
+        for n, line in enumerate(f, 1):
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError("incomplete line")
+                records.append(_decode(line))
+            except ValueError as e:
+                log.warning("%s:%d: %s, ignoring the rest of the log",
+                            path, n, e)
+                break
+    return records
+
+
+class WriteAheadLog(object):
+    """Append-only record log with group commit.
+
+    `append()` queues a record and, unless `wait` is false, blocks until
+    the writer thread has written and fsync'ed it along with every other
+    record queued meanwhile.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.commits = 0
+        self.records = 0
+        self._file = open(path, 'ab')
+        self._cond = threading.Condition()
+        self._io = threading.Lock()
+        self._pending = []
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="spool-wal")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, record, wait=True):
+        done = threading.Event()
+        line = _encode(record)
+        with self._cond:
+            if self._closed:
+                raise ValueError("log closed")
+            self._pending.append((line, done))
+            self._cond.notify()
+        if wait:
+            done.wait()
+            if self._error is not None:
+                raise self._error
+        return done
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                with self._io:
+                    self._file.write("".join(line for line, _ in batch))
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                self.commits += 1
+                self.records += len(batch)
+            except EnvironmentError as e:
+                log.error("can't write %s: %s", self.path, e)
+                self._error = e
+            for _, done in batch:
+                done.set()
+
+    def rewrite(self, snapshot):
+        """Replace the log with the records returned by `snapshot()`, which
+        is called with the writes stopped."""
+        with self._io:
+            tmp = self.path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write("".join(_encode(r) for r in snapshot()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self._file.close()
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
+
+
+class Spool(object):
+    """Durable per-device queues of documents.
+
+    A job is a list of (command, fields) that `HasarPrinter.execute()`
+    takes, usually a whole document. Fields are checked against the schema
+    of `model` on submit. A worker retries a job while the errors are
+    transient, waiting `retry_delays` seconds (the last one repeats); a
+    rejection by the printer cancels the open document and fails the job.
+
+    `on_finish`, if given, is called with each job as it ends, from the
+    worker thread of its device. `last_status` has the last `StatusReport`
+    read from each device. The outcome of the last `keep_finished` tagged
+    jobs stays in the log through compactions, to be found by tag.
+    """
+
+    def __init__(self, path, printer_factory=None, model="615",
+                 retry_delays=(1, 2, 5, 10, 30), fsync=True,
+                 compact_every=1000, on_finish=None, keep_finished=0):
+        self.path = path
+        self.model = model
+        self.printer_factory = printer_factory or \
+                (lambda device: HasarPrinter(FiscalDriver(device), model))
+        self.retry_delays = retry_delays
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self.on_finish = on_finish
+        self.schema = validator(model)
+        self.wal = None
+        self._jobs = {}         # unfinished jobs by id
+        self.last_status = {}
+        self._queues = {}
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ids = None
+        self._last_id = 0
+        self._finished = 0
+        self._recent = deque(maxlen=keep_finished)
+
+    def start(self):
+        """Replay the log and start the workers of its unfinished jobs."""
+        jobs = self._replay(read_log(self.path))
+        last = max([job.id for job in jobs] + [self._last_id])
+        self._ids = itertools.count(last + 1)
+        self._stop.clear()
+        self.wal = WriteAheadLog(self.path, self.fsync)
+        self.compact()
+        for job in jobs:
+            log.info("replaying job %d (%s) on %s", job.id, job.state,
+                     job.device)
+            self._enqueue(job)
+        return jobs
+
+    def stop(self):
+        """Stop the workers after their current job; queued jobs stay in
+        the log for the next start."""
+        self._stop.set()
+        for queue in self._queues.values():
+            queue.put(None)
+        for worker in self._workers.values():
+            worker.join()
+        self._queues.clear()
+        self._workers.clear()
+        self.wal.close()
+        self.wal = None
+
+    def submit(self, device, commands, tag=None):
+        """Queue `commands` for `device` and return its `Job` once it is on
+        disk. `tag` is any JSON value to find the job by after a restart."""
+        prepared = []
+        for cmd, args in commands:
+            args = prepare_args(self.model, cmd, args)
+            try:
+                self.schema.check(cmd, args)
+            except FieldError as e:
+                raise PrinterException("Comando inválido para el modelo %s: %s"
+                                       % (self.model, e))
+            prepared.append((cmd, args))
+        with self._lock:
+            job = Job(next(self._ids), device, prepared, tag)
+            self._jobs[job.id] = job
+            self._last_id = job.id
+        self.wal.append(self._job_record(job))
+        self._enqueue(job)
+        return job
+
+    def pending(self):
+        """Unfinished jobs, oldest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.id)
+
+    def compact(self):
+        """Rewrite the log with the records of the unfinished jobs only."""
+        self.wal.rewrite(self._snapshot)
+
+    def _snapshot(self):
+        with self._lock:
+            records = list(self._recent)
+        pending = self.pending()
+        for job in pending:
+            records.append(self._job_record(job))
+            if job.state == SENT:
+                records.append({'op': 'sent', 'id': job.id,
+                                'before': job.before})
+        if not pending:
+            # keeps the last id, so ids are not reused after a restart
+            records.append({'op': 'last', 'id': self._last_id})
+        return records
+
+    def _job_record(self, job):
+        record = {'op': 'job', 'id': job.id, 'device': job.device,
+                  'commands': job.commands}
+        if job.tag is not None:
+            record['tag'] = job.tag
+        return record
+
+    def _replay(self, records):
+        jobs = {}
+        self._last_id = 0
+        self._recent.clear()
+        for record in records:
+            op, id = record['op'], record['id']
+            self._last_id = max(self._last_id, id)
+            if op == 'job':
+                jobs[id] = Job(id, record['device'],
+                               [(cmd, args) for cmd, args in record['commands']],
+                               record.get('tag'))
+            elif op == 'sent' and id in jobs:
+                jobs[id].state = SENT
+                jobs[id].before = record['before']
+            elif op in (DONE, FAILED):
+                jobs.pop(id, None)
+                if 'tag' in record:
+                    self._recent.append(record)
+        self._jobs = jobs
+        return sorted(jobs.values(), key=lambda job: job.id)
+
+    def _enqueue(self, job):
+        with self._lock:
+            queue = self._queues.get(job.device)
+            if queue is None:
+                queue = self._queues[job.device] = Queue()
+                worker = threading.Thread(target=self._worker,
+                        args=(job.device, queue),
+                        name="spool-%s" % (job.device,))
+                worker.daemon = True
+                self._workers[job.device] = worker
+                worker.start()
+        queue.put(job)
+
+    def _worker(self, device, queue):
+        printer = None
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            delays = iter(self.retry_delays)
+            delay = None
+            while not self._stop.is_set():
+                job.attempts += 1
+                try:
+                    if printer is None:
+                        printer = self.printer_factory(device)
+                    self._print(printer, job)
+                    break
+                except _transient as e:
+                    printer = self._discard(printer)
+                    delay = next(delays, delay)
+                    log.warning("job %d on %s: %s, retrying in %ss",
+                                job.id, device, e, delay)
+                    self._stop.wait(delay)
+                except PrinterException as e:
+                    self._reject(printer, job, e)
+                    break
+            # one worker takes the count, so compactions don't overlap it
+            with self._lock:
+                due = self._finished >= self.compact_every
+                if due:
+                    self._finished = 0
+            if due:
+                self.compact()
+        self._discard(printer)
+
+    def _discard(self, printer):
+        if printer is not None:
+            try:
+                printer.close()
+            except Exception:
+                pass
+        return None
+
+    def _status(self, printer):
+        return parse_status(printer.execute(CMD_STATUS_REQUEST))
+
+    def _print(self, printer, job):
+        counter = document_counter(job.commands)
+        status = self.last_status[job.device] = self._status(printer)
+        if job.state == SENT:
+            # sent before a crash or a link failure: did it get printed?
+            if counter and job.before is not None and \
+                    getattr(status, counter) > job.before:
+                self._finish(job, DONE, number=getattr(status, counter))
+                return
+            if document_open(status):
+                self._cancel(printer, status)
+                status = self._status(printer)
+        job.before = getattr(status, counter) if counter else None
+        self.wal.append({'op': 'sent', 'id': job.id, 'before': job.before})
+        job.state = SENT
+        reply = None
+        for cmd, args in job.commands:
+            reply = printer.execute(cmd, args)
+        number = None
+        if counter:
+            if job.commands[-1][0] in _closing and len(reply) > 2 \
+                    and reply[2].isdigit():
+                number = int(reply[2])
+            else:
+                number = getattr(self._status(printer), counter)
+        self._finish(job, DONE, number=number)
+
+    def _cancel(self, printer, status):
+        log.info("cancelling the open document (status %s)", status.aux_status)
+        if int(status.aux_status, 16) & 0xf == 5:
+            printer.execute(CMD_CLOSE_NON_FISCAL_RECEIPT)
+        else:
+            printer.execute(CMD_ADD_PAYMENT, ["Cancelar", "0.00", "C", "0"])
+
+    def _reject(self, printer, job, error):
+        log.error("job %d on %s rejected: %s", job.id, job.device, error)
+        try:
+            status = self._status(printer)
+            if document_open(status):
+                self._cancel(printer, status)
+        except PrinterException as e:
+            # the next job finds the document open and cancels it
+            log.warning("can't cancel job %d: %s", job.id, e)
+        message = error.args[0] if error.args else str(error)
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self._finish(job, FAILED, error=message)
+
+    def _finish(self, job, state, number=None, error=None):
+        record = {'op': state, 'id': job.id}
+        if state == DONE:
+            record['number'] = number
+        else:
+            record['error'] = error
+        if job.tag is not None:
+            record['tag'] = job.tag
+        self.wal.append(record)
+        with self._lock:
+            if job.tag is not None:
+                self._recent.append(record)
+            self._jobs.pop(job.id, None)
+            self._finished += 1
+        job._finish(state, number, error)
+        if self.on_finish is not None:
+            self.on_finish(job)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from decimal import Decimal
+
+from hasar import PrinterItem
+from items import ItemColumns
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ItemColumnsTest(unittest.TestCase):
+
+    def test_totals(self):
+        items = ItemColumns()
+        items.append(PrinterItem("Cafe", Decimal("2.5"), Decimal("10.01"),
+                                 Decimal("21"), Decimal("1"), "promo", False))
+        items.extend(["A", "B", "Cafe"], [1, 0.333, "3"],
+                     [100, "9.99", Decimal("0.05")], [21, 10.5, 21],
+                     negative=[0, 0, 1])
+        totals = items.totals()
+        self.assertEqual(totals.count, 4)
+        self.assertEqual(totals.total, Decimal("127.21"))
+        self.assertEqual(totals.by_rate[Decimal("21")],
+                         (Decimal("123.88"), Decimal("102.38"), Decimal("21.50")))
+        self.assertEqual(len(items._pool), 4)
+
+    def test_item_round_trip(self):
+        items = ItemColumns()
+        item = PrinterItem("X", Decimal("1.5"), Decimal("12.99"),
+                           Decimal("10.5"), Decimal("0"), None, True)
+        items.append(item)
+        self.assertEqual(items[0], item)
+
+    def test_columns_of_different_length(self):
+        self.assertRaises(ValueError, ItemColumns().extend,
+                          ["a"], [1, 2], [1], [21])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_columns(self):
+        items = ItemColumns()
+        items.extend(["a", "b", "c"],
+                     numpy.array([1, 2, 3], dtype=numpy.int32),
+                     numpy.array([Decimal("12.99"), Decimal("0.50"), 1],
+                                 dtype=object),
+                     numpy.array([21.0, 10.5, 21.0]),
+                     discount=numpy.array(["0", "0.25", "0"], dtype=object))
+        self.assertEqual(list(items.price), [1299, 50, 100])
+        self.assertEqual(list(items.iva), [2100, 1050, 2100])
+        self.assertEqual(list(items.discount), [0, 25, 0])
+        self.assertEqual(items.totals().total, Decimal("16.74"))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_matches_python(self):
+        import items as module
+        columns = ItemColumns()
+        columns.extend(["x"] * 4, ["0.333", "1", "2.5", "7"],
+                       ["9.99", "0.05", "10.01", "3.33"], [21, 21, 10.5, 27],
+                       negative=[0, 1, 0, 0])
+        vectorized = columns.totals()
+        module.numpy, saved = None, module.numpy
+        try:
+            self.assertEqual(columns.totals(), vectorized)
+        finally:
+            module.numpy = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Mide la lectura de la memoria fiscal desde el host
+
+    python bench_audit.py --years 5 --baudrate 9600 --csv zetas.csv
+
+Carga `years` años de cierres Z en una memoria fiscal temporal, arranca el
+emulador sobre un par en memoria y recorre los registros con
+HasarPrinter.daily_reports() y daily_reports_by_date(). Muestra el tiempo
+hasta el primer registro, registros por segundo y cantidad de comandos.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from datetime import date, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "driver"))
+
+from config import config
+config['OUTPUT']['terminal'] = False
+import driver
+import export
+from hasar import HasarPrinter
+from money import format_amount
+from loopback import start_emulator
+
+
+def preload(years, seed):
+    "Guarda un cierre Z por día durante `years` años; devuelve (primera, última) fecha"
+    from drivers.hasar import Hasar615
+    rnd = random.Random(seed)
+    printer = Hasar615()
+    day = first = date.today() - timedelta(days=int(365.25 * years))
+    last_b = 0
+    number = printer._z_number
+    while day < date.today():
+        number += 1
+        tickets = rnd.randint(50, 400)
+        last_b += tickets
+        gross = rnd.randint(100000, 5000000)
+        iva = gross - gross * 100 // 121
+        reply = ((str(number), "0", "0", "0", str(tickets), "0", str(last_b), "0",
+                  format_amount(gross), format_amount(iva)) + (format_amount(0),) * 3 +
+                 ("0", "0") + (format_amount(0),) * 5 + ("0", "0"))
+        printer._store_daily_record(reply, day)
+        day += timedelta(days=1)
+    printer._z_number = number
+    printer._remember('z_number', number)
+    printer.close()
+    return first, day - timedelta(days=1)
+
+
+class Counter(object):
+    "Cuenta los comandos enviados por el driver"
+
+    def __init__(self, printer):
+        self.count = 0
+        printer.driver.add_reply_listener(self._on_reply)
+
+    def _on_reply(self, command, fields):
+        self.count += 1
+
+
+def timed(records):
+    "Consume `records`; devuelve (lista, segundos al primero, segundos totales)"
+    start = time.time()
+    first = None
+    result = []
+    for record in records:
+        if first is None:
+            first = time.time() - start
+        result.append(record)
+    return result, first or 0.0, time.time() - start
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--years", type="float", default=5)
+    parser.add_option("--baudrate", type="int", default=None,
+                      help="simulate the serial link speed (default: no delay)")
+    parser.add_option("--days", type="int", default=31,
+                      help="length of the date range query, in days")
+    parser.add_option("--csv", metavar="FILE", help="export the records to FILE")
+    parser.add_option("--jsonl", metavar="FILE", help="export the records to FILE")
+    parser.add_option("--seed", type="int", default=1)
+    options, args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="bench_audit")
+    config['MEMORY']['path'] = path
+    try:
+        t = time.time()
+        first_day, last_day = preload(options.years, options.seed)
+        print "preload       %.2fs (%s to %s)" % (time.time() - t, first_day, last_day)
+
+        host, comm = start_emulator(baudrate=options.baudrate)
+        printer = HasarPrinter(driver.FiscalDriver(host))
+        counter = Counter(printer)
+
+        records, first, elapsed = timed(printer.daily_reports())
+        print "by number     %d records in %.2fs (%.0f records/s), first after %.1f ms" % (
+            len(records), elapsed, len(records) / elapsed, first * 1000)
+
+        start = last_day - timedelta(days=options.days - 1)
+        counter.count = 0
+        records, first, elapsed = timed(printer.daily_reports_by_date(start, last_day))
+        print "by date       %d records in %.3fs, %d commands, first after %.1f ms" % (
+            len(records), elapsed, counter.count, first * 1000)
+
+        for filename, write in ((options.csv, export.write_csv),
+                                (options.jsonl, export.write_jsonl)):
+            if filename:
+                with open(filename, "w") as f:
+                    t = time.time()
+                    n = write(printer.daily_reports(), f)
+                print "%-13s %d records in %.2fs" % (filename, n, time.time() - t)
+
+        printer.close()
+        comm.thread.join(1)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Mide el efecto de las fallas de comunicación sobre el driver del host
+
+    python bench_faults.py -n 500 --corrupt 0.02 --drop 0.005 --wait-time 0.5
+
+Envía `n` StatusRequest a través de faults.FaultProxy y muestra comandos
+por segundo, percentiles de latencia, errores y los contadores del proxy.
+Con --sweep se repite para varios WAIT_TIME y RETRIES.
+"""
+
+import os
+import sys
+import time
+import logging
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "driver"))
+
+from config import config
+config['OUTPUT']['terminal'] = False
+import driver
+from faults import Faults, start_faulty_emulator
+
+CMD_STATUS_REQUEST = 0x2a
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(faults, n, wait_time, retries, min_wait_time):
+    host, comm, proxy = start_faulty_emulator(faults)
+    printer = driver.FiscalDriver(host)
+    printer.WAIT_TIME = wait_time
+    printer.RETRIES = retries
+    printer.MIN_WAIT_TIME = min_wait_time
+    latencies, errors = [], 0
+    start = time.time()
+    for i in xrange(n):
+        t = time.time()
+        try:
+            printer.send_command(CMD_STATUS_REQUEST, [], skip_errors=True)
+        except driver.CommunicationError:
+            errors += 1
+            # la trama en curso se descarta; la siguiente usa otro número
+            printer._increment_seq_number()
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    rto = printer.timeout_for(CMD_STATUS_REQUEST)
+    printer.close()
+    proxy.join(1)
+    comm.thread.join(1)
+    latencies.sort()
+    return {
+        'wait_time': wait_time,
+        'retries': retries,
+        'rate': n / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': latencies[-1] * 1000,
+        'errors': errors,
+        'rto': rto * 1000,
+        'proxy': proxy.stats,
+    }
+
+def report(r):
+    print ("WAIT_TIME=%(wait_time)-5s RETRIES=%(retries)-2d %(rate)8.1f cmd/s  "
+           "p50 %(p50)7.2f ms  p99 %(p99)8.2f ms  max %(max)8.2f ms  "
+           "errores %(errors)d  timeout %(rto).0f ms" % r)
+    for direction, stats in sorted(r['proxy'].items()):
+        print "    %-12s %s" % (direction, " ".join("%s=%d" % kv for kv in sorted(stats.items())))
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", type="int", default=500, help="commands to send")
+    for name in ('corrupt', 'drop', 'duplicate', 'stall'):
+        parser.add_option("--" + name, type="float", default=0,
+                          help="probability of %s per frame" % name)
+    parser.add_option("--jitter", type="float", default=0,
+                      help="max random delay per frame, in seconds")
+    parser.add_option("--stall-time", type="float", default=0.5)
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--wait-time", type="float", default=driver.FiscalDriver.WAIT_TIME)
+    parser.add_option("--retries", type="int", default=driver.FiscalDriver.RETRIES)
+    parser.add_option("--min-wait-time", type="float",
+                      default=driver.FiscalDriver.MIN_WAIT_TIME)
+    parser.add_option("--sweep", action="store_true", default=False,
+                      help="try several WAIT_TIME/RETRIES combinations")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    faults = Faults(options.corrupt, options.drop, options.duplicate,
+                    options.jitter, options.stall, options.stall_time,
+                    options.seed)
+    if options.sweep:
+        combos = [(w, r) for w in (0.1, 0.5, 2.0) for r in (1, 4, 8)]
+    else:
+        combos = [(options.wait_time, options.retries)]
+    for wait_time, retries in combos:
+        report(run(faults, options.n, wait_time, retries, options.min_wait_time))
+
+if __name__ == '__main__':
+    main()
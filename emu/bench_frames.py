@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Mide el costo de armar las tramas del host con y sin driver.FrameCache
+
+    python bench_frames.py -n 200000 --catalog 2000 --skew 1.1 --weighed 0.1
+
+Genera PrintLineItem de un catálogo de `catalog` productos cuya
+popularidad sigue una ley de Zipf de exponente `skew`; una fracción
+`weighed` de los ítems se vende por peso (cantidad distinta cada vez).
+Muestra microsegundos por trama y tasa de aciertos para varios tamaños de
+caché (0: sin caché) y, como referencia, el armado anterior a FrameCache.
+"""
+
+import os
+import sys
+import time
+import random
+import bisect
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "driver"))
+
+from driver import FrameCache, STX, FS, ETX
+
+CMD_PRINT_LINE_ITEM = 0x42
+
+def catalog(n, rnd):
+    return [("PRODUCTO %05d" % i, "%d.%02d" % divmod(rnd.randint(100, 90000), 100),
+             rnd.choice(("21.00", "10.50", "27.00"))) for i in xrange(n)]
+
+def zipf_sampler(n, skew, rnd):
+    weights = [1.0 / (i + 1) ** skew for i in xrange(n)]
+    total = sum(weights)
+    cumulative, acc = [], 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    return lambda: min(bisect.bisect_left(cumulative, rnd.random()), n - 1)
+
+def items(n, products, skew, weighed, seed):
+    rnd = random.Random(seed)
+    pick = zipf_sampler(len(products), skew, rnd)
+    result = []
+    for i in xrange(n):
+        desc, price, iva = products[pick()]
+        if rnd.random() < weighed:
+            quantity = "%.3f" % rnd.uniform(0.1, 3)
+        else:
+            quantity = rnd.choice(("1", "1", "1", "1", "2", "3"))
+        result.append([desc, quantity, price, iva, "M", "0", "0", "T"])
+    return result
+
+def legacy_frame(command, fields, seq):
+    "Armado de la trama antes de FrameCache"
+    msg = STX + chr(seq) + chr(command)
+    if fields:
+        msg += FS + FS.join(fields)
+    msg += ETX
+    check_sum = sum([ord(x) for x in msg])
+    return msg + ("0000" + hex(check_sum)[2:])[-4:].upper()
+
+def run_legacy(lines):
+    seq = 0x20
+    start = time.clock()
+    for fields in lines:
+        legacy_frame(CMD_PRINT_LINE_ITEM, fields, seq)
+        seq = seq + 2 if seq < 0x7e else 0x20
+    return (time.clock() - start) / len(lines) * 1e6
+
+def run(lines, size):
+    cache = FrameCache(size)
+    frame = cache.frame
+    seq = 0x20
+    start = time.clock()
+    for fields in lines:
+        frame(CMD_PRINT_LINE_ITEM, fields, seq)
+        seq = seq + 2 if seq < 0x7e else 0x20
+    return (time.clock() - start) / len(lines) * 1e6, cache.hit_rate
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", type="int", default=200000, help="items to encode")
+    parser.add_option("--catalog", type="int", default=2000)
+    parser.add_option("--skew", type="float", default=1.1,
+                      help="Zipf exponent of product popularity")
+    parser.add_option("--weighed", type="float", default=0.1,
+                      help="fraction of items sold by weight")
+    parser.add_option("--sizes", default="0,64,256,512,2048")
+    parser.add_option("--seed", type="int", default=1)
+    options, args = parser.parse_args()
+
+    products = catalog(options.catalog, random.Random(options.seed))
+    lines = items(options.n, products, options.skew, options.weighed, options.seed)
+    base = run_legacy(lines)
+    print "legacy       %6.2f us/frame" % base
+    for size in [int(s) for s in options.sizes.split(",")]:
+        us, hit_rate = run(lines, size)
+        print "cache %-6d %6.2f us/frame  hit rate %5.1f %%  %5.1f %% of legacy" % (
+            size, us, hit_rate * 100, us / base * 100)
+
+if __name__ == '__main__':
+    main()
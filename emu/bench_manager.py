@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Mide el throughput del Manager del host según la cantidad de procesos
+
+    python bench_manager.py -d 64 -n 20 -p 1,2,4,8
+
+Cada dispositivo es un emulador en memoria (loopback.start_emulator) que
+corre dentro del proceso del shard que lo atiende, así que el costo de
+emular se reparte igual que el del driver. Se envían `n` tickets por
+dispositivo y se muestran documentos por segundo y percentiles de la
+espera de cada documento. La primera fila es un Spool en un solo proceso,
+sin IPC, como referencia.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "driver"))
+
+from config import config
+config['OUTPUT']['terminal'] = False
+config['OUTPUT']['threaded'] = False
+from loopback import start_emulator
+import driver
+import hasar
+from spool import Spool
+from manager import Manager
+
+TICKET = [
+    (hasar.CMD_OPEN_FISCAL_RECEIPT, ['B', 'T']),
+    (hasar.CMD_PRINT_LINE_ITEM, ['Articulo 1', '1', '12.10', '21.00', 'M', '0', '0', 'T']),
+    (hasar.CMD_PRINT_LINE_ITEM, ['Articulo 2', '2', '3.50', '10.50', 'M', '0', '0', 'T']),
+    (hasar.CMD_ADD_PAYMENT, ['Efectivo', '20.00', 'T', '0']),
+    (hasar.CMD_CLOSE_FISCAL_RECEIPT, []),
+]
+
+def emulated_printer(device):
+    host, comm = start_emulator()
+    return hasar.HasarPrinter(driver.FiscalDriver(host))
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(devices, n, processes):
+    directory = tempfile.mkdtemp(prefix="bench_manager")
+    try:
+        if processes:
+            pool = Manager(directory, processes, emulated_printer, fsync=False)
+        else:
+            pool = Spool(os.path.join(directory, "spool.log"),
+                         emulated_printer, fsync=False)
+        pool.start()
+        start = time.time()
+        jobs = [pool.submit("dev%d" % d, TICKET)
+                for i in xrange(n) for d in xrange(devices)]
+        waits = []
+        for job in jobs:
+            job.result(600)
+            waits.append(time.time() - start)
+        elapsed = time.time() - start
+        pool.stop()
+    finally:
+        shutil.rmtree(directory)
+    waits.sort()
+    return {
+        'processes': processes or 'spool',
+        'docs': len(jobs),
+        'rate': len(jobs) / elapsed,
+        'p50': percentile(waits, 0.50),
+        'p99': percentile(waits, 0.99),
+    }
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-d", "--devices", type="int", default=32)
+    parser.add_option("-n", type="int", default=10,
+                      help="tickets per device")
+    parser.add_option("-p", "--processes", default="1,2,4",
+                      help="process counts to try, comma separated")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    counts = [0] + [int(p) for p in options.processes.split(",")]
+    for processes in counts:
+        r = run(options.devices, options.n, processes)
+        print ("procesos %(processes)-5s %(docs)6d docs %(rate)8.1f docs/s  "
+               "espera p50 %(p50)6.2f s  p99 %(p99)6.2f s" % r)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compara el cálculo de un ticket con Decimal (implementación anterior) y con
+enteros en centavos (money.py).
+
+    python bench_money.py [items] [repeticiones]
+"""
+
+import sys
+import timeit
+from decimal import Decimal
+
+from money import parse_amount, parse_quantity, parse_rate, \
+                  line_amount, net_of, format_amount
+
+def ticket(n):
+    return [("%d.%03d" % (1 + i % 5, i % 1000), "%d.%02d" % (i % 500, i % 100))
+            for i in xrange(n)]
+
+def with_decimal(items):
+    total = Decimal(0)
+    iva = Decimal(0)
+    for cantidad, monto in items:
+        cantidad, monto = Decimal(cantidad), Decimal(monto)
+        total += cantidad * monto
+        iva += (monto / Decimal('1.21')) * Decimal('0.21') * cantidad
+        "%.2f" % (cantidad * monto)
+    return "%.2f" % total, "%.2f" % iva
+
+def with_integers(items):
+    total = 0
+    iva = 0
+    rate = parse_rate("21.00")
+    for cantidad, monto in items:
+        importe = line_amount(parse_quantity(cantidad), parse_amount(monto))
+        total += importe
+        iva += importe - net_of(importe, rate)
+        format_amount(importe)
+    return format_amount(total), format_amount(iva)
+
+def main(n=1000, repeat=20):
+    items = ticket(n)
+    for f in (with_decimal, with_integers):
+        best = min(timeit.repeat(lambda: f(items), number=1, repeat=repeat))
+        print "%-14s %8.3f ms  total=%s iva=%s" % ((f.__name__, best * 1000) + f(items))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
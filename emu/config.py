@@ -8,8 +8,13 @@ config = {
         'ib': "0619591",
         'inicio': "02-09-05",
         'pv': "3",
+        'registro': "HSHAZB0021",
+        'inicializacion': "01-09-05",
+        'iva': "I",
         'last_counter_A': 365,
         'last_counter_B': 790,
+        'last_z': 0,
+        'last_x': 0,
     },
     # Maximo 40 caracteres 
     # 0xf4 - Doble ancho 20 caracteres
@@ -43,4 +48,27 @@ config = {
         19: "",
         20: "",
     },
+    # Memoria fiscal persistente (ver memory.FiscalMemory), None: sólo en RAM
+    'MEMORY': {
+        'path': None,
+        'sync_every': 32,
+        'sync_interval': 1.0,
+        'max_journal': 1<<20,
+    },
+    # Cinta testigo electrónica (ver journal.ElectronicJournal), None: sólo
+    # se conserva el último comprobante para reimpresión
+    'JOURNAL': {
+        'path': None,
+        'segment_size': 4<<20,
+    },
+    # Salida visual (ver output.VisualPrinter): terminal, archivo de texto
+    # y/o archivo JSONL; line_delay simula el tiempo de impresión de una línea
+    'OUTPUT': {
+        'terminal': True,
+        'text': None,
+        'jsonl': None,
+        'line_delay': 0.02,
+        'batch_size': 64,
+        'threaded': True,
+    },
 }
@@ -84,6 +84,8 @@ class FiscalDriver(object):
         self._register_methods()
 
     def _register_methods(self):
+        # la tabla de la clase se copia: guarda métodos ligados a la instancia
+        self._symbol_table = dict(self._symbol_table)
         for key in dir(self):
             method = getattr(self, key)
             if callable(method):
@@ -98,12 +100,16 @@ class FiscalDriver(object):
             method = getattr(self, method, None)
         if not method and method_str is not None:
             raise NotImplementedCommand("%r (0x%.2x) is in commands table as '%s' but no implemented in %s" % \
-                                        (symbol, ord(symbol), method_str, type(self).__name__))
+                                        (symbol, ord(symbol[-1]), method_str, type(self).__name__))
         elif not method or not callable(method):
             raise UnknownCommandError("%r (0x%.2x) not registered in fiscal driver commands table" %\
-                                      (symbol, ord(symbol)))
+                                      (symbol, ord(symbol[-1])))
         return method
 
+    def status_fields(self):
+        "Estado de la impresora y estado fiscal, al inicio de toda respuesta"
+        return self.printer_status.as_hexstr(), self.fiscal_status.as_hexstr()
+
     def filter_retval(self, retval):
         if retval is None:
             retval = []
@@ -117,6 +123,13 @@ class FiscalDriver(object):
     def filter_params(self, params):
         return params
 
+    def validate_params(self, symbol, params):
+        "Rechaza (NotValidDataError) los parámetros que no respetan el formato del comando"
+        pass
+
+    def close(self):
+        pass
+
     def clean_fiscal_status(self):
         self.fiscal_status.unset("unknown command")
         self.fiscal_status.unset("not valid data")
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys
-import time
+import os
+from bisect import bisect_left
 from datetime import datetime
 from collections import namedtuple
-from decimal import Decimal
 
 from drivers.base import FiscalDriver, FiscalStatus, PrinterStatus, \
                          FiscalDriverError, NotValidDataError, \
                          NotValidCommandError, NotImplementedCommand
-from utils import command
+from utils import command, symbols
 from config import config
+from output import VisualPrinter
+from memory import FiscalMemory
+from journal import ElectronicJournal, date_key
+# el esquema de los comandos y el CUIT se validan como en el host
+from host import schema as host_schema, cuit as host_cuit
+from totals import DailyTotals
+from money import parse_amount, parse_quantity, parse_rate, parse_fixed, \
+                  div_round, line_amount, net_of, gross_of, \
+                  format_amount, format_quantity, format_rate
 
 class NotValidDateData(FiscalDriverError):
     error_state = "bad date"
@@ -30,7 +38,9 @@ class Hasar615FiscalStatus(FiscalStatus):
 
 CustomerData = namedtuple("CustomerData", "nombre cuit responsabilidad tipo_doc")
 FiscalDocument = namedtuple("FiscalDocument", "type number items")
-FiscalItem = namedtuple("FiscalItem", "desc cantidad monto iva signo k total")
+# montos en centavos, cantidades y alícuotas según money.py; importe e
+# impuesto son el total del ítem (con IVA) y su IVA, ya redondeados
+FiscalItem = namedtuple("FiscalItem", "desc cantidad monto iva signo k total importe impuesto")
 DiscountItem = namedtuple("DiscountItem", "desc monto signo total")
 
 _customer_type = {
@@ -43,6 +53,28 @@ _customer_type = {
     'B': 'RESPONSABLE NO INSCRIPTO, BIENES DE USO',
 }
 
+SEPARATOR = "-"*40
+CUT_START = "\x1b[31m" + "8<------8<".center(40, "-") + "\x1b[0m"
+CUT_END = "\x1b[31m" + ">8------>8".center(40, "-") + "\x1b[0m"
+
+# bloque fijo del comprobante en el que se imprime cada línea de SetHeaderTrailer
+_header_blocks = dict([(i, 'header') for i in range(1, 8)] +
+                      [(i, 'items_header') for i in range(8, 11)] +
+                      [(i, 'trailer') for i in range(11, 15)])
+
+# código del comprobante abierto en el status de documento (apéndice 5)
+_document_codes = {'A': 0x01, 'B': 0x02, 'C': 0x03, 'D': 0x04, 'E': 0x05,
+                   'T': 0x0a, 'R': 0x40, 'S': 0x41, 'N': 0x20}
+
+# tipo del comprobante no fiscal abierto (no lleva número)
+NON_FISCAL = 'N'
+
+# leyenda que el 615 intercala cada cuatro líneas de texto no fiscal
+NON_FISCAL_LEGEND = "NO FISCAL".center(40)
+
+# tipo con el que se guardan los registros diarios (ver ElectronicJournal)
+DAILY_RECORD = 'Z'
+
 class Hasar615PrinterStatus(PrinterStatus):
 
     __statuses__ = {
@@ -55,17 +87,17 @@ class Hasar615(FiscalDriver):
     brand_name = 'Hasar'
     model_name = 'SMH/P 615F'
 
-    def __init__(self):
+    schema = host_schema.validator("615")
+
+    def __init__(self, output=None, persistent=True):
         super(Hasar615, self).__init__(
                 fiscal_status_cls=Hasar615FiscalStatus,
                 printer_status_cls=Hasar615PrinterStatus
         )
-        self._init_memory()
+        self.output = output or VisualPrinter.from_config(config['OUTPUT'])
+        self._init_memory(persistent)
         self._clean_work_memory()
-        self._last_number = {
-            "A": self.EPROM['last_counter_A'],
-            "B": self.EPROM['last_counter_B'],
-        }
+        self._blocks = {}
 
         self.fiscal_status.set("certified terminal")
         self.fiscal_status.set("fiscalized terminal")
@@ -73,8 +105,14 @@ class Hasar615(FiscalDriver):
         #self.fiscal_status.set("low battery")
 
     def StatusRequest(self, *params):
-        ret = self.printer_status.as_hexstr(), self.fiscal_status.as_hexstr()
-        return ret
+        return self.status_fields() + (
+            "%08d" % self._last_number["B"],
+            "%04X" % self._aux_status(),
+            "%08d" % self._last_number["A"],
+            self._document_status(),
+            "%08d" % self._last_number.get("S", 0),
+            "%08d" % self._last_number.get("R", 0),
+        )
 
     @command('\x58')
     def SetDateTime(self, *params):
@@ -84,21 +122,37 @@ class Hasar615(FiscalDriver):
             raise NotValidDateData("Error en el ingreso de fecha: '%s'" % "|".join(params))
         self.fiscal_status.unset("bad date")
         print "[INFO] * Setting time to %s" % (new_time.isoformat(),)
-        return self.StatusRequest()
+        return self.status_fields()
+
+    @command('\x73')
+    def GetInitData(self, *params):
+        "Datos de inicialización (3.2.3); los 615 no tienen GetPrinterVersion"
+        eprom = self.EPROM
+        inicio = datetime.strptime(eprom['inicio'], "%d-%m-%y")
+        return self.status_fields() + (
+            eprom['cuit'].replace("-", ""),
+            eprom['razon_social'][:40],
+            eprom['registro'],
+            datetime.strptime(eprom['inicializacion'], "%d-%m-%y").strftime("%y%m%d"),
+            "%04d" % int(eprom['pv']),
+            eprom['ib'],
+            inicio.strftime("%y%m%d"),
+            eprom['iva'],
+        )
 
     @command('\x59')
     def GetDateTime(self, *params):
         now = datetime.now()
         fecha = now.date().strftime('%y%m%d')
         hora = now.time().strftime('%H%M%S')
-        return self.StatusRequest() + (fecha, hora)
+        return self.status_fields() + (fecha, hora)
 
     @command('\x62')
     def SetCustomerData(self, *params):
         if self._current_document is not None:
             raise NotValidCommandError(u"existe un documento abierto")
 
-        self._customer_data = CustomerData(*params)
+        self._customer_data = CustomerData(*params[:4])
         if self._customer_data.tipo_doc == 'C':
             if not self._validate_cuit(self._customer_data.cuit):
                 bad_cuit = self._customer_data.cuit
@@ -107,16 +161,19 @@ class Hasar615(FiscalDriver):
 
         # TODO: verificar coherencia 'Responsabilidad frente al IVA' y 'CUIT o documento'
 
-        return self.StatusRequest()
+        return self.status_fields()
 
     @command('\x5d') # ']'
     def SetHeaderTrailer(self, *params):
         lineno, text = params
+        lineno, text = int(lineno), text[:40]
         if text == '\x7f':
-            self.HEADERTRAILER[int(lineno)] = ""
-        else:
-            self.HEADERTRAILER[int(lineno)] = text[:40]
-        return self.StatusRequest()
+            text = ""
+        if self.HEADERTRAILER.get(lineno) != text:
+            self.HEADERTRAILER[lineno] = text
+            self._remember('header:%d' % lineno, text)
+            self._blocks.pop(_header_blocks.get(lineno), None)
+        return self.status_fields()
 
     @command('\x40') # '@'
     def OpenFiscalReceipt(self, *params):
@@ -140,19 +197,8 @@ class Hasar615(FiscalDriver):
 
         # Imprimimos el encabezado
         #print "\x1b[31m" + " inicio ".center(40, "-") + "\x1b[0m"
-        print "\x1b[31m" + "8<------8<".center(40, "-") + "\x1b[0m"
-        for i in [1, 2]:
-            self._print_out_line(self.FANTASY[i])
-        self._print_out_line(self.EPROM['razon_social'])
-        self._print_out_line("C.U.I.T. Nro : %s" % self.EPROM['cuit'])
-        self._print_out_line(" INGRESOS BRUTOS : %s" % self.EPROM['ib'])
-        for i in [1, 2, 3, 4]:
-            self._print_out_line(self.HEADERTRAILER[i])
-        self._print_out_line("INICIO DE ACTIVIDADES : %s" % self.EPROM['inicio'])
-        self._print_out_line("IVA RESPONSABLE INSCRIPTO")
-        for i in [5, 6, 7]:
-            self._print_out_line(self.HEADERTRAILER[i])
-        self._print_separator()
+        self.output.raw(CUT_START)
+        self._print_block('header')
         self._print_out_line('TIQUE FACTURA   \x1b[;1m" %s "\x1b[0m' % self._current_document.type +\
                              '  Nro.%04d' % int(self.EPROM['pv']) +\
                              '-%08d' % int(self._current_document.number))
@@ -170,23 +216,17 @@ class Hasar615(FiscalDriver):
         else:
             ct = _customer_type['C']
         self._print_out_line("A %s" % ct)
-        for i in [8, 9, 10]:
-            self._print_out_line(self.HEADERTRAILER[i])
-        self._print_separator()
-        self._print_out_line("CANTIDAD/PRECIO UNIT (% IVA)")
-        self._print_out_line("DESCRIPCION          [%B.I.]     IMPORTE")
-        self._print_separator()
+        self._print_block('items_header')
 
         self._customer_data = None
         self._can_add_item = True
 
-        return self.StatusRequest()
+        return self.status_fields()
 
     @command('\x41') # 'A'
     def PrintFiscalText(self, *params):
         text, display = params
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay un documento abierto")
+        self._check_fiscal_document()
 
         if len(self._fiscal_text) >= 3 or \
            (len(self._fiscal_text) >= 2 and self._current_document.type == 'T'):
@@ -194,13 +234,12 @@ class Hasar615(FiscalDriver):
 
         self._fiscal_text.append("%s" % text[:28])
 
-        return self.StatusRequest()
+        return self.status_fields()
 
     @command('\x42') # 'B'
     def PrintLineItem(self, *params):
 
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay documento abierto")
+        self._check_fiscal_document()
         if not self._can_add_item:
             raise NotValidCommandError(u"no se pueden agregar mas items")
         try:
@@ -211,19 +250,42 @@ class Hasar615(FiscalDriver):
         if iva == '**.**':
             return self.GeneralDiscount(desc, monto, signo, display, 'T')
 
-        item = FiscalItem(desc, Decimal(cantidad), Decimal(monto), Decimal(iva), signo, Decimal(k), total)
+        try:
+            cantidad = parse_quantity(cantidad)
+            monto = parse_amount(monto)
+            rate = parse_rate(iva)
+            k = parse_fixed(k, 8)
+        except ValueError:
+            raise NotValidDataError(u"campo numerico invalido (%s)" % (params,))
 
-        self._current_document.items.append(item)
+        if rate not in self._doc_iva and rate not in self._z_totals.iva and \
+           len(set(self._z_totals.iva) | set(self._doc_iva)) >= 10:
+            raise NotValidDataError(u"la tabla de IVA esta completa")
+
+        if total == 'T':
+            importe = line_amount(cantidad, monto)
+            neto = net_of(importe, rate)
+        else:
+            neto = line_amount(cantidad, monto)
+            importe = gross_of(neto, rate)
+        item = FiscalItem(desc, cantidad, monto, rate, signo, k, total,
+                          importe, importe - neto)
 
-        if item.total == 'T' and self._current_document.type == "A":
-            monto = item.monto / Decimal('1.21')
-        elif item.total != 'T' and self._current_document.type != "A":
-            monto = item.monto * Decimal('1.21')
+        self._current_document.items.append(item)
+        sign = -1 if signo == 'm' else 1
+        self._doc_total += sign * item.importe
+        self._doc_items += sign
+        self._doc_iva[rate] = self._doc_iva.get(rate, 0) + sign * item.impuesto
+
+        if self._current_document.type == "A":
+            unitario = net_of(monto, rate) if total == 'T' else monto
+            monto_linea = neto
         else:
-            monto = item.monto
+            unitario = monto if total == 'T' else gross_of(monto, rate)
+            monto_linea = importe
 
-        s = "%.3f / %.2f" % (item.cantidad, monto)
-        i = "(%05.2f)" % item.iva
+        s = "%s / %s" % (format_quantity(cantidad), format_amount(unitario))
+        i = "(%s)" % format_rate(rate).zfill(5)
         self._print_out_line(s.ljust(22) + i.ljust(18))
 
         for ft in self._fiscal_text:
@@ -231,19 +293,18 @@ class Hasar615(FiscalDriver):
         self._fiscal_text = []
 
         bi = " "*7
-        if float(item.k) != 0:
+        if item.k != 0:
             # TODO: imprimir (%B.I.) segun corresponda
             pass
 
         desc = "%s" % item.desc
-        monto_str = "%.2f" % (monto*item.cantidad)
+        monto_str = format_amount(monto_linea)
         self._print_out_line(desc.ljust(22) + bi.rjust(8) + monto_str.rjust(10))
-        return self.StatusRequest()
+        return self.status_fields()
 
     @command('\x54')
     def GeneralDiscount(self, *params):
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay documento abierto")
+        self._check_fiscal_document()
         if len(self._current_document.items) < 1:
             raise NotValidCommandError(u"no hubo una venta previa")
         try:
@@ -251,18 +312,35 @@ class Hasar615(FiscalDriver):
         except ValueError:
             raise NotValidDataError(u"cantidad de parametros incorrectos (%s)" % len(params))
 
-        item = DiscountItem(desc, Decimal(monto), signo, total)
+        try:
+            monto = parse_amount(monto)
+        except ValueError:
+            raise NotValidDataError(u"monto invalido (%s)" % monto)
+
+        subtotal = self._doc_total
+        if total != 'T':
+            # monto sin IVA: se lleva a precio final con la proporción del ticket
+            neto = subtotal - sum(self._doc_iva.values())
+            monto = div_round(monto * subtotal, neto) if neto else monto
+        item = DiscountItem(desc, monto, signo, total)
         self._current_document.items.append(item)
-        monto = "%-.2f" % (item.monto if item.signo == "M" else -item.monto)
+
+        # Apéndice 6.3: cada IVA acumulado varía en la misma proporción
+        sign = 1 if signo == "M" else -1
+        if subtotal:
+            for rate, acumulado in self._doc_iva.items():
+                self._doc_iva[rate] = acumulado + sign * div_round(acumulado * monto, subtotal)
+        self._doc_total += sign * monto
+
+        monto = format_amount(sign * item.monto)
         self._print_out_line(item.desc.ljust(30) + monto.rjust(10))
         self._can_add_item = False
 
-        return self.StatusRequest()
+        return self.status_fields()
 
     @command('\x43') # 'C'
     def Subtotal(self, *params):
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay documento abierto")
+        self._check_fiscal_document()
         try:
             imprimir, _, display = params
         except ValueError as e:
@@ -270,52 +348,170 @@ class Hasar615(FiscalDriver):
 
         total, items, iva = self._calcular_totales()
 
-        return self.StatusRequest() + (str(items), str(total), str(0), str(0), str(0), str(0))
+        return self.status_fields() + (str(items), format_amount(total),
+                format_amount(sum(iva.values())), format_amount(0),
+                format_amount(0), format_amount(0))
 
     @command('\x44') # 'D'
     def TotalTender(self, *params):
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay documento abierto")
+        self._check_fiscal_document()
 
         try:
             text, monto, op, display = params[:4]
         except ValueError as e:
             raise NotValidDataError(u"cantidad de parametros incorrectos (%s)" % len(params))
 
-        if op == 'T':
+        if op == 'C':
+            self._print_out_line("CANCELADO")
+            self.output.raw(CUT_END)
+            for totals in (self._z_totals, self._x_totals):
+                totals.add_cancelled(self._current_document.type)
+            self._clean_work_memory()
+            self._cancelled = True
+            return self.status_fields() + ("0.00",)
+        elif op == 'T':
             self._print_totals()
 
-            monto = Decimal(monto)
+            try:
+                monto = parse_amount(monto)
+            except ValueError:
+                raise NotValidDataError(u"monto invalido (%s)" % monto)
+            total, items, iva = self._calcular_totales()
             self._print_out_line("RECIBI/MOS")
-            self._print_out_line(("%s" % text).ljust(30) + ("%.2f" % monto).rjust(10))
-            return self.StatusRequest() + (str(0.0),)
+            self._print_out_line(("%s" % text).ljust(30) + format_amount(monto).rjust(10))
+            # resta pagar o, si los pagos superan el total, el vuelto
+            self._doc_paid += monto
+            return self.status_fields() + (format_amount(abs(total - self._doc_paid)),)
         else:
             raise NotImplementedCommand(u"esta opcion todavia no se implementa")
 
     @command('\x45') # 'E'
     def CloseFiscalReceipt(self, *params):
-        if self._current_document is None:
-            raise NotValidCommandError(u"no hay documento abierto")
+        self._check_fiscal_document()
 
         self._print_totals()
+        total, items, iva = self._calcular_totales()
 
-        for i in [11, 12, 13, 14]:
-            self._print_out_line(self.HEADERTRAILER[i])
-        self._print_out_line("\x1b[30;1m" + "  CF" + "\x1b[0m"+"      V: 01.02")
-        self._print_out_line("\x1b[30;1m" + " DGI" + "\x1b[0m"+"      Reg.:NNG0003137")
-
-        #print "\x1b[31m" + " fin ".center(40, "-") + "\x1b[0m"
-        print "\x1b[31m" + ">8------>8".center(40, "-") + "\x1b[0m"
+        self._print_block('trailer')
+        self.output.raw(CUT_END)
 
         self._last_number[self._current_document.type] = n = self._current_document.number
+        self._remember('last_number:%s' % self._current_document.type, n)
+        self._store_document(self._current_document.type, n)
+        for totals in (self._z_totals, self._x_totals):
+            totals.add_document(self._current_document.type, n, total, iva)
         # Reset some variables
         self._clean_work_memory()
 
-        return self.StatusRequest() + (str(n),)
+        return self.status_fields() + (str(n),)
+
+    @command('\x99')
+    def Reprint(self, *params):
+        if self._current_document is not None:
+            raise NotValidCommandError(u"existe un documento abierto")
+        if params:
+            try:
+                doc_type, number = params
+                number = int(number)
+            except ValueError:
+                raise NotValidDataError(u"parametros incorrectos (%s)" % (params,))
+            text = self.journal.get(doc_type, number) if self.journal else None
+            if text is None and self._last_document and \
+               self._last_document[:2] == (doc_type, number):
+                text = self._last_document[2]
+        else:
+            last = self.journal.last() if self.journal else self._last_document
+            text = last[2] if last else None
+        if text is None:
+            raise NotValidCommandError(u"no hay comprobante para reimprimir")
+
+        self.output.raw("\x1b[31m" + " REIMPRESION ".center(40, "-") + "\x1b[0m")
+        for line in text.split("\n"):
+            self._print_out_line(line)
+        self.output.raw(CUT_END)
+        return self.status_fields()
+
+    @command('\x48') # 'H'
+    def OpenNonFiscalReceipt(self, *params):
+        if self._current_document is not None:
+            raise NotValidCommandError(u"ya existe un documento abierto")
+        self._current_document = FiscalDocument(NON_FISCAL, None, [])
+        self._non_fiscal_lines = 0
+        self.output.raw(CUT_START)
+        self._print_block('header')
+        self.output.line(NON_FISCAL_LEGEND)
+        self._print_date_time()
+        self._print_separator()
+        return self.status_fields()
+
+    @command('\x49') # 'I'
+    def PrintNonFiscalText(self, *params):
+        if self._current_document is None or \
+           self._current_document.type != NON_FISCAL:
+            raise NotValidCommandError(u"no hay un comprobante no fiscal abierto")
+        text = params[0]
+        if self._non_fiscal_lines and self._non_fiscal_lines % 4 == 0:
+            self.output.line(NON_FISCAL_LEGEND)
+        # las líneas no se guardan: los informes largos no ocupan memoria
+        self.output.line(text[:40] or " ")
+        self._non_fiscal_lines += 1
+        return self.status_fields()
 
     @command('\x4a') # 'J'
     def CloseNonFiscalReceipt(self, *params):
-        return self.StatusRequest()
+        if self._current_document is None or \
+           self._current_document.type != NON_FISCAL:
+            raise NotValidCommandError(u"no hay un comprobante no fiscal abierto")
+        self._print_block('trailer')
+        self.output.raw(CUT_END)
+        for totals in (self._z_totals, self._x_totals):
+            totals.add_non_fiscal()
+        self._clean_work_memory()
+        return self.status_fields()
+
+    @command('\x3c') # '<'
+    def GetDailyReport(self, *params):
+        if self._current_document is not None:
+            raise NotValidCommandError(u"existe un documento abierto")
+        try:
+            value, kind = params
+            if kind == 'Z':
+                record = self._daily_record(number=int(value))
+            elif kind == 'F':
+                day = datetime.strptime(value, '%y%m%d')
+                record = self._daily_record(date=date_key(day))
+            else:
+                raise ValueError(kind)
+        except ValueError:
+            raise NotValidDataError(u"parametros incorrectos (%s)" % (params,))
+        if record is None:
+            raise NotValidDataError(u"no existe el registro diario (%s)" % (params,))
+        return self.status_fields() + tuple(record)
+
+    @command('\x3a') # ':'
+    def DailyCloseByDate(self, *params):
+        if self._current_document is not None:
+            raise NotValidCommandError(u"existe un documento abierto")
+        try:
+            start, end, detail = params
+            start = date_key(datetime.strptime(start, '%y%m%d'))
+            end = date_key(datetime.strptime(end, '%y%m%d'))
+        except ValueError:
+            raise NotValidDataError(u"parametros incorrectos (%s)" % (params,))
+        self._print_audit_report(self._daily_records_by_date(start, end), detail != 'T')
+        return self.status_fields()
+
+    @command('\x3b') # ';'
+    def DailyCloseByNumber(self, *params):
+        if self._current_document is not None:
+            raise NotValidCommandError(u"existe un documento abierto")
+        try:
+            first, last, detail = params
+            first, last = int(first), int(last)
+        except ValueError:
+            raise NotValidDataError(u"parametros incorrectos (%s)" % (params,))
+        self._print_audit_report(self._daily_records_by_number(first, last), detail != 'T')
+        return self.status_fields()
 
     @command('\x39') # '9'
     def DailyClose(self, *params):
@@ -325,115 +521,358 @@ class Hasar615(FiscalDriver):
             close_type, = params
         except ValueError as e:
             raise NotValidDataError(u"cantidad de parametros incorrectos (%s)" % len(params))
+        if close_type not in ('Z', 'X'):
+            raise NotValidDataError(u"tipo de cierre incorrecto (%s)" % close_type)
+
+        if close_type == 'Z':
+            self._z_number += 1
+            number, totals = self._z_number, self._z_totals
+        else:
+            self._x_number += 1
+            number, totals = self._x_number, self._x_totals
+
+        self._print_daily_report(close_type, number, totals)
+        reply = self._daily_report_fields(number, totals)
+
+        if close_type == 'Z':
+            self._store_daily_record(reply)
+        totals.reset()
+        if close_type == 'Z':
+            self._x_totals.reset()
+            self._remember('z_number', self._z_number)
+            if self.memory is not None:
+                self.memory.sync()
+        else:
+            self._remember('x_number', self._x_number)
 
-        print "DailyClose('%s') requested" % close_type
+        return self.status_fields() + reply
 
-        return self.StatusRequest()
+    def validate_params(self, symbol, params):
+        try:
+            self.schema.check(ord(symbol), params)
+        except host_schema.FieldError as e:
+            raise NotValidDataError(unicode(e))
 
     ## Internal Methods
 
+    def _daily_report_fields(self, number, totals):
+        amount = format_amount
+        return (
+            str(number),
+            str(totals.cancelled),
+            str(totals.dnfh),
+            str(totals.non_fiscal),
+            str(totals.fiscal_count),
+            "0",
+            str(self._last_number.get("B", 0)),
+            str(self._last_number.get("A", 0)),
+            amount(totals.gross),
+            amount(totals.total_iva),
+            amount(0), # impuestos internos
+            amount(0), # percepciones
+            amount(0), # IVA no inscripto
+            str(self._last_number.get("S", 0)),
+            str(self._last_number.get("R", 0)),
+            amount(totals.credit),
+            amount(totals.total_credit_iva),
+            amount(0),
+            amount(0),
+            amount(0),
+            "0",
+            str(totals.credit_cancelled),
+        )
+
+    def _store_daily_record(self, reply, day=None):
+        "Guarda en memoria fiscal el registro de la Z que devuelve GetDailyReport"
+        day = day or datetime.now().date()
+        number = int(reply[0])
+        # fecha, número y los acumulados del cierre (sin los contadores)
+        fields = (day.strftime('%y%m%d'),) + reply[:1] + reply[6:20]
+        if self.daily_records is not None:
+            self.daily_records.append(DAILY_RECORD, number, day,
+                                      symbols.FS.join(fields))
+        else:
+            self._daily_numbers.append(number)
+            self._daily_dates.append(date_key(day))
+            self._daily_fields.append(fields)
+
+    def _daily_record(self, number=None, date=None):
+        "Campos del registro de la Z `number` o de la primera Z de `date`"
+        if number is not None:
+            records = self._daily_records_by_number(number, number)
+        else:
+            records = self._daily_records_by_date(date, date)
+        for record in records:
+            return record
+        return None
+
+    def _daily_records_by_number(self, first, last):
+        if self.daily_records is not None:
+            return (text.split(symbols.FS) for number, date, text in
+                    self.daily_records.range(DAILY_RECORD, first, last))
+        return self._daily_records_between(self._daily_numbers, first, last)
+
+    def _daily_records_by_date(self, start, end):
+        if self.daily_records is not None:
+            return (text.split(symbols.FS) for number, date, text in
+                    self.daily_records.by_date(DAILY_RECORD, start, end))
+        return self._daily_records_between(self._daily_dates, start, end)
+
+    def _daily_records_between(self, keys, first, last):
+        i = bisect_left(keys, first)
+        while i < len(keys) and keys[i] <= last:
+            yield self._daily_fields[i]
+            i += 1
+
+    def _print_audit_report(self, records, detail):
+        amount = lambda v: format_amount(v).rjust(14)
+        self.output.raw(CUT_START)
+        self._print_out_line(self.EPROM['razon_social'])
+        self._print_out_line("C.U.I.T. Nro : %s" % self.EPROM['cuit'])
+        self._print_separator()
+        self._print_out_line("\xf4  AUDITORIA")
+        self._print_separator()
+        first = last = None
+        sold = iva = credit = 0
+        for record in records:
+            number, gross = int(record[1]), parse_amount(record[4])
+            if first is None:
+                first = record
+            last = record
+            sold += gross
+            iva += parse_amount(record[5])
+            credit += parse_amount(record[11])
+            if detail:
+                self._print_out_line(("Z %04d  %s-%s-%s" % (number, record[0][4:6],
+                                      record[0][2:4], record[0][:2])).ljust(26) + amount(gross))
+        if first is None:
+            self._print_out_line("SIN REGISTROS EN EL PERIODO")
+        else:
+            if detail:
+                self._print_separator()
+            self._print_out_line("Z %s a %s" % (first[1], last[1]))
+            self._print_out_line("VENTAS".ljust(26) + amount(sold))
+            self._print_out_line("IVA".ljust(26) + amount(iva))
+            self._print_out_line("NOTAS DE CREDITO".ljust(26) + amount(credit))
+        self.output.raw(CUT_END)
+
+    def _print_daily_report(self, close_type, number, totals):
+        amount = lambda v: format_amount(v).rjust(14)
+        self.output.raw(CUT_START)
+        self._print_out_line(self.EPROM['razon_social'])
+        self._print_out_line("C.U.I.T. Nro : %s" % self.EPROM['cuit'])
+        self._print_separator()
+        if close_type == 'Z':
+            self._print_out_line("\xf4  CIERRE Z  %04d" % number)
+        else:
+            self._print_out_line("\xf4  INFORME X  %04d" % number)
+        self._print_date_time()
+        self._print_separator()
+        self._print_out_line("DF emitidos".ljust(26) + str(totals.fiscal_count).rjust(14))
+        self._print_out_line("DF cancelados".ljust(26) + str(totals.cancelled).rjust(14))
+        self._print_out_line("DNF emitidos".ljust(26) + str(totals.non_fiscal).rjust(14))
+        for doc_type in sorted(totals.counts):
+            self._print_out_line(("  Tipo %s  %08d a %08d" % (doc_type,
+                                  totals.first[doc_type], totals.last[doc_type])).ljust(40))
+        self._print_separator()
+        self._print_out_line("VENTAS".ljust(26) + amount(totals.gross))
+        for rate in sorted(totals.iva):
+            self._print_out_line(("IVA %s %%" % format_rate(rate)).ljust(26) +
+                                 amount(totals.iva[rate]))
+        if totals.credit:
+            self._print_out_line("NOTAS DE CREDITO".ljust(26) + amount(totals.credit))
+            for rate in sorted(totals.credit_iva):
+                self._print_out_line(("IVA %s %%" % format_rate(rate)).ljust(26) +
+                                     amount(totals.credit_iva[rate]))
+        self.output.raw(CUT_END)
+
     def _print_totals(self):
         if not self._total_printed:
             self._total_printed = True
             total, items, iva = self._calcular_totales()
 
             if self._current_document.type == "A":
-                neto = "%.2f" % (total/Decimal('1.21'),)
-                iva_str = "%.2f" % iva
-                print
+                neto = format_amount(total - sum(iva.values()))
+                self.output.raw()
                 self._print_out_line("NETO SIN IVA".ljust(30) + neto.rjust(10))
-                self._print_out_line("IVA 21.00 %".ljust(30) + iva_str.rjust(10))
-            print
-            self._print_out_line("\xf4TOTAL" + (" %.2f" % total).rjust(15))
+                for rate in sorted(iva):
+                    self._print_out_line(("IVA %s %%" % format_rate(rate)).ljust(30) +
+                                         format_amount(iva[rate]).rjust(10))
+            self.output.raw()
+            self._print_out_line("\xf4TOTAL" + (" %s" % format_amount(total)).rjust(15))
 
     def _calcular_totales(self):
+        """
+        Total (centavos), cantidad de ítems y {alícuota: IVA} del documento.
+
+        Los acumuladores se actualizan con cada ítem o descuento, por lo que
+        no se recorre el documento.
+        """
         assert self._current_document is not None, u"BUG! no hay documento abierto"
-        total = Decimal(0)
-        iva = Decimal(0)
-        items_count = 0
-
-        for item in self._current_document.items:
-            if item.total == 'T':
-                iiva = (item.monto/Decimal('1.21')) * Decimal('0.21')
-                monto = item.monto
-            else:
-                iiva = (item.monto*Decimal('0.21'))
-                monto = item.monto * Decimal('1.21')
-
-            if isinstance(item, FiscalItem):
-                if item.signo == 'M':
-                    total += item.cantidad * monto
-                    items_count += 1
-                    iva += iiva * item.cantidad
-                elif item.signo == 'm':
-                    total -= item.cantidad * monto
-                    items_count -= 1
-                    iva -= iiva * item.cantidad
-            elif isinstance(item, DiscountItem):
-                if item.signo == 'M':
-                    total += item.monto
-                    iva += iiva
-                elif item.signo == 'm':
-                    total -= item.monto
-                    iva -= iiva
-
-        return total, items_count, iva
+        return self._doc_total, self._doc_items, dict(self._doc_iva)
 
     def _print_out_line(self, message, align='left'):
-        time.sleep(0.02)
-        if message:
-            if message[0] == '\xf4':
-                message = '\x1b[;1m%s\x1b[0m' % (" "+" ".join(list(message[1:]))[:40])
-            if align == 'left':
-                print message.ljust(40)
-            elif align == 'right':
-                print message.rjust(40)
-            else: # center
-                print message.center(40)
-        sys.stdout.flush()
+        if self._current_document is not None:
+            self._rendered.append(message.rjust(40) if align == 'right' else message)
+        self.output.line(message, align)
+
+    def _print_block(self, name):
+        """
+        Imprime un bloque fijo del comprobante (encabezado, cola) de una vez.
+
+        Los bloques se arman una sola vez y se vuelven a armar sólo cuando
+        cambia alguna línea de encabezado/cola (SetHeaderTrailer).
+        """
+        lines = self._blocks.get(name)
+        if lines is None:
+            lines = self._blocks[name] = getattr(self, '_%s_lines' % name)()
+        if self._current_document is not None:
+            self._rendered.extend(lines)
+        self.output.lines(lines)
+
+    def _header_lines(self):
+        return [self.FANTASY[i] for i in [1, 2]] + [
+            self.EPROM['razon_social'],
+            "C.U.I.T. Nro : %s" % self.EPROM['cuit'],
+            " INGRESOS BRUTOS : %s" % self.EPROM['ib'],
+        ] + [self.HEADERTRAILER[i] for i in [1, 2, 3, 4]] + [
+            "INICIO DE ACTIVIDADES : %s" % self.EPROM['inicio'],
+            "IVA RESPONSABLE INSCRIPTO",
+        ] + [self.HEADERTRAILER[i] for i in [5, 6, 7]] + [SEPARATOR]
+
+    def _items_header_lines(self):
+        return [self.HEADERTRAILER[i] for i in [8, 9, 10]] + [
+            SEPARATOR,
+            "CANTIDAD/PRECIO UNIT (% IVA)",
+            "DESCRIPCION          [%B.I.]     IMPORTE",
+            SEPARATOR,
+        ]
+
+    def _trailer_lines(self):
+        return [self.HEADERTRAILER[i] for i in [11, 12, 13, 14]] + [
+            "\x1b[30;1m" + "  CF" + "\x1b[0m"+"      V: 01.02",
+            "\x1b[30;1m" + " DGI" + "\x1b[0m"+"      Reg.:NNG0003137",
+        ]
 
     def _print_separator(self):
-        print "-"*40
+        if self._current_document is not None:
+            self._rendered.append("-"*40)
+        self.output.raw("-"*40)
 
     def _print_date_time(self):
         now = datetime.now()
         self._print_out_line("Fecha : %s" % now.date().strftime('%d-%m-%y'), align="right")
         self._print_out_line("Hora  : %s" % now.time().strftime('%H:%M:%S'), align="right")
 
-    def _init_memory(self):
-        self.HEADERTRAILER = config['HEADERTRAILER']
+    def close(self):
+        self.output.close()
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.daily_records is not None:
+            self.daily_records.close()
+            self.daily_records = None
+
+    def _init_memory(self, persistent=True):
+        """Memoria fiscal y cinta testigo según config; con `persistent`
+        falso todo queda en RAM aunque haya rutas configuradas."""
+        self.HEADERTRAILER = dict(config['HEADERTRAILER'])
         self.FANTASY = config['FANTASY']
         self.EPROM = config['EPROM']
 
+        self.memory = None
+        self.daily_records = None
+        opts = config['MEMORY']
+        if persistent and opts['path']:
+            self.memory = FiscalMemory(opts['path'],
+                    sync_every=opts['sync_every'],
+                    sync_interval=opts['sync_interval'],
+                    max_journal=opts['max_journal'])
+            # registros diarios: uno por Z, indexados por número y fecha
+            self.daily_records = ElectronicJournal(
+                    os.path.join(opts['path'], 'daily'))
+        # sin memoria en disco los registros diarios se guardan en RAM
+        self._daily_numbers, self._daily_dates, self._daily_fields = [], [], []
+
+        self._last_number = {
+            "A": self._recall('last_number:A', self.EPROM['last_counter_A']),
+            "B": self._recall('last_number:B', self.EPROM['last_counter_B']),
+        }
+        self._z_number = self._recall('z_number', self.EPROM['last_z'])
+        self._x_number = self._recall('x_number', self.EPROM['last_x'])
+
+        self.journal = None
+        self._last_document = None
+        opts = config['JOURNAL']
+        if persistent and opts['path']:
+            # la cinta se busca por número: sin memoria persistente los
+            # números vuelven a empezar en cada arranque
+            if self.memory is None:
+                raise ValueError(u"la cinta testigo requiere memoria fiscal "
+                                 u"persistente (config['MEMORY']['path'])")
+            self.journal = ElectronicJournal(opts['path'],
+                    segment_size=opts['segment_size'])
+
+        self._z_totals = DailyTotals('z:', self.memory)
+        self._x_totals = DailyTotals('x:', self.memory)
+        for lineno in self.HEADERTRAILER:
+            key = 'header:%d' % lineno
+            self.HEADERTRAILER[lineno] = self._recall(key, self.HEADERTRAILER[lineno])
+
+    def _recall(self, key, default):
+        if self.memory is None:
+            return default
+        return self.memory.get(key, default)
+
+    def _remember(self, key, value):
+        if self.memory is not None:
+            self.memory.set(key, value)
+
+    def _store_document(self, doc_type, number):
+        text = "\n".join(self._rendered)
+        self._last_document = doc_type, number, text
+        if self.journal is not None:
+            self.journal.append(doc_type, number, datetime.now(), text)
+
+    def _check_fiscal_document(self):
+        "Los comandos de un comprobante fiscal no valen en uno no fiscal"
+        if self._current_document is None or \
+           self._current_document.type == NON_FISCAL:
+            raise NotValidCommandError(u"no hay documento fiscal abierto")
+
+    def _aux_status(self):
+        "Apéndice 4: 2 sin comprobante, 3 fiscal abierto, 5 no fiscal abierto"
+        if self._current_document is None:
+            return 2
+        if self._current_document.type == NON_FISCAL:
+            return 5
+        return 3
+
+    def _document_status(self):
+        "Apéndice 5: tipo de comprobante abierto o si se canceló el anterior"
+        if self._current_document is None:
+            return "0001" if self._cancelled else "0000"
+        return "%02X00" % _document_codes.get(self._current_document.type, 0)
+
     def _clean_work_memory(self):
         self._customer_data = None
         self._fiscal_text = []
         self._current_document = None
+        self._rendered = []
+        self._doc_total = 0
+        self._doc_items = 0
+        self._doc_iva = {}
+        self._doc_paid = 0
         self._can_add_item = False
         self._total_printed = False
+        self._cancelled = False
 
     def _validate_cuit(self, cuit):
         """Validar CUIT:
         Devuelve `True` si el CUIT tiene la longitud, el formato correcto y su
-        dígito verificador esta OK.
-        from: http://python.org.ar/pyar/Recetario/ValidarCuit
+        dígito verificador esta OK (ver driver/cuit.py, compartido con el host).
         """
-        # validaciones mínimas
-        if len(cuit) != 11:
-            return False
-
-        base = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
-
-        # calculo el dígito verificador
-        aux = 0
-        for i in xrange(10):
-            aux += int(cuit[i]) * base[i]
-
-        aux = 11 - (aux-(int(aux/11)*11))
-
-        if aux == 11:
-            aux = 0
-        if aux == 10:
-            aux = 9
-
-        return aux == int(cuit[10])
+        return host_cuit.is_valid(cuit)
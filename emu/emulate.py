@@ -3,12 +3,16 @@
 
 import sys
 import time
+import signal
+from optparse import OptionParser
 
 from wrapper import CommunicationWrapper
 from drivers.base import FiscalDriver
 from drivers.hasar import Hasar615
+from config import config
+from profiler import CommandProfiler
 
-def main(tty_name, debug=False):
+def main(tty_name, debug=False, profile=None, use_cprofile=False, sample=None):
 
     try:
         tty = open(tty_name, "r+", 0)
@@ -17,16 +21,55 @@ def main(tty_name, debug=False):
         raise SystemExit(0)
 
     comm = CommunicationWrapper(port=tty, driver=Hasar615, debug=debug)
+    profiler = None
+    if profile:
+        profiler = CommandProfiler(use_cprofile, sample).attach(comm)
+        # kill -USR1 <pid> escribe el perfil sin detener el emulador
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump(profile))
     try:
         comm.loop()
     except KeyboardInterrupt as k:
         sys.exit(0)
     finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.dump(profile)
+        comm.driver.close()
         tty.close()
 
 if __name__ == '__main__':
-    debug = False
-    if "-d" in sys.argv:
-        debug = True
-        sys.argv.remove("-d")
-    main(sys.argv[1], debug)
+    parser = OptionParser(usage="%prog [options] tty")
+    parser.add_option("-d", dest="debug", action="store_true", default=False,
+                      help="print every command and its result")
+    parser.add_option("-m", "--memory", dest="memory", metavar="DIR",
+                      help="keep the fiscal memory in DIR across restarts")
+    parser.add_option("-j", "--journal", dest="journal", metavar="DIR",
+                      help="store every issued document in DIR for reprints")
+    parser.add_option("-q", "--quiet", dest="terminal", action="store_false",
+                      default=True, help="do not print receipts on the terminal")
+    parser.add_option("-o", "--output", dest="text", metavar="FILE",
+                      help="append printed receipts to FILE as plain text")
+    parser.add_option("--jsonl", dest="jsonl", metavar="FILE",
+                      help="append printed lines to FILE as JSON records")
+    parser.add_option("--profile", dest="profile", metavar="DIR",
+                      help="time every command by phase and write the results "
+                           "to DIR on exit or on SIGUSR1")
+    parser.add_option("--cprofile", dest="cprofile", action="store_true",
+                      default=False, help="with --profile, also run cProfile")
+    parser.add_option("--sample", dest="sample", type="float", metavar="MS",
+                      help="with --profile, sample stacks every MS of CPU time "
+                           "into a collapsed stacks file")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("tty is required")
+    if options.journal and not options.memory:
+        parser.error("--journal requires --memory: without it document "
+                     "numbers restart and the journal can't be searched")
+    if options.memory:
+        config['MEMORY']['path'] = options.memory
+    if options.journal:
+        config['JOURNAL']['path'] = options.journal
+    config['OUTPUT'].update(terminal=options.terminal, text=options.text,
+                            jsonl=options.jsonl)
+    main(args[0], options.debug, options.profile, options.cprofile,
+         options.sample and options.sample / 1000.0)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Proxy con inyección de fallas entre el driver del host y el emulador
+
+    host, comm, proxy = start_faulty_emulator(Faults(corrupt=0.05, drop=0.01))
+
+Cada sentido se copia trama por trama (STX ... ETX BCC, o un carácter de
+control suelto) y a cada una se le puede aplicar, con la probabilidad
+indicada en `Faults`:
+
+- corrupt:   cambiar un byte del contenido (el BCC deja de coincidir)
+- drop:      descartar la trama
+- duplicate: enviarla dos veces
+- jitter:    demorarla entre 0 y `jitter` segundos
+- stall:     detener el sentido durante `stall_time` segundos
+"""
+
+import random
+import threading
+import time
+from collections import namedtuple
+
+from loopback import loopback_pair, run_emulator
+from drivers.hasar import Hasar615
+from utils import symbols as s
+
+_faults = ('corrupt', 'drop', 'duplicate', 'jitter', 'stall')
+
+class Faults(namedtuple("Faults", _faults + ('stall_time', 'seed'))):
+
+    def __new__(cls, corrupt=0, drop=0, duplicate=0, jitter=0, stall=0,
+                stall_time=0.5, seed=None):
+        return super(Faults, cls).__new__(cls, corrupt, drop, duplicate,
+                                          jitter, stall, stall_time, seed)
+
+
+class _Pump(object):
+    "Copia las tramas de `src` a `dst` aplicando las fallas"
+
+    def __init__(self, name, src, dst, faults, rnd):
+        self.name = name
+        self.src = src
+        self.dst = dst
+        self.faults = faults
+        self.rnd = rnd
+        self.stats = dict.fromkeys(('frames', 'bytes') + _faults, 0)
+        self.thread = threading.Thread(target=self._run, name="faults-" + name)
+        self.thread.daemon = True
+
+    def _frames(self):
+        while True:
+            c = self.src.read(1)
+            if not c:
+                continue
+            if c != s.STX:
+                yield c
+                continue
+            frame = [c]
+            while c != s.ETX:
+                c = self.src.read(1)
+                frame.append(c)
+            frame.append(self.src.read(4))
+            yield "".join(frame)
+
+    def _corrupt(self, frame):
+        if len(frame) < 6:
+            # carácter de control: se reemplaza por uno desconocido
+            return '\x00'
+        i = self.rnd.randrange(1, len(frame) - 5)
+        c = frame[i]
+        while c in (frame[i], s.STX, s.ETX):
+            c = chr(ord(frame[i]) ^ self.rnd.randint(1, 0x7f))
+        return frame[:i] + c + frame[i+1:]
+
+    def _run(self):
+        f, rnd, stats = self.faults, self.rnd, self.stats
+        try:
+            for frame in self._frames():
+                stats['frames'] += 1
+                stats['bytes'] += len(frame)
+                if f.stall and rnd.random() < f.stall:
+                    stats['stall'] += 1
+                    time.sleep(f.stall_time)
+                if f.jitter:
+                    stats['jitter'] += 1
+                    time.sleep(rnd.uniform(0, f.jitter))
+                if f.drop and rnd.random() < f.drop:
+                    stats['drop'] += 1
+                    continue
+                if f.corrupt and rnd.random() < f.corrupt:
+                    stats['corrupt'] += 1
+                    frame = self._corrupt(frame)
+                self.dst.write(frame)
+                if f.duplicate and rnd.random() < f.duplicate:
+                    stats['duplicate'] += 1
+                    self.dst.write(frame)
+        except IOError:
+            # uno de los extremos se cerró
+            self.src.close()
+            self.dst.close()
+
+
+class FaultProxy(object):
+    """
+    Une dos pares en memoria: host <-> proxy <-> emulador.
+
+    `stats` tiene los contadores por sentido ('to_emulator', 'to_host').
+    """
+
+    def __init__(self, host_side, emulator_side, faults):
+        rnd = random.Random(faults.seed)
+        self.faults = faults
+        self.pumps = [
+            _Pump('to_emulator', host_side, emulator_side, faults,
+                  random.Random(rnd.random())),
+            _Pump('to_host', emulator_side, host_side, faults,
+                  random.Random(rnd.random())),
+        ]
+
+    @property
+    def stats(self):
+        return dict((p.name, dict(p.stats)) for p in self.pumps)
+
+    def start(self):
+        for pump in self.pumps:
+            pump.thread.start()
+        return self
+
+    def join(self, timeout=None):
+        "Espera a que terminen los hilos (al cerrar el puerto del host)"
+        for pump in self.pumps:
+            pump.thread.join(timeout)
+
+
+def start_faulty_emulator(faults, driver=Hasar615, baudrate=None, timeout=0.05):
+    """
+    Como loopback.start_emulator() pero con un FaultProxy en el medio.
+
+    Devuelve (puerto del host, wrapper, proxy). El puerto del host tiene
+    `timeout` para que el driver pueda detectar las tramas perdidas.
+    """
+    host, proxy_host = loopback_pair(baudrate, timeout)
+    proxy_emulator, port = loopback_pair(baudrate)
+    proxy = FaultProxy(proxy_host, proxy_emulator, faults).start()
+    return host, run_emulator(port, driver), proxy
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Módulos del driver del host que comparte el emulador
+
+schema.py y cuit.py sólo usan la biblioteca estándar justamente para que
+el emulador valide igual que el host. Se cargan desde driver/ por su ruta
+y con un nombre propio (host_schema, host_cuit), sin tocar sys.path: así
+no tapan a los módulos del emulador ni se confunden con otros homónimos.
+"""
+
+import os
+import sys
+import imp
+
+DRIVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "driver")
+
+def load(name):
+    "El módulo `name` de driver/, cargado una sola vez"
+    key = "host_" + name
+    if key not in sys.modules:
+        imp.load_source(key, os.path.join(DRIVER_DIR, name + ".py"))
+    return sys.modules[key]
+
+schema = load("schema")
+cuit = load("cuit")
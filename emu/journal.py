@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import mmap
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+def date_key(d):
+    "date/datetime o entero AAAAMMDD -> entero AAAAMMDD"
+    if isinstance(d, (int, long)):
+        return d
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+class _Segment(object):
+    """
+    Segmento cerrado: archivo de datos y su índice ordenado por (tipo, número).
+
+    Por cada tipo sólo se guardan en RAM los límites de su rango en el índice
+    y el primer/último número y fecha; las búsquedas dentro del segmento son
+    binarias sobre el índice mapeado con mmap.
+    """
+
+    def __init__(self, journal, seq):
+        self.journal = journal
+        self.seq = seq
+        self.types = {}
+        index = journal._open_index(seq)
+        count = len(index) // _entry.size
+        i = 0
+        while i < count:
+            doc_type = index[i * _entry.size]
+            j = self._type_end(index, doc_type, i, count)
+            first = _entry.unpack_from(index, i * _entry.size)
+            last = _entry.unpack_from(index, (j - 1) * _entry.size)
+            self.types[doc_type] = (i, j, first[1], last[1], first[2], last[2])
+            i = j
+
+    def _type_end(self, index, doc_type, lo, hi):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index[mid * _entry.size] > doc_type:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _find(self, doc_type, value, field, side):
+        lo, hi = self.types[doc_type][:2]
+        index = self.journal._open_index(self.seq)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = _entry.unpack_from(index, mid * _entry.size)[field]
+            if v < value or (side == 'right' and v == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entries(self, doc_type, value_from, value_to, field):
+        "(número, fecha, offset) con value_from <= campo <= value_to"
+        if doc_type not in self.types:
+            return
+        index = self.journal._open_index(self.seq)
+        lo = self._find(doc_type, value_from, field, 'left')
+        hi = self._find(doc_type, value_to, field, 'right')
+        for i in xrange(lo, hi):
+            entry = _entry.unpack_from(index, i * _entry.size)
+            yield entry[1], entry[2], entry[3]
+
+
+_record = struct.Struct("<cIII")    # tipo, número, fecha, longitud del texto
+_entry = struct.Struct("<cIII")     # tipo, número, fecha, offset en el segmento
+
+
+class ElectronicJournal(object):
+    """
+    Cinta testigo electrónica del emulador
+
+    Guarda el texto de cada comprobante emitido en segmentos de hasta
+    `segment_size` bytes. Al cerrarse un segmento se escribe su índice
+    ordenado por (tipo, número); como los números y fechas de un mismo tipo
+    son crecientes, la búsqueda por número o por fecha es O(log n) sin
+    mantener en memoria más que el segmento activo y un resumen por segmento.
+    Se asume que el reloj del emulador no retrocede; un número que no es
+    mayor que el último de su tipo se rechaza (ValueError), porque dejaría
+    la cinta desordenada.
+    """
+
+    def __init__(self, path, segment_size=4<<20, max_open=16):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_open = max_open
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._open = OrderedDict()
+        self._segments = []
+        self._bounds = {}       # tipo -> [(último número, última fecha, segmento)]
+
+        seqs = sorted(int(os.path.basename(f)[:-4])
+                      for f in glob.glob(os.path.join(path, "*.dat")))
+        for seq in seqs[:-1]:
+            self._add_segment(seq)
+        self._load_active(seqs[-1] if seqs else 0)
+
+    ## Public API
+
+    def append(self, doc_type, number, date, text):
+        last = self._last_number(doc_type)
+        if last is not None and number <= last:
+            raise ValueError(u"comprobante %s %d fuera de orden (el último es "
+                             u"el %d)" % (doc_type, number, last))
+        if self._size >= self.segment_size:
+            self._seal()
+        date = date_key(date)
+        record = _record.pack(doc_type, number, date, len(text)) + text
+        offset = self._size
+        self._data.write(record)
+        self._data.flush()
+        self._size += len(record)
+        numbers, dates, offsets = self._active.setdefault(doc_type, ([], [], []))
+        numbers.append(number)
+        dates.append(date)
+        offsets.append(offset)
+        self._last = doc_type, number
+
+    def get(self, doc_type, number):
+        "Texto del comprobante o None si no está en la cinta"
+        for number, date, text in self.range(doc_type, number, number):
+            return text
+        return None
+
+    def last(self):
+        "(tipo, número, texto) del último comprobante guardado, o None"
+        if self._last is None:
+            return None
+        doc_type, number = self._last
+        return doc_type, number, self.get(doc_type, number)
+
+    def range(self, doc_type, first, last):
+        "Genera (número, fecha, texto) con first <= número <= last"
+        return self._query(doc_type, first, last, 1)
+
+    def by_date(self, doc_type, start, end):
+        "Genera (número, fecha, texto) emitidos entre las fechas start y end"
+        return self._query(doc_type, date_key(start), date_key(end), 2)
+
+    def close(self):
+        self._data.close()
+        self._reader.close()
+        for data, index, mm in self._open.values():
+            if mm:
+                mm.close()
+            index.close()
+            data.close()
+        self._open.clear()
+
+    ## Internal Methods
+
+    def _query(self, doc_type, value_from, value_to, field):
+        bounds = self._bounds.get(doc_type, [])
+        keys = [b[field - 1] for b in bounds]
+        for n in xrange(bisect_left(keys, value_from), len(bounds)):
+            segment = bounds[n][2]
+            if segment.types[doc_type][2 * field] > value_to:
+                return
+            for number, date, offset in segment.entries(doc_type, value_from,
+                                                        value_to, field):
+                yield number, date, self._read(segment.seq, offset)
+
+        if doc_type not in self._active:
+            return
+        columns = self._active[doc_type]
+        values = columns[field - 1]
+        lo = bisect_left(values, value_from)
+        hi = bisect_right(values, value_to)
+        for i in xrange(lo, hi):
+            yield (columns[0][i], columns[1][i],
+                   self._read(self._seq, columns[2][i]))
+
+    def _last_number(self, doc_type):
+        if doc_type in self._active:
+            return self._active[doc_type][0][-1]
+        if doc_type in self._bounds:
+            return self._bounds[doc_type][-1][0]
+        return None
+
+    def _read(self, seq, offset):
+        if seq == self._seq:
+            f = self._reader
+        else:
+            f = self._open_segment(seq)[0]
+        f.seek(offset)
+        doc_type, number, date, length = _record.unpack(f.read(_record.size))
+        return f.read(length)
+
+    def _filename(self, seq, ext):
+        return os.path.join(self.path, "%06d.%s" % (seq, ext))
+
+    def _open_segment(self, seq):
+        if seq in self._open:
+            self._open[seq] = files = self._open.pop(seq)
+            return files
+        if len(self._open) >= self.max_open:
+            old_seq, (data, index, mm) = self._open.popitem(last=False)
+            if mm:
+                mm.close()
+            index.close()
+            data.close()
+        data = open(self._filename(seq, "dat"), "rb")
+        index = open(self._filename(seq, "idx"), "rb")
+        if os.fstat(index.fileno()).st_size:
+            mm = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            mm = ""
+        self._open[seq] = files = (data, index, mm)
+        return files
+
+    def _open_index(self, seq):
+        return self._open_segment(seq)[2]
+
+    def _add_segment(self, seq):
+        if not os.path.exists(self._filename(seq, "idx")):
+            # la caída ocurrió antes de escribir el índice
+            self._write_index(seq, self._scan(seq))
+        segment = _Segment(self, seq)
+        self._segments.append(segment)
+        for doc_type, info in segment.types.iteritems():
+            self._bounds.setdefault(doc_type, []).append(
+                    (info[3], info[5], segment))
+
+    def _scan(self, seq):
+        "Lee los registros de un segmento, descartando uno incompleto al final"
+        entries = {}
+        offset = 0
+        last = None
+        with open(self._filename(seq, "dat"), "rb") as f:
+            data = f.read()
+        while offset + _record.size <= len(data):
+            doc_type, number, date, length = _record.unpack_from(data, offset)
+            end = offset + _record.size + length
+            if end > len(data):
+                break
+            numbers, dates, offsets = entries.setdefault(doc_type, ([], [], []))
+            numbers.append(number)
+            dates.append(date)
+            offsets.append(offset)
+            last = doc_type, number
+            offset = end
+        return entries, offset, last
+
+    def _write_index(self, seq, scanned):
+        entries = scanned[0]
+        tmp = self._filename(seq, "idx.tmp")
+        with open(tmp, "wb") as f:
+            for doc_type in sorted(entries):
+                for number, date, offset in zip(*entries[doc_type]):
+                    f.write(_entry.pack(doc_type, number, date, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._filename(seq, "idx"))
+
+    def _load_active(self, seq):
+        self._seq = seq
+        filename = self._filename(seq, "dat")
+        self._active, self._size, self._last = {}, 0, None
+        if os.path.exists(filename):
+            self._active, self._size, self._last = self._scan(seq)
+            with open(filename, "r+b") as f:
+                f.truncate(self._size)
+        if self._last is None and self._segments:
+            self._last = self._scan(self._segments[-1].seq)[2]
+        self._data = open(filename, "ab")
+        self._reader = open(filename, "rb")
+
+    def _seal(self):
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._data.close()
+        self._reader.close()
+        self._write_index(self._seq, (self._active, self._size, self._last))
+        self._add_segment(self._seq)
+        self._seq += 1
+        self._active, self._size = {}, 0
+        filename = self._filename(self._seq, "dat")
+        self._data = open(filename, "ab")
+        self._reader = open(filename, "rb")
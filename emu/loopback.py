@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Puerto serie en memoria entre el driver del host y el emulador
+
+Reemplaza al par de ptys de socat (init_socat.sh) cuando ambos extremos
+corren en el mismo proceso:
+
+    host, comm = start_emulator()
+    printer = driver.FiscalDriver(host)     # acepta un puerto ya abierto
+
+Cada sentido es un buffer con una condición; los bytes escritos por un
+extremo quedan disponibles para el otro sin pasar por el sistema operativo.
+Con `baudrate` se simula el tiempo de transmisión (10 bits por byte).
+"""
+
+import threading
+import time
+
+from wrapper import CommunicationWrapper
+from drivers.hasar import Hasar615
+
+
+class _Channel(object):
+    "Un sentido de la comunicación"
+
+    def __init__(self, baudrate=None):
+        self.byte_time = 10.0 / baudrate if baudrate else 0
+        self._buffer = bytearray()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._available_at = 0      # fin de la transmisión simulada
+
+    def write(self, data):
+        with self._cond:
+            if self._closed:
+                raise IOError("loopback port closed")
+            if self.byte_time:
+                now = time.time()
+                self._available_at = max(now, self._available_at) + \
+                                     len(data) * self.byte_time
+            self._buffer.extend(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while len(self._buffer) < size and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._closed and not self._buffer:
+                raise IOError("loopback port closed")
+            delay = self._available_at - time.time()
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+    def waiting(self):
+        with self._cond:
+            return len(self._buffer)
+
+    def clear(self):
+        with self._cond:
+            del self._buffer[:]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class LoopbackPort(object):
+    """
+    Extremo de un par en memoria con la interfaz de serial.Serial que usan
+    driver.FiscalDriver y CommunicationWrapper (read, write, flush, close).
+    """
+
+    def __init__(self, rx, tx, timeout=None, name="loopback"):
+        self._rx = rx
+        self._tx = tx
+        self.timeout = timeout
+        self.name = name
+        self.is_open = True
+
+    def read(self, size=1):
+        return self._rx.read(size, self.timeout)
+
+    def write(self, data):
+        return self._tx.write(data)
+
+    def flush(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        return self._rx.waiting()
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        # el otro extremo ve el puerto cerrado al vaciar lo pendiente
+        self.is_open = False
+        self._rx.close()
+        self._tx.close()
+
+    def __repr__(self):
+        return "<LoopbackPort %s>" % self.name
+
+
+def loopback_pair(baudrate=None, timeout=None):
+    "(extremo del host, extremo del emulador)"
+    to_emulator = _Channel(baudrate)
+    to_host = _Channel(baudrate)
+    host = LoopbackPort(to_host, to_emulator, timeout, "host")
+    emulator = LoopbackPort(to_emulator, to_host, None, "emulator")
+    return host, emulator
+
+
+def start_emulator(driver=Hasar615, baudrate=None, timeout=None, debug=False):
+    """
+    Arranca el emulador en un hilo sobre un par en memoria.
+
+    Devuelve (puerto del host, wrapper). Al cerrar el puerto del host el
+    hilo del emulador termina.
+    """
+    host, port = loopback_pair(baudrate, timeout)
+    return host, run_emulator(port, driver, debug)
+
+def run_emulator(port, driver=Hasar615, debug=False):
+    "CommunicationWrapper.loop() sobre `port` en un hilo (comm.thread)"
+    comm = CommunicationWrapper(port=port, driver=driver, debug=debug)
+    comm.thread = threading.Thread(target=_serve, args=(comm,), name="emulator")
+    comm.thread.daemon = True
+    comm.thread.start()
+    return comm
+
+def _serve(comm):
+    try:
+        comm.loop()
+    except (SystemExit, IOError):
+        pass
+    finally:
+        comm.driver.close()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+class FiscalMemoryError(Exception):
+    "Base exception for FiscalMemory errors"
+
+
+class FiscalMemory(object):
+    """
+    Memoria fiscal persistente del emulador
+
+    Guarda pares clave/valor (números de comprobante, contadores de Z, líneas
+    de encabezado y cola) en un directorio con dos archivos:
+
+    - journal.log: registros agregados al final con su longitud y CRC32,
+      cada cambio se escribe directamente al archivo (sobrevive a la caída
+      del proceso) y se hace fsync por lotes, cada `sync_every` registros o
+      `sync_interval` segundos.
+    - memory.idx: tabla de slots de tamaño fijo mapeada con mmap, con el
+      último valor de cada clave al momento del último checkpoint.
+
+    Cuando el journal supera `max_journal` bytes se vuelcan a la tabla sólo
+    los slots modificados y el journal se trunca, por lo que el arranque lee
+    a lo sumo la tabla y `max_journal` bytes de journal.
+    """
+
+    JOURNAL = "journal.log"
+    INDEX = "memory.idx"
+    MAGIC = "HFM1"
+    SLOTS = 256
+
+    _header = struct.Struct("<4sI")       # magic, slots used
+    _slot = struct.Struct("<24scB54s")    # key, type, value length, value
+    _record = struct.Struct("<HI")        # payload length, crc32
+
+    def __init__(self, path, sync_every=32, sync_interval=1.0,
+                 max_journal=1<<20):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.max_journal = max_journal
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._values = {}
+        self._slots = {}
+        self._dirty = set()
+        self._pending = 0
+        self._last_sync = time.time()
+
+        self._open_index()
+        self._replay_journal()
+
+    ## Public API
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def items(self):
+        return self._values.items()
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        changed = False
+        for key, value in values.iteritems():
+            if self._values.get(key) == value:
+                continue
+            self._append(key, value)
+            changed = True
+        if not changed:
+            return
+        if self._pending >= self.sync_every or \
+           time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+        if self._journal_size >= self.max_journal:
+            self.checkpoint()
+
+    def sync(self):
+        "Flush pending journal records to disk"
+        if self._pending:
+            os.fsync(self._journal)
+            self._pending = 0
+        self._last_sync = time.time()
+
+    def checkpoint(self):
+        "Dump modified keys to the index and truncate the journal"
+        for key in self._dirty:
+            self._write_slot(key, self._values[key])
+        self._dirty.clear()
+        self._mm.flush()
+        # Replaying an older journal over a newer index is harmless: every
+        # record sets a value and the journal ends with the latest ones.
+        os.ftruncate(self._journal, 0)
+        os.fsync(self._journal)
+        self._journal_size = 0
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._journal is None:
+            return
+        self.sync()
+        os.close(self._journal)
+        self._journal = None
+        self._mm.close()
+        os.close(self._index)
+
+    ## Internal Methods
+
+    def _open_index(self):
+        filename = os.path.join(self.path, self.INDEX)
+        size = self._header.size + self.SLOTS * self._slot.size
+        self._index = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        if os.fstat(self._index).st_size < size:
+            os.ftruncate(self._index, size)
+        self._mm = mmap.mmap(self._index, size)
+
+        magic, used = self._header.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            used = 0
+            self._header.pack_into(self._mm, 0, self.MAGIC, used)
+
+        for n in xrange(used):
+            key, kind, length, data = self._slot.unpack_from(self._mm,
+                    self._slot_offset(n))
+            key = key.rstrip('\0')
+            self._slots[key] = n
+            self._values[key] = self._decode(kind, data[:length])
+
+    def _replay_journal(self):
+        filename = os.path.join(self.path, self.JOURNAL)
+        self._journal = os.open(filename,
+                os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        while offset + self._record.size <= len(data):
+            length, crc = self._record.unpack_from(data, offset)
+            start = offset + self._record.size
+            payload = data[start:start+length]
+            if len(payload) != length or \
+               zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            key, kind, value = payload.split('\x1c', 2)
+            self._values[key] = self._decode(kind, value)
+            self._dirty.add(key)
+            offset = start + length
+
+        if offset != len(data):
+            # torn write at the end of the journal, drop it
+            os.ftruncate(self._journal, offset)
+        self._journal_size = offset
+
+    def _append(self, key, value):
+        kind, data = self._encode(value)
+        if len(key) > 24 or len(data) > 54 or '\x1c' in key:
+            raise FiscalMemoryError("%r = %r doesn't fit in a slot" % (key, value))
+        if key not in self._values and len(self._values) >= self.SLOTS:
+            raise FiscalMemoryError("fiscal memory full (%d slots)" % self.SLOTS)
+        payload = "%s\x1c%s\x1c%s" % (key, kind, data)
+        crc = zlib.crc32(payload) & 0xffffffff
+        record = self._record.pack(len(payload), crc) + payload
+        os.write(self._journal, record)
+        self._journal_size += len(record)
+        self._pending += 1
+        self._values[key] = value
+        self._dirty.add(key)
+
+    def _write_slot(self, key, value):
+        kind, data = self._encode(value)
+        n = self._slots.get(key)
+        if n is not None:
+            self._slot.pack_into(self._mm, self._slot_offset(n),
+                    key, kind, len(data), data)
+            return
+        n = len(self._slots)
+        self._slot.pack_into(self._mm, self._slot_offset(n),
+                key, kind, len(data), data)
+        # the slot is only visible once the header counts it
+        self._header.pack_into(self._mm, 0, self.MAGIC, n + 1)
+        self._slots[key] = n
+
+    def _slot_offset(self, n):
+        return self._header.size + n * self._slot.size
+
+    def _encode(self, value):
+        if isinstance(value, (int, long)):
+            return 'i', str(value)
+        return 's', str(value)
+
+    def _decode(self, kind, data):
+        if kind == 'i':
+            return int(data)
+        return data
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Aritmética de punto fijo para los montos fiscales del emulador
+
+Todos los valores son enteros:
+
+- montos en centavos (±nnnnnnn.nn, ver 2.2.4 del manual)
+- cantidades con 10 decimales (ver 2.2.5: se aceptan 10 decimales y sólo
+  se imprimen los 3 más significativos)
+- alícuotas de IVA en centésimos de punto porcentual (21.00 % -> 2100)
+
+Cada monto calculado (importe de un ítem, neto, IVA) se redondea al centavo
+más próximo, con las mitades alejándose de cero.
+"""
+
+CENTS = 100
+QUANTITY = 10**10
+RATE = 100 * 100
+
+def parse_fixed(text, places):
+    """
+    '±nnn.nnn' -> entero escalado por 10**places
+
+    Los decimales que exceden `places` se redondean. Lanza ValueError si el
+    texto no es un número.
+    """
+    text = text.strip()
+    sign = 1
+    if text[:1] in ('+', '-'):
+        sign = -1 if text[0] == '-' else 1
+        text = text[1:]
+    whole, _, frac = text.partition('.')
+    if not (whole or frac) or not (whole + frac).isdigit():
+        raise ValueError("invalid fixed point value %r" % text)
+    value = int(whole or '0') * 10**places
+    if frac:
+        digits = frac[:places].ljust(places, '0')
+        value += int(digits)
+        if len(frac) > places and frac[places] >= '5':
+            value += 1
+    return sign * value
+
+def parse_amount(text):
+    return parse_fixed(text, 2)
+
+def parse_quantity(text):
+    return parse_fixed(text, 10)
+
+def parse_rate(text):
+    return parse_fixed(text, 2)
+
+def div_round(n, d):
+    "n / d redondeado al entero más próximo, las mitades lejos del cero"
+    q, r = divmod(abs(n), abs(d))
+    if 2 * r >= abs(d):
+        q += 1
+    return q if (n < 0) == (d < 0) else -q
+
+def line_amount(quantity, price):
+    "Importe (centavos) de `quantity` unidades de `price` centavos"
+    return div_round(quantity * price, QUANTITY)
+
+def net_of(gross, rate):
+    "Neto gravado incluido en un importe final con IVA `rate`"
+    return div_round(gross * RATE, RATE + rate)
+
+def iva_of(net, rate):
+    "IVA correspondiente a un neto gravado"
+    return div_round(net * rate, RATE)
+
+def gross_of(net, rate):
+    return net + iva_of(net, rate)
+
+def format_amount(cents):
+    sign = '-' if cents < 0 else ''
+    whole, frac = divmod(abs(cents), CENTS)
+    return "%s%d.%02d" % (sign, whole, frac)
+
+def format_quantity(quantity):
+    "Cantidad con los 3 decimales que se imprimen"
+    milli = div_round(quantity, QUANTITY // 1000)
+    sign = '-' if milli < 0 else ''
+    whole, frac = divmod(abs(milli), 1000)
+    return "%s%d.%03d" % (sign, whole, frac)
+
+def format_rate(rate):
+    whole, frac = divmod(rate, 100)
+    return "%d.%02d" % (whole, frac)
@@ -1,5 +1,241 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Salida visual del emulador (la "impresora" propiamente dicha)
+
+Los comandos no escriben en la terminal: emiten registros de línea que un
+hilo escritor vuelca en lotes a uno o más destinos (terminal, archivo de
+texto, archivo JSONL). La velocidad de impresión (`line_delay`) también se
+simula en el escritor, por lo que una consola lenta no demora las respuestas
+por el puerto serie.
+"""
+
+import re
+import sys
+import atexit
+import json
+import time
+import threading
+import weakref
+from Queue import Queue, Empty
+from collections import namedtuple
+
+# kind: 'line' se formatea a 40 columnas según `align`, 'raw' se escribe tal
+# cual (cortes de papel, separadores en color, líneas en blanco)
+Line = namedtuple("Line", "text align kind time")
+
+_ansi = re.compile(r"\x1b\[[0-9;]*m")
+
+def format_line(message, align='left'):
+    "Línea de 40 columnas para la terminal; '\\xf4' al inicio: doble ancho"
+    if message[:1] == '\xf4':
+        message = '\x1b[;1m%s\x1b[0m' % (" "+" ".join(list(message[1:]))[:40])
+    if align == 'left':
+        return message.ljust(40)
+    elif align == 'right':
+        return message.rjust(40)
+    else: # center
+        return message.center(40)
+
+def plain_text(message):
+    "Texto sin secuencias de escape ni marca de doble ancho"
+    message = _ansi.sub("", message)
+    if message[:1] == '\xf4':
+        message = message[1:]
+    return message
+
+
+class TerminalSink(object):
+    "Escribe en la terminal (o en cualquier stream) con colores ANSI"
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._cache = {}
+
+    def write(self, records):
+        self.stream.write("".join(self._render(r) for r in records))
+        self.stream.flush()
+
+    def _render(self, record):
+        if record.kind == 'raw':
+            return record.text + "\n"
+        key = record.text, record.align
+        text = self._cache.get(key)
+        if text is None:
+            if len(self._cache) >= 1024:
+                self._cache.clear()
+            text = self._cache[key] = format_line(*key) + "\n"
+        return text
+
+    def close(self):
+        self.stream.flush()
+
+
+class TextSink(object):
+    "Archivo de texto plano, 40 columnas por línea"
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, records):
+        lines = []
+        for r in records:
+            text = plain_text(r.text)
+            if r.kind == 'line':
+                text = format_line(text, r.align)
+            lines.append(text.rstrip() + "\n")
+        self.file.write("".join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(object):
+    "Un objeto JSON por línea con hora, alineación y texto sin formato"
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, records):
+        self.file.write("".join(json.dumps({
+            'time': round(r.time, 3),
+            'kind': r.kind,
+            'align': r.align,
+            'double': r.text[:1] == '\xf4',
+            'text': plain_text(r.text).decode('latin-1'),
+        }) + "\n" for r in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CountingSink(object):
+    "Sólo cuenta las líneas impresas (simulaciones, pruebas)"
+
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, records):
+        self.lines += len(records)
+
+    def close(self):
+        pass
+
+
+# impresoras con hilo escritor: lo que quede en cola se escribe al salir,
+# aunque nadie llame a close(); close() las quita de aquí
+_threaded = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for printer in list(_threaded):
+        printer.flush()
+
+
 class VisualPrinter(object):
-    pass
+    """
+    Cola de líneas impresas y el hilo que las escribe en `sinks`
+
+    Con `threaded=False` las líneas se escriben en el momento (útil para
+    scripts y pruebas); sin destinos las líneas se descartan.
+    """
+
+    def __init__(self, sinks=(), line_delay=0, batch_size=64, threaded=True):
+        self.sinks = list(sinks)
+        self.line_delay = line_delay
+        self.batch_size = batch_size
+        self.threaded = threaded and bool(self.sinks)
+        self._queue = Queue()
+        self._thread = None
+        if self.threaded:
+            self._thread = threading.Thread(target=self._run, name="VisualPrinter")
+            self._thread.daemon = True
+            self._thread.start()
+            _threaded.add(self)
+
+    @classmethod
+    def from_config(cls, conf):
+        sinks = []
+        if conf.get('terminal', True):
+            sinks.append(TerminalSink())
+        if conf.get('text'):
+            sinks.append(TextSink(conf['text']))
+        if conf.get('jsonl'):
+            sinks.append(JsonlSink(conf['jsonl']))
+        return cls(sinks, line_delay=conf.get('line_delay', 0),
+                   batch_size=conf.get('batch_size', 64),
+                   threaded=conf.get('threaded', True))
+
+    def line(self, text, align='left'):
+        if text:
+            self._put([Line(text, align, 'line', time.time())])
+
+    def raw(self, text=""):
+        self._put([Line(text, 'left', 'raw', time.time())])
+
+    def lines(self, texts):
+        "Varias líneas (un bloque fijo del comprobante) en un solo registro de cola"
+        now = time.time()
+        self._put([Line(t, 'left', 'line', now) for t in texts if t])
+
+    def flush(self):
+        "Espera a que se escriba todo lo emitido hasta ahora"
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            _threaded.discard(self)
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+    ## Internal Methods
+
+    def _put(self, records):
+        if not self.sinks:
+            return
+        if self.threaded:
+            self._queue.put(records)
+        else:
+            self._write(records)
+
+    def _write(self, records):
+        if self.line_delay:
+            time.sleep(self.line_delay * len(records))
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+            except (IOError, ValueError) as e:
+                # un destino roto no debe detener a los demás
+                print >>sys.stderr, "[ERROR] output %s: %s" % (sink.__class__.__name__, e)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            items, records = 1, []
+            stop = item is None
+            if not stop:
+                records.extend(item)
+            while not stop and len(records) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                items += 1
+                if item is None:
+                    stop = True
+                else:
+                    records.extend(item)
+            if records:
+                self._write(records)
+            for i in xrange(items):
+                self._queue.task_done()
+            if stop:
+                return
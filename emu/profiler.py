@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Perfilado del emulador por comando
+
+Con un CommandProfiler instalado (ver emulate.py --profile), cada mensaje
+procesado por CommunicationWrapper registra tiempo de reloj y de CPU en
+las fases:
+
+- parse:    validación y separación de la trama, filtros de parámetros
+- dispatch: búsqueda del método en la tabla de comandos
+- handler:  ejecución del comando (sin la emisión de líneas)
+- render:   emisión de líneas impresas (output.VisualPrinter)
+- reply:    armado de los campos y de la trama de respuesta
+
+Opcionalmente se perfila con cProfile y/o se muestrean las pilas con
+SIGPROF para generar un archivo "collapsed" (flamegraph.pl, speedscope).
+"""
+
+import os
+import time
+import signal
+import cProfile
+from collections import defaultdict
+
+PHASES = ('parse', 'dispatch', 'handler', 'render', 'reply')
+
+_cpu = time.clock
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.wall = dict.fromkeys(PHASES, 0.0)
+        self.cpu = dict.fromkeys(PHASES, 0.0)
+        self.max_wall = 0.0
+
+    @property
+    def total_wall(self):
+        return sum(self.wall.values())
+
+
+class CommandProfiler(object):
+
+    def __init__(self, use_cprofile=False, sample_interval=None):
+        self.stats = defaultdict(_Stats)
+        self.profile = cProfile.Profile() if use_cprofile else None
+        self.sample_interval = sample_interval
+        self.stacks = defaultdict(int)
+        self._render_wall = self._render_cpu = 0.0
+        self._wall = self._cpu = None
+        self._phases = None
+        self._name = None
+
+    def attach(self, comm):
+        "Instala el perfilador en un CommunicationWrapper"
+        comm.profiler = self
+        output = getattr(comm.driver, 'output', None)
+        if output is not None:
+            for name in ('line', 'raw', 'lines'):
+                setattr(output, name, self._timed(getattr(output, name)))
+        if self.profile is not None:
+            self.profile.enable()
+        if self.sample_interval:
+            signal.signal(signal.SIGPROF, self._sample)
+            # no interrumpir la lectura bloqueante del puerto
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval,
+                             self.sample_interval)
+        return self
+
+    def stop(self):
+        if self.sample_interval:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        if self.profile is not None:
+            self.profile.disable()
+
+    ## Fases (llamadas desde CommunicationWrapper)
+
+    def start(self):
+        self._wall, self._cpu = time.time(), _cpu()
+        self._phases = []
+        self._name = None
+        self._render_wall = self._render_cpu = 0.0
+
+    def mark(self, phase, name=None):
+        wall, cpu = time.time(), _cpu()
+        if self._wall is None:
+            return
+        if phase == 'handler':
+            # el tiempo de emisión de líneas se informa aparte
+            self._phases.append(('render', self._render_wall, self._render_cpu))
+            self._phases.append((phase, wall - self._wall - self._render_wall,
+                                 cpu - self._cpu - self._render_cpu))
+        else:
+            self._phases.append((phase, wall - self._wall, cpu - self._cpu))
+        if name is not None:
+            self._name = name
+        self._wall, self._cpu = wall, cpu
+
+    def finish(self):
+        if self._wall is None:
+            return
+        stats = self.stats[self._name or '?']
+        stats.count += 1
+        total = 0.0
+        for phase, wall, cpu in self._phases:
+            stats.wall[phase] += wall
+            stats.cpu[phase] += cpu
+            total += wall
+        stats.max_wall = max(stats.max_wall, total)
+        self._wall = None
+
+    ## Reportes
+
+    def report(self):
+        "Tabla con tiempos promedio por comando y fase, en milisegundos"
+        lines = ["%-22s %7s %9s %9s  %s" % ("command", "count", "mean ms", "max ms",
+                 "  ".join("%-15s" % ("%s wall/cpu" % p) for p in PHASES))]
+        for name, st in sorted(self.stats.items(), key=lambda i: -i[1].total_wall):
+            n = float(st.count)
+            lines.append("%-22s %7d %9.3f %9.3f  %s" % (
+                name, st.count, st.total_wall / n * 1000, st.max_wall * 1000,
+                "  ".join("%7.3f/%-7.3f" % (st.wall[p] / n * 1000, st.cpu[p] / n * 1000)
+                          for p in PHASES)))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        "Escribe commands.txt, stacks.collapsed y profile.pstats en `path`"
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "commands.txt"), "w") as f:
+            f.write(self.report())
+        if self.stacks:
+            with open(os.path.join(path, "stacks.collapsed"), "w") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write("%s %d\n" % (stack, count))
+        if self.profile is not None:
+            self.profile.dump_stats(os.path.join(path, "profile.pstats"))
+
+    ## Internal Methods
+
+    def _timed(self, method):
+        def timed(*args, **kwargs):
+            wall, cpu = time.time(), _cpu()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._render_wall += time.time() - wall
+                self._render_cpu += _cpu() - cpu
+        return timed
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name,
+                         os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
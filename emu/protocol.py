@@ -92,10 +92,13 @@ class Protocol(object):
             seq_no = ''
 
         command = message[1]
-        if not self._check_command_range(command):
+        if command == symbols.ESC:
+            # comandos de dos bytes: ESC y el código (p.ej. GetPrinterVersion)
+            command = message[1:3]
+        if not self._check_command_range(command[-1]):
             raise ValueError("Command %r out of valid range" % command)
 
-        params = self.parse_params(message[2:])
+        params = self.parse_params(message[1 + len(command):])
 
         if seq_no:
             return [ord(seq_no), command] + params
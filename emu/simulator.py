@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulación de eventos discretos de cajas e impresoras fiscales
+
+    python simulator.py --lanes 12 --printers 6 --rate 40 --items 15
+
+Los tickets llegan a cada caja como un proceso de Poisson y se encolan en
+la impresora asignada a la caja (las cajas se reparten entre las
+impresoras). Cada ticket se ejecuta contra una instancia de Hasar615 con
+los mismos comandos que enviaría el host; el tiempo de servicio sale de un
+modelo de transmisión serie (bytes de cada trama, ACK incluido) y de las
+líneas que efectivamente imprime el comando. Todo transcurre en tiempo
+virtual: no hay puertos ni esperas.
+"""
+
+import heapq
+import random
+from collections import namedtuple
+from optparse import OptionParser
+
+from drivers.hasar import Hasar615
+from output import VisualPrinter, CountingSink
+
+Timing = namedtuple("Timing", "baudrate line_time command_time")
+Timing.__new__.__defaults__ = (9600, 0.05, 0.005)
+
+Report = namedtuple("Report", "tickets items duration throughput wait_mean "
+                              "wait_p95 wait_max utilisation z_reports")
+
+OPEN_FISCAL_RECEIPT = '\x40'
+PRINT_LINE_ITEM = '\x42'
+SUBTOTAL = '\x43'
+TOTAL_TENDER = '\x44'
+CLOSE_FISCAL_RECEIPT = '\x45'
+DAILY_CLOSE = '\x39'
+
+
+class SimulatedPrinter(object):
+    "Hasar615 con salida contada; devuelve el tiempo de cada comando"
+
+    def __init__(self, timing):
+        self.timing = timing
+        self.counter = CountingSink()
+        # sólo en RAM: con memoria persistente configurada todas las
+        # impresoras simuladas compartirían los mismos archivos
+        self.driver = Hasar615(output=VisualPrinter([self.counter], threaded=False),
+                               persistent=False)
+        self.busy_until = 0.0
+        self.busy_time = 0.0
+        self.queue = []
+
+    def execute(self, symbol, params):
+        "Ejecuta el comando y devuelve su duración en segundos"
+        lines = self.counter.lines
+        method = self.driver.get_method(symbol)
+        self.driver.validate_params(symbol, params)
+        reply = self.driver.filter_retval(method(*params))
+        # STX seq cmd [FS param]... ETX BCC(4) + ACK, en ambos sentidos
+        sent = 8 + sum(len(p) + 1 for p in params) + 1
+        received = 8 + sum(len(r) + 1 for r in reply) + 1
+        t = self.timing
+        return (t.command_time + (sent + received) * 10.0 / t.baudrate +
+                (self.counter.lines - lines) * t.line_time)
+
+    def close(self):
+        self.driver.close()
+
+
+class Simulation(object):
+    """
+    `rate`: tickets por hora y por caja, `profile`: multiplicador de `rate`
+    para cada hora desde el inicio (se repite si es más corto), `items`: ítems promedio por ticket
+    (distribución geométrica), `payments`: probabilidad de pagar con dos
+    medios.
+    """
+
+    def __init__(self, lanes=4, printers=4, rate=30.0, items=10.0, payments=0.2,
+                 hours=12.0, profile=None, timing=None, seed=None):
+        self.lanes = lanes
+        self.rate = rate
+        self.items = items
+        self.payments = payments
+        self.duration = hours * 3600
+        self.profile = profile
+        self.timing = timing or Timing()
+        self.random = random.Random(seed)
+        self.printers = [SimulatedPrinter(self.timing) for i in xrange(printers)]
+        self._events = []
+        self._seq = 0
+        self.waits = []
+        self.items_sent = 0
+
+    def run(self):
+        max_rate = self.rate * max(self.profile or [1.0])
+        for lane in xrange(self.lanes):
+            self._schedule(self._next_arrival(0.0, max_rate), self._arrival,
+                           lane, max_rate)
+        while self._events:
+            now, seq, handler, args = heapq.heappop(self._events)
+            handler(now, *args)
+        end = max([self.duration] + [p.busy_until for p in self.printers])
+        z_reports = []
+        for printer in self.printers:
+            z_reports.append(printer.driver.get_method(DAILY_CLOSE)('Z'))
+            printer.close()
+        return self._report(end, z_reports)
+
+    ## Internal Methods
+
+    def _schedule(self, when, handler, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (when, self._seq, handler, args))
+
+    def _next_arrival(self, now, rate):
+        return now + self.random.expovariate(rate / 3600.0)
+
+    def _arrival(self, now, lane, max_rate):
+        if now >= self.duration:
+            return
+        self._schedule(self._next_arrival(now, max_rate), self._arrival,
+                       lane, max_rate)
+        # perfil horario por aceptación/rechazo (thinning)
+        if self.profile:
+            factor = self.profile[int(now // 3600) % len(self.profile)]
+            if self.random.random() * max(self.profile) > factor:
+                return
+        printer = self.printers[lane % len(self.printers)]
+        printer.queue.append((now, self._ticket()))
+        if len(printer.queue) == 1 and printer.busy_until <= now:
+            self._start(now, printer)
+
+    def _ticket(self):
+        rnd = self.random
+        n = 1 + int(rnd.expovariate(1.0 / max(self.items - 1, 1e-9)))
+        commands = [(OPEN_FISCAL_RECEIPT, ('B', 'T'))]
+        total = 0
+        for i in xrange(n):
+            price = rnd.randint(100, 50000)
+            total += price
+            commands.append((PRINT_LINE_ITEM, ("ITEM %d" % i, "1", "%d.%02d" % divmod(price, 100),
+                                               "21.00", "M", "0", "0", "T")))
+        commands.append((SUBTOTAL, ('P', 'Subtotal', '0')))
+        if rnd.random() < self.payments:
+            commands.append((TOTAL_TENDER, ('Tarjeta', "%d.%02d" % divmod(total // 2, 100), 'T', '0')))
+            total -= total // 2
+        commands.append((TOTAL_TENDER, ('Efectivo', "%d.%02d" % divmod(total, 100), 'T', '0')))
+        commands.append((CLOSE_FISCAL_RECEIPT, ()))
+        return n, commands
+
+    def _start(self, now, printer):
+        arrival, (n, commands) = printer.queue[0]
+        service = sum(printer.execute(symbol, params) for symbol, params in commands)
+        self.waits.append(now - arrival)
+        self.items_sent += n
+        printer.busy_until = now + service
+        printer.busy_time += service
+        self._schedule(printer.busy_until, self._done, printer)
+
+    def _done(self, now, printer):
+        printer.queue.pop(0)
+        if printer.queue:
+            self._start(now, printer)
+
+    def _report(self, end, z_reports):
+        waits = sorted(self.waits)
+        count = len(waits)
+        return Report(
+            tickets=count,
+            items=self.items_sent,
+            duration=end,
+            throughput=count / (end / 3600.0) if end else 0.0,
+            wait_mean=sum(waits) / count if count else 0.0,
+            wait_p95=waits[int(count * 0.95)] if count else 0.0,
+            wait_max=waits[-1] if count else 0.0,
+            utilisation=[p.busy_time / end if end else 0.0 for p in self.printers],
+            z_reports=z_reports,
+        )
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--lanes", type="int", default=4)
+    parser.add_option("--printers", type="int", default=4)
+    parser.add_option("--rate", type="float", default=30.0,
+                      help="tickets per hour per lane at peak")
+    parser.add_option("--profile", metavar="F,F,...",
+                      help="hourly multipliers of the rate (e.g. 0.2,0.5,1,1,0.6)")
+    parser.add_option("--items", type="float", default=10.0,
+                      help="mean items per ticket")
+    parser.add_option("--payments", type="float", default=0.2,
+                      help="probability of paying with two tenders")
+    parser.add_option("--hours", type="float", default=12.0)
+    parser.add_option("--baudrate", type="int", default=9600)
+    parser.add_option("--line-time", type="float", default=0.05,
+                      help="seconds to print a line")
+    parser.add_option("--command-time", type="float", default=0.005,
+                      help="processing overhead per command, in seconds")
+    parser.add_option("--seed", type="int", default=None)
+    options, args = parser.parse_args()
+
+    profile = None
+    if options.profile:
+        profile = [float(f) for f in options.profile.split(",")]
+    sim = Simulation(options.lanes, options.printers, options.rate,
+                     options.items, options.payments, options.hours, profile,
+                     Timing(options.baudrate, options.line_time, options.command_time),
+                     options.seed)
+    r = sim.run()
+    print "tickets       %d (%d items) in %.1f h" % (r.tickets, r.items, r.duration / 3600)
+    print "throughput    %.1f tickets/h" % r.throughput
+    print "queue delay   mean %.2fs  p95 %.2fs  max %.2fs" % (r.wait_mean, r.wait_p95, r.wait_max)
+    for i, u in enumerate(r.utilisation):
+        print "printer %-4d  utilisation %5.1f %%  Z %s: %s documents" % (
+                i, u * 100, r.z_reports[i][2], r.z_reports[i][6])
+
+if __name__ == '__main__':
+    main()
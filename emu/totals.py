@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tipos de comprobante fiscal (OpenFiscalReceipt)
+FISCAL_TYPES = ('T', 'A', 'B', 'D', 'E')
+# tipos de nota de crédito (OpenDNFH)
+CREDIT_TYPES = ('R', 'S')
+
+
+class DailyTotals(object):
+    """
+    Acumuladores de una jornada fiscal (informe Z) o de lectura (informe X)
+
+    Se actualizan al cerrar cada comprobante, de modo que generar el informe
+    no depende de la cantidad de comprobantes emitidos. Si se indica una
+    memoria fiscal (ver memory.FiscalMemory) los acumuladores se guardan
+    con el prefijo `prefix` y sobreviven a un reinicio del emulador.
+    """
+
+    def __init__(self, prefix, memory=None):
+        self.prefix = prefix
+        self.memory = memory
+        self._clear()
+        self._load()
+
+    def reset(self):
+        self._clear()
+        self._save(clear=True)
+
+    def add_document(self, doc_type, number, total, iva):
+        """
+        Suma un comprobante cerrado.
+
+        `total` e `iva` en centavos, `iva` es un diccionario {alícuota: IVA}
+        (ver money.py).
+        """
+        if doc_type in CREDIT_TYPES:
+            self.credit += total
+            acc = self.credit_iva
+        else:
+            self.gross += total
+            acc = self.iva
+        for rate, amount in iva.iteritems():
+            acc[rate] = acc.get(rate, 0) + amount
+        self.counts[doc_type] = self.counts.get(doc_type, 0) + 1
+        self.first.setdefault(doc_type, number)
+        self.last[doc_type] = number
+        self._save()
+
+    def add_cancelled(self, doc_type):
+        if doc_type in CREDIT_TYPES:
+            self.credit_cancelled += 1
+        else:
+            self.cancelled += 1
+        self._save()
+
+    def add_non_fiscal(self):
+        self.non_fiscal += 1
+        self._save()
+
+    @property
+    def fiscal_count(self):
+        return sum(self.counts.get(t, 0) for t in FISCAL_TYPES)
+
+    @property
+    def total_iva(self):
+        return sum(self.iva.values(), 0)
+
+    @property
+    def total_credit_iva(self):
+        return sum(self.credit_iva.values(), 0)
+
+    ## Internal Methods
+
+    def _clear(self):
+        self.gross = 0
+        self.iva = {}
+        self.credit = 0
+        self.credit_iva = {}
+        self.counts = {}
+        self.first = {}
+        self.last = {}
+        self.cancelled = 0
+        self.credit_cancelled = 0
+        self.non_fiscal = 0
+        self.dnfh = 0
+
+    _scalars = ('gross', 'credit', 'cancelled', 'credit_cancelled',
+                'non_fiscal', 'dnfh')
+    _mappings = ('iva', 'credit_iva', 'counts', 'first', 'last')
+
+    def _dump(self):
+        p = self.prefix
+        values = {}
+        for name in self._scalars:
+            values[p + name] = getattr(self, name)
+        for name in self._mappings:
+            for key, value in getattr(self, name).iteritems():
+                values["%s%s:%s" % (p, name, key)] = value
+        return values
+
+    def _save(self, clear=False):
+        if self.memory is None:
+            return
+        values = self._dump()
+        if clear:
+            # las claves por alícuota/tipo quedan en cero
+            for key, value in self.memory.items():
+                if key.startswith(self.prefix) and key not in values:
+                    values[key] = 0
+        self.memory.update(values)
+
+    def _load(self):
+        if self.memory is None:
+            return
+        p = self.prefix
+        for key, value in self.memory.items():
+            if not key.startswith(p):
+                continue
+            name, _, sub = key[len(p):].partition(':')
+            if name in self._scalars and not sub:
+                setattr(self, name, value)
+            elif name in self._mappings and sub and value:
+                if name in ('iva', 'credit_iva'):
+                    sub = int(sub)
+                getattr(self, name)[sub] = value
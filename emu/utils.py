@@ -227,7 +227,7 @@ class _symbols(object):
     STX = '\x02'
     ETX = '\x03'
     ACK = '\x06'
-    NAK = '\x07'
+    NAK = '\x15'
     DC1 = '\x11'
     DC2 = '\x12'
     DC3 = '\x13'
@@ -22,39 +22,61 @@ class CommunicationWrapper(object):
         self.proto = protocol(commandRange=(0x00, 0xff), sequenceRange=(0x00, 0xff))
         self.driver = driver()
         self.debug = debug
+        self._last_input = None
+        self._last_output = None
+        self._pending = ""
+        self.profiler = None    # ver profiler.CommandProfiler
 
     def process_message(self, message):
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
         self.driver.clean_fiscal_status()
         try:
             msg = self.proto.parse_message(message, False)
         except ProtocolError as e:
             self.manage_exception(e)
+            return None
 
         seq, command = msg[:2]
         params = msg[2:]
 
         seq = self.filter_seq(seq)
         params = self.filter_params(params)
-
-        self.send_control_char('ACK')
+        if profiler:
+            profiler.mark('parse')
 
         retval = self.execute_command(command, params)
         retval = self.filter_retval(retval)
 
         self._last_input = message
         self._last_output = self.proto.build_message_with_seq(command, seq, *retval)
+        if profiler:
+            profiler.mark('reply')
+            profiler.finish()
 
         return self._last_output
 
     def execute_command(self, command, params):
         retval = None
+        callback = None
+        profiler = self.profiler
         try:
             callback = self.driver.get_method(command)
+            self.driver.validate_params(command, params)
+            if profiler:
+                profiler.mark('dispatch')
             retval = callback(*params)
+            if profiler:
+                profiler.mark('handler', callback.__name__)
             if self.debug:
                 print "\x1b[32mDEBUG:\x1b[0m %s%r --> %r" % (callback.__name__, tuple(params), retval)
         except FiscalDriverException as e:
+            if profiler:
+                profiler.mark('handler', callback.__name__ if callback else None)
             self.manage_exception(e)
+            # un comando rechazado responde sólo con los estados
+            retval = self.driver.status_fields()
 
         return retval
 
@@ -81,7 +103,7 @@ class CommunicationWrapper(object):
             return
 
         if isinstance(exception, ProtocolError):
-            self.send_control_char('NAK')
+            self.send_control_char(s.NAK)
             return
 
         # TODO: log the exception
@@ -112,43 +134,57 @@ class CommunicationWrapper(object):
         self.serial_port.write(s)
         self.serial_port.flush()
 
-    def write(self, message, waitACK=True):
+    def write(self, message, waitACK=True, retries=4):
         self.serial_port.write(message)
         self.serial_port.flush()
 
         if waitACK:
-            r = self.serial_port.read(1)
-            if r == s.NAK:
-                print "NAK received, resending message."
-                self.write(message)
-            elif r == s.ACK:
+            r = self._read_byte()
+            if r == s.ACK:
                 return
+            elif r == s.STX:
+                # se perdió el ACK y el host ya envió otra trama
+                self._pending = r
+            elif retries:
+                # NAK o un ACK dañado: se reenvía
+                print "%r received, resending message." % r
+                self.write(message, retries=retries - 1)
             else:
                 raise TransmissionError("Unknown response %r (0x%x)" % (r, ord(r)))
 
-    def read(self):
-        data = []
-
+    def _read_byte(self):
+        if self._pending:
+            r, self._pending = self._pending, ""
+            return r
         try:
             r = self.serial_port.read(1)
         except IOError as e:
+            r = ""
+        if not r:
+            # el puerto no tiene timeout: sin datos es fin de archivo
             print "Closed port by external process (finishing...)"
             raise SystemExit(0)
+        return r
+
+    def read(self):
+        data = []
+
+        r = self._read_byte()
 
         if r == s.STX:
             data.append(r)
             while r != s.ETX:
-                r = self.serial_port.read(1)
+                r = self._read_byte()
                 data.append(r)
             bcc = ""
             for i in range(4):
-                bcc += self.serial_port.read(1)
+                bcc += self._read_byte()
             data.append(bcc)
-        elif r == s.ACK:
-            self.send_control_char(s.ACK)
+        elif r in (s.ACK, s.NAK):
+            # ACK/NAK fuera de lugar (repetido o tardío): se ignora
             return self.read()
         else:
-            raise TransmissionError("not ETX received, instaed %r (0x%x)" % (r, ord(r)))
+            raise TransmissionError("not STX received, instead %r (0x%x)" % (r, ord(r[:1] or "\0")))
 
         return "".join(data)
 
@@ -162,8 +198,26 @@ class CommunicationWrapper(object):
                 self.send_control_char(s.NAK)
                 continue
 
+            if not self.proto._checkBCC(request_message):
+                print "Bad Request: BCC error in %r" % request_message
+                self.send_control_char(s.NAK)
+                continue
+
             self.send_control_char(s.ACK)
 
+            if request_message == self._last_input:
+                # trama repetida (el host no recibió la respuesta): no se
+                # vuelve a ejecutar el comando, se reenvía la respuesta
+                try:
+                    self.write(self._last_output)
+                except TransmissionError as te:
+                    print "Reply not acknowledged: %s" % te
+                continue
+
             response_message = self.process_message(request_message)
 
-            self.write(response_message)
+            if response_message is not None:
+                try:
+                    self.write(response_message)
+                except TransmissionError as te:
+                    print "Reply not acknowledged: %s" % te